@@ -0,0 +1,381 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+from StringIO import StringIO
+from collections import deque
+from pymetabans import Metabans, MetabansBatch, call_label, decompress_chunks, \
+    encode_requests
+import asyncore
+import httplib
+import logging
+import socket
+import sys
+import time
+import types
+import urllib
+import urllib2
+import urlparse
+import zlib
+'''Non-blocking Metabans client running many calls on a single thread'''
+
+log = logging.getLogger('pymetabans')
+
+
+class MetabansFuture(object):
+    """Result of a call made by AsyncMetabans, available once the call is
+    over"""
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        """return the result of the call or raise its exception"""
+        if not self._done:
+            raise RuntimeError("call is not over yet")
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        if not self._done:
+            raise RuntimeError("call is not over yet")
+        return self._exception
+
+    def add_done_callback(self, func):
+        """call func with this future once it is done"""
+        if self._done:
+            func(self)
+        else:
+            self._callbacks.append(func)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def then(self, func):
+        """return a future of func(result), or of the exception of this
+        future or raised by func"""
+        future = MetabansFuture()
+        def chain(_):
+            if self._exception is not None:
+                future.set_exception(self._exception)
+                return
+            try:
+                result = func(self._result)
+            except Exception, err:
+                future.set_exception(err)
+            else:
+                future.set_result(result)
+        self.add_done_callback(chain)
+        return future
+
+    def _finish(self):
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, []
+        for func in callbacks:
+            try:
+                func(self)
+            except Exception:
+                log.exception("error in %r callback", func)
+
+
+def coroutine(func):
+    """decorator turning a generator function yielding MetabansFutures into
+    a function returning a MetabansFuture of the generator return value.
+
+    The result of each yielded future is sent back into the generator (or its
+    exception raised there). As generators cannot return a value in this
+    version of Python, the value of the last `yield` of something that is not
+    a future is used as result.
+    """
+    def wrapper(*args, **kwargs):
+        future = MetabansFuture()
+        gen = func(*args, **kwargs)
+        if not isinstance(gen, types.GeneratorType):
+            future.set_result(gen)
+            return future
+        state = {'result': None}
+        def step(send_value=None, exception=None):
+            try:
+                while True:
+                    if exception is not None:
+                        yielded = gen.throw(exception)
+                        exception = None
+                    else:
+                        yielded = gen.send(send_value)
+                    if isinstance(yielded, MetabansFuture):
+                        if yielded.done():
+                            send_value, exception = yielded._result, yielded._exception
+                            continue
+                        yielded.add_done_callback(lambda f: step(f._result, f._exception))
+                        return
+                    state['result'] = send_value = yielded
+            except StopIteration:
+                future.set_result(state['result'])
+            except Exception, err:
+                future.set_exception(err)
+        step()
+        return future
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+
+class _FakeSocket(object):
+    """let httplib parse a response we already received"""
+    def __init__(self, data):
+        self._data = data
+
+    def makefile(self, *args, **kwargs):
+        return StringIO(self._data)
+
+
+class _HTTPCall(asyncore.dispatcher):
+    """a single HTTP request over its own non-blocking connection"""
+    def __init__(self, client, family, address, request, future, wire):
+        asyncore.dispatcher.__init__(self, map=client._map)
+        self._client = client
+        self._outgoing = request
+        self._incoming = []
+        self.future = future
+        self.wire = wire
+        self.started = time.time()
+        self.create_socket(family, socket.SOCK_STREAM)
+        try:
+            self.connect(address)
+        except socket.error:
+            self.close()
+            raise
+
+    def writable(self):
+        return not self.connected or bool(self._outgoing)
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        sent = self.send(self._outgoing)
+        self._outgoing = self._outgoing[sent:]
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if data:
+            self._incoming.append(data)
+
+    def handle_close(self):
+        self.close()
+        try:
+            response = httplib.HTTPResponse(_FakeSocket(''.join(self._incoming)))
+            response.begin()
+            raw_body = response.read()
+            self.wire['received'] = len(raw_body)
+            http_body = ''.join(decompress_chunks([raw_body], response.getheader('Content-Encoding')))
+        except (httplib.HTTPException, socket.error, zlib.error, ValueError), err:
+            self.fail(err)
+            return
+        if response.status != 200:
+            self.fail(urllib2.HTTPError(self._client._service_url, response.status,
+                                        response.reason, response.msg, None))
+            return
+        self._client._finished(self)
+        self.future.set_result(http_body)
+
+    def handle_error(self):
+        self.fail(sys.exc_info()[1])
+
+    def fail(self, exception):
+        self.close()
+        self._client._finished(self)
+        if not self.future.done():
+            self.future.set_exception(exception)
+
+
+class AsyncMetabansBatch(MetabansBatch):
+    """MetabansBatch whose send() returns a MetabansFuture of the results"""
+    def send(self, mirror=None, profiler=None):
+        return self._metabans.multi_query(self.requests, mirror, profiler).then(self.results)
+
+
+class AsyncMetabans(Metabans):
+    """Metabans client whose calls do not block.
+
+    mbo_player_status(), mb_sight_player(), mb_assess_player(),
+    mbo_availability_account_name(), multi_query() and _query() take the same
+    parameters as with Metabans but return a MetabansFuture, which gets the
+    same result or exception. So does the send() method of batch(). Calls only make progress while run() or wait()
+    are running, so a single thread can have thousands of them in flight.
+
+    Every call is made over its own connection. At most `max_connections`
+    connections are opened at once, other calls wait for their turn. A call
+    taking more than `timeout` seconds fails with socket.timeout.
+
+    Responses are compressed whenever the Metabans service supports it, but
+    requests are never compressed. Only http URLs are supported.
+    """
+    def __init__(self, username=None, apikey=None, user_agent='pymetabans',
+                 url="http://metabans.com/api", max_connections=100, timeout=30,
+                 mirror=False, profiler=True, metrics=None):
+        Metabans.__init__(self, username, apikey, user_agent, url, keep_alive=False,
+                          mirror=mirror, profiler=profiler, metrics=metrics, timeout=timeout)
+        parts = urlparse.urlsplit(url)
+        if parts.scheme != 'http':
+            raise ValueError("unsupported URL scheme : %r" % parts.scheme)
+        self._host = parts.hostname
+        self._port = parts.port or 80
+        self._path = parts.path or '/'
+        if parts.query:
+            self._path += '?' + parts.query
+        self._host_header = parts.netloc.rpartition('@')[2]
+        self._address = None
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._map = {}
+        self._calls = set()
+        self._waiting = deque()
+
+    @property
+    def pending(self):
+        """number of calls not over yet"""
+        return len(self._calls) + len(self._waiting)
+
+    def run(self, timeout=None):
+        """run calls until they are all over, or for at most timeout seconds"""
+        deadline = None if timeout is None else time.time() + timeout
+        while self.pending and (deadline is None or time.time() < deadline):
+            self._poll()
+
+    def wait(self, futures):
+        """run calls until all the given futures are done and return their
+        results, in order"""
+        if isinstance(futures, MetabansFuture):
+            futures = [futures]
+        while not all(f.done() for f in futures):
+            if not self.pending:
+                raise RuntimeError("waiting for a future no call will complete")
+            self._poll()
+        return [f.result() for f in futures]
+
+    def close(self):
+        """abort all calls in flight"""
+        for call in list(self._calls):
+            call.fail(socket.error("client closed"))
+        while self._waiting:
+            request, future, wire = self._waiting.popleft()
+            future.set_exception(socket.error("client closed"))
+
+    def batch(self):
+        return AsyncMetabansBatch(self)
+
+    def iter_multi_query(self, requests, mirror=None, profiler=None):
+        """run the call until it is over, then yield its raw responses. The
+        responses of a call made over the event loop are all decoded at once"""
+        future = self.multi_query(requests, mirror, profiler)
+        for response in self.wait(future)[0]:
+            yield response
+
+    def _query(self, requests):
+        return self._send(requests).then(self._unwrap)
+
+    def _send(self, requests, options=None):
+        requests = list(requests)
+        data = urllib.urlencode(self._query_parameters(encode_requests(requests), options))
+        wire = {'sent': len(data), 'received': 0}
+        future = self._post(data, wire)
+        if self.metrics is not None:
+            started = time.time()
+            def observe(future):
+                self.metrics.observe_call(call_label(requests), len(requests), time.time() - started,
+                                          wire['sent'], wire['received'], error=future._exception)
+            future.add_done_callback(observe)
+        def decode(http_body):
+            responses = self._decode(http_body)
+            for request, response in zip(requests, responses):
+                self._observe_response(request, response)
+            return responses
+        return future.then(decode)
+
+    def _post(self, data, wire):
+        """queue the call and return a MetabansFuture of its HTTP body. The
+        size of the response body as received is set in wire['received']"""
+        request = "\r\n".join([
+            "POST %s HTTP/1.0" % self._path,
+            "Host: %s" % self._host_header,
+            "User-Agent: %s" % self._user_agent,
+            "Content-Type: application/x-www-form-urlencoded",
+            "Accept-Encoding: gzip, deflate",
+            "Content-Length: %d" % len(data),
+            "", data])
+        future = MetabansFuture()
+        self._waiting.append((request, future, wire))
+        self._startWaitingCalls()
+        return future
+
+    def _startWaitingCalls(self):
+        while self._waiting and len(self._calls) < self.max_connections:
+            request, future, wire = self._waiting.popleft()
+            try:
+                if self._address is None:
+                    family, _, _, _, address = socket.getaddrinfo(
+                        self._host, self._port, 0, socket.SOCK_STREAM)[0]
+                    self._address = (family, address)
+                self._calls.add(_HTTPCall(self, self._address[0], self._address[1],
+                                          request, future, wire))
+            except socket.error, err:
+                future.set_exception(err)
+
+    def _finished(self, call):
+        self._calls.discard(call)
+        self._startWaitingCalls()
+
+    def _poll(self):
+        asyncore.loop(timeout=0.1, use_poll=True, map=self._map, count=1)
+        now = time.time()
+        for call in list(self._calls):
+            if now - call.started > self.timeout:
+                call.fail(socket.timeout("no response after %ss" % self.timeout))
+
+
+if __name__ == '__main__':
+    import pprint
+    from pymetabans import Player
+    logging.basicConfig(level=logging.INFO)
+
+    metabans = AsyncMetabans()
+
+    @coroutine
+    def sight_and_check(player):
+        yield metabans.mb_sight_player('MOH_2010', player)
+        status = yield metabans.mbo_player_status('MOH_2010', player.uid)
+        yield status
+
+    futures = [sight_and_check(Player('test_async_%s' % i, 'test_async_%s' % i))
+               for i in range(20)]
+    started = time.time()
+    metabans.run()
+    print("%s calls in %0.2fs" % (2 * len(futures), time.time() - started))
+    for f in futures:
+        if f.exception():
+            print(f.exception())
+        else:
+            pprint.pprint(f.result())
@@ -0,0 +1,134 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+from itertools import islice
+import logging
+import threading
+'''Adapt the number of requests sent in a single call to Metabans'''
+
+log = logging.getLogger('pymetabans')
+
+
+def recheck_interval(interval, max_interval, calls, latency, target_latency):
+    """return the time to wait before the next re-check of connected players.
+    
+    interval is stretched by the number of calls the last re-check made and
+    by how much slower than target_latency they were, so that re-checks make
+    about one call per interval whatever the number of players, and back off
+    when Metabans is slow"""
+    stretch = max(1, calls) * max(1.0, latency / target_latency)
+    return min(max_interval, interval * stretch)
+
+
+def batches(iterable, size):
+    """group the items of iterable into lists of size items, consuming 
+    iterable only as the lists are needed. size can also be a function 
+    returning the size of the next list"""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size() if callable(size) else size))
+        if not batch:
+            return
+        yield batch
+
+
+class BatchSizer(object):
+    """Batch size controller fed with the outcome of each call.
+
+    A full batch is grown by `step` requests as long as the number of requests
+    processed per second does not drop. The batch size is halved as soon as a
+    call fails, takes more than `target_latency` seconds, or when the time per
+    request, either as seen by us or as reported by Metabans in the
+    `fetch_time` of the responses, spikes above `spike_factor` times its
+    recent average. As the fixed cost of a call weighs more on small calls,
+    the time per request seen by us is only compared between calls of at
+    least half the batch size.
+
+    A single BatchSizer is meant to be used by a single batching path.
+
+            initial : batch size to start with
+            minimum : smallest batch size
+            maximum : largest batch size
+               step : number of requests added to a batch when growing
+     target_latency : time in seconds above which a call is too slow
+       spike_factor : how many times slower than usual a call must be to be
+                      seen as a latency spike
+    """
+    def __init__(self, initial=50, minimum=1, maximum=200, step=5,
+                 target_latency=2.0, spike_factor=3.0):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.step = step
+        self.target_latency = target_latency
+        self.spike_factor = spike_factor
+        self._size = min(max(initial, self.minimum), self.maximum)
+        self._throughput = None
+        self._latency = None
+        self._server_time = None
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        """number of requests to put in the next batch"""
+        return self._size
+
+    def record(self, count, latency, fetch_times=()):
+        """account for a call of `count` requests which took `latency` seconds,
+        fetch_times being the time in seconds Metabans took for each request"""
+        if count <= 0:
+            return
+        latency = max(latency, 0.001)
+        request_latency = latency / count
+        server_time = sum(fetch_times) / count
+        with self._lock:
+            comparable = count * 2 >= self._size
+            spike = (comparable and self._isSpike(request_latency, self._latency)) \
+                or self._isSpike(server_time, self._server_time)
+            if comparable:
+                self._latency = self._average(self._latency, request_latency)
+            self._server_time = self._average(self._server_time, server_time)
+            if latency > self.target_latency:
+                self._shrink("call took %.2fs" % latency)
+            elif spike:
+                self._shrink("latency spike")
+            elif count >= self._size:
+                throughput = count / latency
+                if self._throughput is None or throughput >= self._throughput:
+                    self._size = min(self._size + self.step, self.maximum)
+                else:
+                    self._size = max(self._size - self.step, self.minimum)
+                self._throughput = self._average(self._throughput, throughput)
+
+    def failed(self):
+        """account for a call that failed or timed out"""
+        with self._lock:
+            self._shrink("call failed")
+
+    def _shrink(self, reason):
+        size = max(self._size // 2, self.minimum)
+        if size != self._size:
+            log.debug("%s, reducing batch size from %s to %s", reason, self._size, size)
+        self._size = size
+        # the throughput seen with larger batches is no longer comparable
+        self._throughput = None
+
+    def _isSpike(self, value, average):
+        return average is not None and average > 0 and value > average * self.spike_factor
+
+    @staticmethod
+    def _average(average, value, weight=0.3):
+        if average is None:
+            return value
+        return average + weight * (value - average)
@@ -0,0 +1,372 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+from b3.events import EVT_CLIENT_AUTH, EVT_CLIENT_BAN, EVT_CLIENT_UNBAN, Event
+from fakemetabans import FakeMetabans, FakeMetabansServer
+from plugin import MetabansPlugin
+from pymetabans import HTTPConnectionPool, Transport
+import b3
+import b3.clients
+import b3.config
+import b3.fake
+import os
+import re
+import resource
+import shutil
+import tempfile
+import threading
+import time
+'''Benchmarks of the plugin hot paths against a local stand-in for Metabans.
+
+Run from a B3 installation, as the game server is simulated with b3.fake :
+
+    python benchmark.py [-h] [-o results.json] [scenario[:size,...]] ...
+
+Each run reports its throughput, the p50/p95/p99 latencies, the peak number
+of threads and how much the RSS of the process grew during the run, and the
+results of all runs are written as JSON.
+
+The sync scenario needs a B3 database without penalties, as it fills the
+penalties table with bans of its own.
+'''
+
+try:
+    # Python >= 2.6
+    import json
+except ImportError:
+    # Python < 2.6
+    import simplejson as json
+
+SCENARIOS = {
+    # players connecting at once, each one checked then sighted
+    'storm': (32, 64, 128),
+    # active bans sent by !metabanssync full
+    'sync': (1000, 10000, 100000),
+    # players banned then unbanned at once
+    'bans': (100, 1000),
+}
+
+# share of the players of a reconnect storm that are banned at Metabans
+BANNED_RATIO = 0.1
+
+
+def percentile(values, p):
+    """nearest-rank percentile of a list of values"""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(int(round(p / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+class TimedTransport(Transport):
+    """Transport recording the duration of each call made through another
+    transport"""
+    def __init__(self, transport):
+        self.transport = transport
+        self.durations = []
+
+    def post_stream(self, body, headers, wire=None):
+        started = time.time()
+        try:
+            for chunk in self.transport.post_stream(body, headers, wire):
+                yield chunk
+        finally:
+            self.durations.append(time.time() - started)
+
+    def close(self):
+        self.transport.close()
+
+
+def current_rss_kb():
+    """resident set size of the process, or None if /proc is not available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() // 1024
+    except (IOError, IndexError, ValueError):
+        return None
+
+
+class ResourceMonitor(object):
+    """Sample the number of threads and the RSS while a benchmark runs"""
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak_threads = 0
+        self.start_rss_kb = None
+        self.peak_rss_kb = None
+        self._running = threading.Event()
+
+    def __enter__(self):
+        self.peak_threads = threading.activeCount()
+        self.start_rss_kb = self.peak_rss_kb = current_rss_kb()
+        self._start_maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self._running.set()
+        self._thread = threading.Thread(target=self._run, name='benchmark-monitor')
+        self._thread.setDaemon(True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._running.clear()
+        self._thread.join()
+        self._sample()
+
+    def _run(self):
+        while self._running.isSet():
+            self._sample()
+            time.sleep(self.interval)
+
+    def _sample(self):
+        self.peak_threads = max(self.peak_threads, threading.activeCount())
+        rss = current_rss_kb()
+        if rss is not None:
+            self.peak_rss_kb = max(self.peak_rss_kb, rss)
+
+    @property
+    def rss_increase_kb(self):
+        """how much the RSS of the process grew above its value at the start
+        of the benchmark. ru_maxrss is the peak of the whole process, so
+        without /proc only a growth above the peak of earlier runs is seen"""
+        if self.start_rss_kb is not None:
+            return self.peak_rss_kb - self.start_rss_kb
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - self._start_maxrss
+
+
+class Benchmark(object):
+    """Run the plugin on a b3.fake console against a FakeMetabansServer
+
+                latency : time in seconds each call to the fake server takes
+    latency_per_request : time in seconds added for each request of a call
+    """
+    def __init__(self, latency=0.02, latency_per_request=0.0002):
+        self.metabans = FakeMetabans(latency=latency, latency_per_request=latency_per_request)
+        self.server = FakeMetabansServer(metabans=self.metabans).start()
+        self.console = b3.fake.fakeConsole
+        self.console.gameName = 'bf3'
+        self._tmpdir = tempfile.mkdtemp(prefix='metabans-benchmark-')
+        self._admin = self._loadAdminPlugin()
+        self._penaltiesPopulated = False
+        self.plugin = self._loadPlugin()
+        self.transport = TimedTransport(HTTPConnectionPool(self.server.url))
+        self.plugin._metabans.metabans.transport = self.transport
+        self.plugin.onStartup()
+        self.results = []
+
+    def close(self):
+        self.server.shutdown()
+        shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+    def _loadAdminPlugin(self):
+        from b3.plugins.admin import AdminPlugin
+        admin = AdminPlugin(self.console, '@b3/conf/plugin_admin.xml')
+        admin.onStartup()
+        if getattr(self.console, '_plugins', None) is None:
+            self.console._plugins = {}
+        self.console._plugins['admin'] = admin
+        return admin
+
+    def _loadPlugin(self):
+        """load the plugin with the distributed config file, using a database
+        of its own"""
+        conf = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'conf', 'plugin_metabans.xml')
+        with open(conf) as f:
+            xml = f.read()
+        database = os.path.join(self._tmpdir, 'metabans.sqlite')
+        xml = re.sub(r'<set name="database">[^<]*</set>', '<set name="database">%s</set>' % database, xml)
+        path = os.path.join(self._tmpdir, 'plugin_metabans.xml')
+        with open(path, 'w') as f:
+            f.write(xml)
+        return MetabansPlugin(self.console, b3.config.load(path))
+
+    def run(self, scenario, size):
+        """run a scenario and return its results"""
+        if self.plugin._metabans.cache is not None:
+            self.plugin._metabans.cache.clear()
+        del self.transport.durations[:]
+        with ResourceMonitor() as monitor:
+            started = time.time()
+            latencies, extra = getattr(self, 'run_%s' % scenario)(size)
+            duration = time.time() - started
+        result = {
+            'scenario': scenario,
+            'size': size,
+            'duration': round(duration, 4),
+            'throughput': round(size / duration, 2) if duration else None,
+            'latency': dict(('p%s' % p, percentile(latencies, p)) for p in (50, 95, 99)),
+            'calls': len(self.transport.durations),
+            'call_latency': dict(('p%s' % p, percentile(self.transport.durations, p)) for p in (50, 95, 99)),
+            'peak_threads': monitor.peak_threads,
+            'rss_increase_kb': monitor.rss_increase_kb,
+        }
+        result.update(extra)
+        self.results.append(result)
+        return result
+
+    def _newClients(self, prefix, size):
+        clients = []
+        for i in range(size):
+            client = b3.fake.FakeClient(self.console, name='%s%s' % (prefix, i),
+                                        exactName='%s%s' % (prefix, i),
+                                        guid='%s%032d' % (prefix, i),
+                                        ip='10.%s.%s.%s' % (i // 65536 % 256, i // 256 % 256, i % 256),
+                                        groupBits=1)
+            clients.append(client)
+        return clients
+
+    def run_storm(self, size):
+        """players reconnecting at once, as after a map change or a server
+        restart. Latency is from the EVT_CLIENT_AUTH event to the end of the
+        player check"""
+        prefix = 'storm%s_%s_' % (size, int(time.time()))
+        clients = self._newClients(prefix, size)
+        nb_banned = int(size * BANNED_RATIO)
+        for client in clients:
+            self.metabans.handle_request({'action': 'mb_sight_player', 'game_name': 'BF_3',
+                                          'player_uid': client.guid, 'player_name': client.name})
+        for client in clients[:nb_banned]:
+            self.metabans.handle_request({'action': 'mb_assess_player', 'game_name': 'BF_3',
+                                          'player_uid': client.guid, 'assessment_type': 'black',
+                                          'reason': 'benchmark'})
+        submitted = {}
+        checked = {}
+        done = threading.Event()
+        check_client = self.plugin._checkClient
+        def timed_check(client):
+            try:
+                check_client(client)
+            finally:
+                checked[client.guid] = time.time()
+                if len(checked) == size:
+                    done.set()
+        self.plugin._checkClient = timed_check
+        try:
+            for client in clients:
+                submitted[client.guid] = time.time()
+                self.plugin.onEvent(Event(EVT_CLIENT_AUTH, None, client))
+            done.wait(300)
+        finally:
+            del self.plugin._checkClient
+        latencies = [checked[guid] - submitted[guid] for guid in checked]
+        return latencies, {'banned': nb_banned, 'checked': len(checked)}
+
+    def run_sync(self, size):
+        """!metabanssync full over that many active bans. Latency is the
+        duration of each call to Metabans"""
+        self._populatePenalties(size)
+        admin = b3.fake.FakeClient(self.console, name='benchmark admin', exactName='benchmark admin',
+                                   guid='benchmarkadmin', groupBits=128)
+        self.plugin.cmd_metabanssync('full', admin)
+        return list(self.transport.durations), {}
+
+    def _populatePenalties(self, size):
+        storage = self.console.storage
+        if self._penaltiesPopulated:
+            # the table only holds the bans of the previous sync run
+            storage.query("DELETE FROM penalties")
+        else:
+            cursor = storage.query("SELECT COUNT(*) AS nb_penalties FROM penalties")
+            nb_penalties = int(cursor.getRow()['nb_penalties'])
+            cursor.close()
+            if nb_penalties:
+                raise RuntimeError("the B3 database already has %s penalties, the sync benchmark "
+                                   "needs a database without any" % nb_penalties)
+        self._penaltiesPopulated = True
+        now = int(time.time())
+        for i in range(size):
+            client = b3.clients.Client(console=self.console, guid='sync%032d' % i,
+                                       name='sync%s' % i, ip='10.0.%s.%s' % (i // 256 % 256, i % 256))
+            client.id = storage.setClient(client)
+            if i % 3:
+                penalty = b3.clients.ClientBan()
+                penalty.timeExpire = -1
+            else:
+                penalty = b3.clients.ClientTempBan()
+                penalty.timeExpire = now + 86400
+                penalty.duration = 1440
+            penalty.clientId = client.id
+            penalty.adminId = 0
+            penalty.reason = 'benchmark ban %s' % i
+            penalty.keyword = 'benchmark'
+            penalty.inactive = 0
+            penalty.timeAdd = penalty.timeEdit = now
+            storage.setClientPenalty(penalty)
+
+    def run_bans(self, size):
+        """players banned then unbanned at once. Latency is the time taken
+        by each event, until all of them are delivered to Metabans"""
+        clients = self._newClients('bans%s_%s_' % (size, int(time.time())), size)
+        latencies = []
+        for event_type in (EVT_CLIENT_BAN, EVT_CLIENT_UNBAN):
+            for client in clients:
+                started = time.time()
+                self.plugin.onEvent(Event(event_type, {'reason': 'benchmark', 'keyword': 'bench'}, client))
+                latencies.append(time.time() - started)
+        started = time.time()
+        while len(self.plugin._outbox) and time.time() - started < 300:
+            time.sleep(0.01)
+        return latencies, {'delivery_time': round(time.time() - started, 4),
+                           'compacted': self.plugin._outbox.compacted}
+
+
+if __name__ == '__main__':
+    from getopt import getopt
+    import logging
+    import sys
+
+    output = None
+    opts, args = getopt(sys.argv[1:], 'ho:l:')
+    latency = 0.02
+    for k, v in opts:
+        if k == '-h':
+            print("""
+Usage: python benchmark.py [options] [scenario[:size,...]] ...
+
+Scenarios (and default sizes) :
+%s
+Options :
+ -h : print this help
+ -o : write the JSON results to that file instead of the standard output
+ -l : latency of the fake Metabans service in milliseconds (default 20)
+""" % '\n'.join(" %s : %s" % (k, ', '.join(map(str, v))) for k, v in sorted(SCENARIOS.items())))
+            sys.exit(0)
+        elif k == '-o':
+            output = v
+        elif k == '-l':
+            latency = int(v) / 1000.0
+
+    runs = []
+    for arg in args or sorted(SCENARIOS):
+        scenario, _, sizes = arg.partition(':')
+        if scenario not in SCENARIOS:
+            sys.exit("unknown scenario %r" % scenario)
+        sizes = map(int, sizes.split(',')) if sizes else SCENARIOS[scenario]
+        runs.extend((scenario, size) for size in sizes)
+
+    logging.basicConfig(level=logging.WARNING)
+    benchmark = Benchmark(latency=latency)
+    try:
+        for scenario, size in runs:
+            result = benchmark.run(scenario, size)
+            sys.stderr.write("%(scenario)s %(size)s : %(throughput)s/s, %(duration)ss, "
+                             "p50 %(p50)s, p95 %(p95)s, p99 %(p99)s, %(peak_threads)s threads, "
+                             "+%(rss_increase_kb)s KB RSS\n" % dict(result, **result['latency']))
+    finally:
+        benchmark.close()
+    results = json.dumps({'results': benchmark.results}, indent=2, sort_keys=True)
+    if output:
+        with open(output, 'w') as f:
+            f.write(results)
+    else:
+        print(results)
@@ -0,0 +1,128 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+from collections import namedtuple
+import logging
+import threading
+import time
+'''Local copy of the Metabans assessments of players'''
+
+log = logging.getLogger('pymetabans')
+
+# what we know of the assessment of a player. expires is a timestamp or None
+# if the assessment does not expire
+Assessment = namedtuple('Assessment', 'type expires reason inherited')
+
+
+def assessment_from_status(status):
+    """return the Assessment described by the player status data of a
+    Metabans response, or None if the player has no assessment"""
+    if status.get('is_banned'):
+        assessment_type = 'black'
+    elif status.get('is_whitelisted'):
+        assessment_type = 'white'
+    elif status.get('is_watched'):
+        assessment_type = 'watch'
+    else:
+        return None
+    try:
+        expires = float(status.get('assessment_expires')) or None
+    except (TypeError, ValueError):
+        expires = None
+    return Assessment(assessment_type, expires, status.get('reason'),
+                      status.get('inherited_blacklist') or None)
+
+
+class BlacklistMirror(object):
+    """Assessments of players as last seen in Metabans responses or made by
+    us, kept in memory and in the local store so that they survive restarts.
+
+    Only players having an assessment are kept : a player missing from the
+    mirror is not known to be banned, which is answered with a single dict
+    lookup. Expired assessments are dropped as they are looked up.
+
+         store : a LocalStore
+    """
+    def __init__(self, store):
+        self._store = store
+        self._lock = threading.Lock()
+        self._store.execute("""CREATE TABLE IF NOT EXISTS assessments (
+            player_uid TEXT PRIMARY KEY,
+            type TEXT,
+            expires REAL,
+            reason TEXT,
+            inherited TEXT,
+            time_edit REAL)""")
+        self._store.execute("DELETE FROM assessments WHERE expires IS NOT NULL AND expires < ?",
+                            (time.time(),))
+        self._entries = dict((uid, Assessment(*row)) for uid, row in (
+            (r[0], r[1:]) for r in self._store.execute(
+                "SELECT player_uid, type, expires, reason, inherited FROM assessments")))
+        log.debug("%s assessments loaded", len(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, player_uid):
+        """return the Assessment of the player, or None"""
+        assessment = self._entries.get(player_uid)
+        if assessment is not None and assessment.expires is not None \
+            and assessment.expires < time.time():
+            self.update(player_uid, None)
+            return None
+        return assessment
+
+    def banned(self, player_uid):
+        """return the Assessment of the player if banned, or None"""
+        assessment = self.get(player_uid)
+        if assessment is not None and assessment.type == 'black':
+            return assessment
+        return None
+
+    def refresh(self, player_uid, assessment, pending=None):
+        """set the Assessment of a player as told by Metabans, unless it is
+        unchanged or pending(player_uid) tells that our own assessment of the
+        player has not reached Metabans yet"""
+        if self.get(player_uid) != assessment \
+            and not (pending and pending(player_uid)):
+            self.update(player_uid, assessment)
+
+    def update(self, player_uid, assessment):
+        """set the Assessment of a player, None meaning no assessment"""
+        self.update_many([(player_uid, assessment)])
+
+    def update_many(self, assessments):
+        """set the Assessment of many players from a list of (player_uid,
+        Assessment or None), writing only the changes in a single
+        transaction"""
+        with self._lock:
+            changes = [(uid, assessment) for uid, assessment in assessments
+                       if self._entries.get(uid) != assessment]
+            if not changes:
+                return
+            now = time.time()
+            with self._store.transaction() as cursor:
+                for uid, assessment in changes:
+                    if assessment is None:
+                        cursor.execute("DELETE FROM assessments WHERE player_uid = ?", (uid,))
+                    else:
+                        cursor.execute("INSERT OR REPLACE INTO assessments (player_uid, type, "
+                                       "expires, reason, inherited, time_edit) VALUES (?, ?, ?, ?, ?, ?)",
+                                       (uid,) + tuple(assessment) + (now,))
+            for uid, assessment in changes:
+                if assessment is None:
+                    self._entries.pop(uid, None)
+                else:
+                    self._entries[uid] = assessment
@@ -0,0 +1,103 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+from collections import OrderedDict
+import threading
+import time
+'''Thread-safe in-memory cache of Metabans player statuses'''
+
+
+class StatusCache(object):
+    """LRU cache whose entries expire after a time to live.
+
+                 ttl : time in seconds a player status is kept
+         unknown_ttl : time in seconds we remember that a player is unknown
+                       at Metabans
+            max_size : maximum number of entries, least recently used entries
+                       are evicted first
+    """
+    def __init__(self, ttl=120, unknown_ttl=30, max_size=1000):
+        self.ttl = ttl
+        self.unknown_ttl = unknown_ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._invalidations = OrderedDict()
+        self._invalidation_count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        """whether key has a value that has not expired, without counting a
+        hit or a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[1] >= time.time()
+
+    def get(self, key, default=None):
+        """return the value cached for key if it has not expired"""
+        with self._lock:
+            try:
+                value, expires = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires < time.time():
+                self.misses += 1
+                return default
+            self._entries[key] = (value, expires)
+            self.hits += 1
+            return value
+
+    def generation(self, key):
+        """return the generation of key, to give to put() along with a value
+        fetched afterwards"""
+        with self._lock:
+            return self._invalidations.get(key, 0)
+
+    def put(self, key, value, ttl=None, generation=None):
+        """cache value for key. If generation is given, value is dropped if
+        key was invalidated since that generation"""
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            if generation is not None and generation != self._invalidations.get(key, 0):
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time() + ttl)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def put_unknown(self, key, value, generation=None):
+        """cache value for the shorter time to live used for unknown players"""
+        self.put(key, value, self.unknown_ttl, generation)
+
+    def invalidate(self, key):
+        """drop the value of key, along with the values being fetched for key
+        which are put afterwards"""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._invalidation_count += 1
+            self._invalidations.pop(key, None)
+            self._invalidations[key] = self._invalidation_count
+            while len(self._invalidations) > self.max_size:
+                self._invalidations.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
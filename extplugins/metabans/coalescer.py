@@ -0,0 +1,208 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+from pymetabans import MetabansException
+from tracing import add_span
+from workers import PRIORITIES, PRIORITY_ENFORCEMENT, PRIORITY_SIGHTING
+import logging
+import socket
+import threading
+import time
+'''Merge the Metabans requests made by concurrent threads into multi-request
+calls'''
+
+log = logging.getLogger('pymetabans')
+
+
+class _PendingRequest(object):
+    def __init__(self, request, priority):
+        self.request = request
+        self.priority = priority
+        self.time = time.time()
+        self.sent = None
+        self.received = None
+        self.result = None
+        self.exception = None
+        self.done = threading.Event()
+
+
+class RequestCoalescer(object):
+    """Collect the requests submitted by any thread during a time window and
+    send them to Metabans in one single call.
+
+    A batch is sent `window` seconds after its first request was submitted, or
+    as soon as it holds `max_batch` requests. Each caller then gets its own
+    result back. Up to `concurrency` batches are sent at once, so that a slow
+    call does not hold up the batches behind it.
+
+    Batches are filled with the highest priority requests first, so that a
+    backlog of sightings does not delay the requests that can lead to a kick.
+    Those PRIORITY_ENFORCEMENT requests also have a sender of their own, which
+    never waits behind the batches of the other senders.
+
+    When a BatchSizer is given as `sizer`, it decides the batch size instead 
+    of `max_batch`.
+
+    A caller waits at most `timeout` seconds for its result, or forever if
+    None, then gets socket.timeout.
+    """
+    def __init__(self, metabans, window=0.1, max_batch=50, sizer=None, timeout=None,
+                 concurrency=4):
+        self._metabans = metabans
+        self.window = window
+        self.max_batch = max_batch
+        self.sizer = sizer
+        self.timeout = timeout
+        self.concurrency = max(1, concurrency)
+        self._lanes = dict((priority, []) for priority in PRIORITIES)
+        self._cond = threading.Condition()
+        self._threads = []
+        self._collecting = 0
+        self._enforcer = None
+        self._closed = False
+
+    def submit(self, request, priority=PRIORITY_SIGHTING):
+        """send request (a dict of request parameters) with the next batch.
+
+        Wait for the batch response and return the 'data' of the response to
+        that request or raise its MetabansException
+        """
+        item = _PendingRequest(request, priority)
+        with self._cond:
+            self._lanes[priority].append(item)
+            if priority == PRIORITY_ENFORCEMENT and self._enforcer is None:
+                self._enforcer = self._startSender((PRIORITY_ENFORCEMENT,), 'metabans-coalescer-enforcement')
+            if not self._collecting and len(self._threads) < self.concurrency:
+                # every sender is busy sending a batch
+                self._threads.append(self._startSender(PRIORITIES, 'metabans-coalescer'))
+            self._cond.notifyAll()
+        item.done.wait(self.timeout)
+        if not item.done.isSet():
+            with self._cond:
+                if item in self._lanes[priority]:
+                    # not sent yet, nobody would read the result
+                    self._lanes[priority].remove(item)
+            raise socket.timeout("no response from Metabans after %ss" % self.timeout)
+        if item.sent is not None:
+            add_span('coalescing', item.time, item.sent)
+            add_span('network', item.sent, item.received)
+        if item.exception:
+            raise item.exception
+        return item.result
+
+    @property
+    def pending(self):
+        """number of requests waiting for the next batch"""
+        return sum(len(lane) for lane in self._lanes.itervalues())
+
+    @property
+    def batch_size(self):
+        """maximum number of requests in the next batch"""
+        if self.sizer:
+            return self.sizer.size
+        return self.max_batch
+
+    def close(self):
+        """stop the threads sending the batches once the pending requests are
+        sent. A request submitted afterwards starts them again"""
+        with self._cond:
+            self._closed = True
+            self._cond.notifyAll()
+
+    def _startSender(self, priorities, name):
+        thread = threading.Thread(target=self._run, args=(priorities,), name=name)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+    def _run(self, priorities):
+        while True:
+            batch = self._next_batch(priorities)
+            if batch is None:
+                return
+            self._send(batch)
+
+    def _next_batch(self, priorities=PRIORITIES):
+        """return the next batch of requests of the given priorities to send,
+        or None once closed"""
+        lanes = [self._lanes[priority] for priority in priorities]
+        pending = lambda: sum(len(lane) for lane in lanes)
+        general = priorities == PRIORITIES
+        with self._cond:
+            if general:
+                self._collecting += 1
+            try:
+                while True:
+                    if not pending():
+                        if self._closed:
+                            self._exit()
+                            return None
+                        self._cond.wait()
+                        continue
+                    deadline = min(lane[0].time for lane in lanes if lane) + self.window
+                    batch_size = self.batch_size
+                    while 0 < pending() < batch_size:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                    if not pending():
+                        # taken by another sender meanwhile
+                        continue
+                    batch = []
+                    for lane in lanes:
+                        room = batch_size - len(batch)
+                        batch.extend(lane[:room])
+                        del lane[:room]
+                    return batch
+            finally:
+                if general:
+                    self._collecting -= 1
+
+    def _exit(self):
+        thread = threading.currentThread()
+        if thread in self._threads:
+            self._threads.remove(thread)
+        elif thread is self._enforcer:
+            self._enforcer = None
+
+    def _send(self, batch):
+        log.debug("sending a batch of %s requests", len(batch))
+        requests = self._metabans.batch()
+        for item in batch:
+            requests.add(item.request)
+        started = time.time()
+        try:
+            results = requests.send()
+        except Exception, err:
+            if self.sizer:
+                self.sizer.failed()
+            received = time.time()
+            for item in batch:
+                item.sent, item.received = started, received
+                item.exception = err
+                item.done.set()
+            return
+        received = time.time()
+        if self.sizer:
+            self.sizer.record(len(batch), received - started, 
+                              [r.fetch_time for r in results])
+        for item, result in zip(batch, results):
+            item.sent, item.received = started, received
+            try:
+                item.result = result.get()
+            except MetabansException, err:
+                item.exception = err
+            item.done.set()
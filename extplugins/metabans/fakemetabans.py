@@ -0,0 +1,385 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+from hashlib import sha1
+from pymetabans import STREAM_CHUNK_SIZE, Transport, gzip_compress
+import BaseHTTPServer
+import SocketServer
+import logging
+import random
+import re
+import socket
+import threading
+import time
+import urllib2
+import urlparse
+import zlib
+'''Local stand-in for the Metabans service, to try pymetabans and the plugin
+without reaching metabans.com'''
+
+try:
+    # Python >= 2.6
+    import json
+except ImportError:
+    # Python < 2.6
+    import simplejson as json
+
+log = logging.getLogger('pymetabans')
+
+# error codes of the Metabans API
+ERROR_UNKNOWN_ACTION = 1
+ERROR_MISSING_PARAMETER = 2
+ERROR_AUTHENTICATION = 5
+ERROR_UNKNOWN_PLAYER = 9
+
+ASSESSMENT_TYPES = ('none', 'watch', 'white', 'black')
+
+
+class FakeMetabansError(Exception):
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+        self.message = message
+
+
+class FakeMetabans(object):
+    """In-memory implementation of the Metabans actions used by pymetabans.
+
+    The players seen and their assessments are kept in memory. Slow or 
+    failing calls can be simulated.
+
+               accounts : dict of username -> api key accepted. If None, any
+                          credentials are accepted
+                latency : time in seconds each call takes
+    latency_per_request : time in seconds added for each request of a call
+                 jitter : maximum random time in seconds added to a call
+             error_rate : probability that a call fails with HTTP 503
+        disconnect_rate : probability that the connection is lost during a 
+                          call
+                   seed : seed of the random failures and jitter
+
+    failing_calls can also be set to make that many next calls fail with
+    HTTP 503.
+    """
+    def __init__(self, accounts=None, latency=0.0, latency_per_request=0.0,
+                 jitter=0.0, error_rate=0.0, disconnect_rate=0.0, seed=None):
+        self.accounts = accounts
+        self.latency = latency
+        self.latency_per_request = latency_per_request
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.disconnect_rate = disconnect_rate
+        self.failing_calls = 0
+        self.calls = 0
+        self.requests = 0
+        self.players = {}
+        self.assessments = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def call(self, body):
+        """answer the url-encoded body of a call. 
+        
+        Return a (HTTP status, payload) tuple or raise socket.error when the
+        connection is to be lost"""
+        parameters = urlparse.parse_qs(body, keep_blank_values=True)
+        get = lambda name: parameters.get(name, [None])[-1]
+        requests = decode_requests(parameters)
+        with self._lock:
+            self.calls += 1
+            self.requests += len(requests)
+            delay = self.latency + self.latency_per_request * len(requests) \
+                + self._random.uniform(0, self.jitter)
+            failure = self._random.random()
+            forced = self.failing_calls > 0
+            if forced:
+                self.failing_calls -= 1
+        if delay > 0:
+            time.sleep(delay)
+        if not forced and failure < self.disconnect_rate:
+            raise socket.error("simulated connection loss")
+        if forced or failure < self.disconnect_rate + self.error_rate:
+            return 503, "Service Unavailable"
+        responses = self.handle(requests, get('username'), get('apikey'), get('salt'))
+        options = (get('options') or '').split(',')
+        for request, response in zip(requests, responses):
+            if 'mirror' in options:
+                response['request'] = request
+            if 'profiler' not in options:
+                del response['fetch_time']
+        return 200, json.dumps({'responses': responses})
+
+    def handle(self, requests, username=None, apikey=None, salt=None):
+        """return the raw responses to a list of requests (dicts of request
+        parameters)"""
+        if self.accounts is not None:
+            expected = self.accounts.get(username)
+            if expected is None or sha1("%s%s" % (salt, expected)).hexdigest() != apikey:
+                error = {'code': ERROR_AUTHENTICATION, 'message': 'invalid credentials'}
+                return [{'status': 'ERROR', 'error': error} for request in requests]
+        return [self.handle_request(request) for request in requests]
+
+    def handle_request(self, request):
+        started = time.time()
+        handler = getattr(self, '_do_%s' % request.get('action'), None)
+        try:
+            if handler is None:
+                raise FakeMetabansError(ERROR_UNKNOWN_ACTION, "unknown action %r" % request.get('action'))
+            with self._lock:
+                response = {'status': 'OK', 'data': handler(request)}
+        except FakeMetabansError, err:
+            response = {'status': 'ERROR', 'error': {'code': err.code, 'message': err.message}}
+        response['fetch_time'] = '%0.4f s' % (time.time() - started)
+        return response
+
+    def _param(self, request, name):
+        try:
+            return request[name]
+        except KeyError:
+            raise FakeMetabansError(ERROR_MISSING_PARAMETER, "missing parameter %r" % name)
+
+    def _status(self, key):
+        if key not in self.players:
+            raise FakeMetabansError(ERROR_UNKNOWN_PLAYER, "unknown player %r" % (key[1],))
+        assessment_type, expires, reason = self.assessments.get(key, ('none', None, None))
+        if expires is not None and expires < time.time():
+            del self.assessments[key]
+            assessment_type, expires, reason = 'none', None, None
+        return {
+            'game_name': key[0],
+            'player_uid': key[1],
+            'player_name': self.players[key]['player_name'],
+            'is_banned': assessment_type == 'black',
+            'is_blacklisted': assessment_type == 'black',
+            'is_whitelisted': assessment_type == 'white',
+            'is_watched': assessment_type == 'watch',
+            'inherited_blacklist': None,
+            'assessment_expires': expires,
+            'reason': reason,
+        }
+
+    def _do_mbo_player_status(self, request):
+        return self._status((self._param(request, 'game_name'), self._param(request, 'player_uid')))
+
+    def _do_mb_sight_player(self, request):
+        key = (self._param(request, 'game_name'), self._param(request, 'player_uid'))
+        self.players[key] = {
+            'player_name': self._param(request, 'player_name'),
+            'player_ip': request.get('player_ip'),
+            'alternate_uid': request.get('alternate_uid'),
+            'group_name': request.get('group_name'),
+            'last_seen': time.time(),
+        }
+        return self._status(key)
+
+    def _do_mb_assess_player(self, request):
+        key = (self._param(request, 'game_name'), self._param(request, 'player_uid'))
+        assessment_type = self._param(request, 'assessment_type')
+        if assessment_type not in ASSESSMENT_TYPES:
+            raise FakeMetabansError(ERROR_MISSING_PARAMETER, "invalid assessment_type %r" % assessment_type)
+        if key not in self.players:
+            raise FakeMetabansError(ERROR_UNKNOWN_PLAYER, "unknown player %r" % (key[1],))
+        length = request.get('assessment_length')
+        if assessment_type == 'none' or (length is not None and int(length) <= 0):
+            self.assessments.pop(key, None)
+        else:
+            expires = time.time() + int(length) if length is not None else None
+            self.assessments[key] = (assessment_type, expires, request.get('reason'))
+        return self._status(key)
+
+    def _do_mbo_availability_account_name(self, request):
+        name = self._param(request, 'account_name')
+        return {'account_name': name, 'is_available': name not in (self.accounts or {})}
+
+
+_reRequestParameter = re.compile(r'^requests\[(\d+)\]\[(\w+)\]$')
+
+def decode_requests(query_parameters):
+    """turn the requests[N][...] parameters of a call back into a list of
+    requests"""
+    requests = {}
+    for name, values in query_parameters.iteritems():
+        match = _reRequestParameter.match(name)
+        if match:
+            requests.setdefault(int(match.group(1)), {})[match.group(2)] = values[-1].decode('utf-8')
+    return [requests[i] for i in sorted(requests)]
+
+
+class FakeMetabansHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        log.debug("fake Metabans : " + format, *args)
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        server.throttle(len(body))
+        encoding = self.headers.get('Content-Encoding', 'identity').lower()
+        if encoding != 'identity':
+            if not server.compression or encoding != 'gzip':
+                self._reply(server.rejection_status, "unsupported content encoding %r" % encoding)
+                return
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        with server.lock:
+            server.calls += 1
+            server.bytes_received += int(self.headers.get('Content-Length', 0))
+        try:
+            status, payload = server.metabans.call(body)
+        except socket.error:
+            self.close_connection = 1
+            return
+        self._reply(status, payload)
+
+    def _reply(self, status, payload):
+        server = self.server
+        headers = {'Content-Type': 'application/json'}
+        accepted = [x.split(';')[0].strip().lower()
+                    for x in self.headers.get('Accept-Encoding', '').split(',')]
+        if server.compression and 'gzip' in accepted:
+            payload = gzip_compress(payload)
+            headers['Content-Encoding'] = 'gzip'
+        elif server.compression and 'deflate' in accepted:
+            payload = zlib.compress(payload)
+            headers['Content-Encoding'] = 'deflate'
+        headers['Content-Length'] = str(len(payload))
+        server.throttle(len(payload))
+        self.send_response(status)
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+        self.end_headers()
+        with server.lock:
+            server.bytes_sent += len(payload)
+        self.wfile.write(payload)
+
+
+class FakeMetabansServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP server answering like the Metabans API, on 127.0.0.1
+
+          metabans : the FakeMetabans to query, a new one by default
+       compression : if False, responses are never compressed and compressed
+                     requests are rejected with the HTTP status
+                     rejection_status
+         bandwidth : bytes per second the link to the server is limited to,
+                     None for no limit
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, metabans=None, compression=True, bandwidth=None,
+                 rejection_status=415):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), FakeMetabansHandler)
+        self.metabans = metabans or FakeMetabans()
+        self.compression = compression
+        self.rejection_status = rejection_status
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s/api' % self.server_address[1]
+
+    def handle_error(self, request, client_address):
+        # clients giving up on a slow call close their connection
+        log.debug("fake Metabans : error with %s", client_address, exc_info=True)
+
+    def throttle(self, size):
+        if self.bandwidth:
+            time.sleep(float(size) / self.bandwidth)
+
+    def start(self):
+        """serve requests from a background thread"""
+        thread = threading.Thread(target=self.serve_forever, name='fake-metabans')
+        thread.setDaemon(True)
+        thread.start()
+        return self
+
+
+class FakeTransport(Transport):
+    """Transport handing calls to a FakeMetabans in the same process
+
+          metabans : the FakeMetabans to query, a new one by default
+    """
+    def __init__(self, metabans=None, url='http://fake.metabans/api'):
+        self.metabans = metabans or FakeMetabans()
+        self.url = url
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+    def post_stream(self, body, headers, wire=None, chunk_size=STREAM_CHUNK_SIZE):
+        self.bytes_received += len(body)
+        if headers.get('Content-Encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        status, payload = self.metabans.call(body)
+        if status != 200:
+            raise urllib2.HTTPError(self.url, status, payload, None, None)
+        self.bytes_sent += len(payload)
+        for i in xrange(0, len(payload), chunk_size):
+            chunk = payload[i:i + chunk_size]
+            if wire is not None:
+                wire['received'] += len(chunk)
+            yield chunk
+
+
+if __name__ == '__main__':
+    from getopt import getopt
+    from pymetabans import Metabans, Player
+    import sys
+
+    calls = 20
+    players_per_call = 200
+    bandwidth = None
+    opts, args = getopt(sys.argv[1:], 'hn:p:b:')
+    for k, v in opts:
+        if k == '-h':
+            print("""
+Measure the bandwidth and time saved by compression against a local stand-in
+for the Metabans service.
+
+Usage:
+ -h : print this help
+ -n : number of calls (default %s)
+ -p : number of players sighted per call (default %s)
+ -b : bandwidth of the link in kilobytes per second (default : no limit)
+""" % (calls, players_per_call))
+            sys.exit(0)
+        elif k == '-n':
+            calls = int(v)
+        elif k == '-p':
+            players_per_call = int(v)
+        elif k == '-b':
+            bandwidth = int(v) * 1024
+
+    for compression in (False, True):
+        server = FakeMetabansServer(compression=compression, bandwidth=bandwidth).start()
+        metabans = Metabans('test', 'key', url=server.url, compress_requests=compression)
+        started = time.time()
+        for i in range(calls):
+            batch = metabans.batch()
+            for j in range(players_per_call):
+                uid = 'EA_%032d' % (i * players_per_call + j)
+                batch.sight('BF_3', Player(uid, 'player %s' % j, '10.0.%s.%s' % (i % 256, j % 256)),
+                            group_name='server #1')
+            batch.send()
+        elapsed = time.time() - started
+        print("compression %-3s : %6s bytes sent, %6s bytes received, %0.3fs" % (
+              'on' if compression else 'off', server.bytes_received,
+              server.bytes_sent, elapsed))
+        metabans.close()
+        server.shutdown()
+        server.server_close()
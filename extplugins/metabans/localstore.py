@@ -0,0 +1,66 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+from contextlib import contextmanager
+import sqlite3
+import threading
+'''SQLite database holding the plugin own data'''
+
+
+class LocalStore(object):
+    """Thread-safe access to a SQLite database file"""
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.text_factory = str
+        self.execute("""CREATE TABLE IF NOT EXISTS plugin_values (
+            name TEXT PRIMARY KEY,
+            value TEXT)""")
+
+    def execute(self, sql, parameters=()):
+        """run a single statement, commit and return the resulting rows"""
+        with self.transaction() as cursor:
+            cursor.execute(sql, parameters)
+            return cursor.fetchall()
+
+    def get_value(self, name, default=None):
+        """return a value saved with set_value()"""
+        rows = self.execute("SELECT value FROM plugin_values WHERE name = ?", (name,))
+        if rows:
+            return rows[0][0]
+        return default
+
+    def set_value(self, name, value):
+        self.execute("INSERT OR REPLACE INTO plugin_values (name, value) VALUES (?, ?)",
+                     (name, value))
+
+    @contextmanager
+    def transaction(self):
+        """give a cursor to run many statements in a single transaction"""
+        with self._lock:
+            cursor = self._conn.cursor()
+            try:
+                yield cursor
+                self._conn.commit()
+            except:
+                self._conn.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
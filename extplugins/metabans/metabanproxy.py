@@ -13,8 +13,17 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 #
-from pymetabans import Metabans, Player
+from cache import StatusCache
+from coalescer import RequestCoalescer
+from metrics import Metrics
+from singleflight import SingleFlight
+from tracing import span
+from workers import PRIORITY_ENFORCEMENT, PRIORITY_SIGHTING
+from pymetabans import Metabans, MetabansError, MetabansException, Player, \
+    assess_player_request, player_status_request, sight_player_request
+import Queue
 import re
+import threading
 import time
 '''Class that makes it easy to make calls to Metabans.com API from B3'''
 
@@ -24,9 +33,72 @@ class MetabansProxy(object):
     _reColor = re.compile(r'(\^[0-9])')
     group_name = None
     
-    def __init__(self, game_name, user_agent='pymetabans'):
+    def __init__(self, game_name, user_agent='pymetabans', keep_alive=True,
+                 pool_size=4, pool_idle_timeout=30, coalesce_window=0.1, 
+                 coalesce_max_batch=50, cache_ttl=120, cache_unknown_ttl=30,
+                 cache_size=1000, coalesce_sizer=None, compress_requests=False,
+                 transport=None, metrics=None, timeout=30):
+        """
+          coalesce_window : time in seconds during which sight and check
+                            requests are gathered to be sent in a single call.
+                            0 sends each request on its own
+           coalesce_sizer : a BatchSizer adapting the size of those calls
+                cache_ttl : time in seconds player statuses are cached. 
+                            0 disables the cache
+        cache_unknown_ttl : time in seconds we remember a player is unknown
+                            at Metabans
+               cache_size : maximum number of players in the cache
+        compress_requests : if True, big requests are sent gzipped
+                transport : the pymetabans.Transport calls go through, see
+                            pymetabans.Metabans
+                  metrics : the metrics.Metrics calls are recorded to, a new
+                            one by default
+                  timeout : time in seconds after which a call Metabans does
+                            not answer fails with socket.timeout
+        """
         self._game_name = self._getMetabansGameName(game_name)
-        self._metabans = Metabans(user_agent=user_agent)
+        self._single_flight = SingleFlight()
+        self.metrics = metrics if metrics is not None else Metrics()
+        self._metabans = Metabans(user_agent=user_agent, keep_alive=keep_alive,
+                                  pool_size=pool_size,
+                                  pool_idle_timeout=pool_idle_timeout,
+                                  compress_requests=compress_requests,
+                                  transport=transport, metrics=self.metrics,
+                                  timeout=timeout)
+        if coalesce_window > 0:
+            self._coalescer = RequestCoalescer(self._metabans, 
+                                               window=coalesce_window,
+                                               max_batch=coalesce_max_batch,
+                                               sizer=coalesce_sizer,
+                                               timeout=coalesce_window + timeout,
+                                               concurrency=pool_size)
+        else:
+            self._coalescer = None
+        if cache_ttl > 0:
+            self._cache = StatusCache(ttl=cache_ttl, unknown_ttl=cache_unknown_ttl,
+                                      max_size=cache_size)
+            self._sightings = StatusCache(ttl=cache_ttl, max_size=cache_size)
+        else:
+            self._cache = self._sightings = None
+        self._addGauges()
+
+    def _addGauges(self):
+        self.metrics.add_gauge('single_flight_in_flight', lambda: self._single_flight.in_flight,
+                               "player checks and sightings being sent")
+        self.metrics.add_gauge('single_flight_shared', lambda: self._single_flight.shared,
+                               "player checks and sightings answered by an identical call in flight")
+        if self._coalescer is not None:
+            self.metrics.add_gauge('coalescer_pending', lambda: self._coalescer.pending,
+                                   "requests waiting to be sent in the next coalesced call")
+            self.metrics.add_gauge('coalescer_batch_size', lambda: self._coalescer.batch_size,
+                                   "maximum number of requests of the next coalesced call")
+        if self._cache is not None:
+            self.metrics.add_gauge('cache_entries', lambda: len(self._cache),
+                                   "player statuses in the cache")
+            self.metrics.add_gauge('cache_hits', lambda: self._cache.hits,
+                                   "player statuses found in the cache")
+            self.metrics.add_gauge('cache_misses', lambda: self._cache.misses,
+                                   "player statuses not found in the cache")
         
     
     @property
@@ -68,80 +140,313 @@ class MetabansProxy(object):
     def _stripColors(self, text):
         return re.sub(self._reColor, '', text).strip()
     
-    def sight(self, client):
+    def sight(self, client, priority=PRIORITY_SIGHTING):
+        """tell Metabans we have seen the client and return its status.
+        A sighting repeating the data of a recent one is answered from the
+        cache"""
         if client:
-            metabans_player = Player(client.guid, client.name, client.ip, client.pbid)
-            return self._metabans.mb_sight_player(self._game_name, 
-                                                  metabans_player,
-                                                  self.group_name)
-    def check(self, client):
+            key = (self._game_name, client.guid)
+            sighting = (client.name, client.ip, client.pbid)
+            if self._cache is not None and self._sightings.get(key) == sighting:
+                response = self._cache.get(key)
+                if response is not None and not isinstance(response, MetabansException):
+                    return response
+            return self._single_flight.do(('mb_sight_player', client.guid) + sighting,
+                                          self._sight, client, priority)
+
+    def _sight(self, client, priority):
+        key = (self._game_name, client.guid)
+        generation = self._cache.generation(key) if self._cache is not None else None
+        metabans_player = Player(client.guid, client.name, client.ip, client.pbid)
+        if self._coalescer:
+            response = self._coalescer.submit(sight_player_request(self._game_name, 
+                                                                   metabans_player,
+                                                                   self.group_name),
+                                              priority)
+        else:
+            with span('network'):
+                response = self._metabans.mb_sight_player(self._game_name, 
+                                                          metabans_player,
+                                                          self.group_name)
+        if self._cache is not None:
+            self._sightings.put(key, (client.name, client.ip, client.pbid))
+            self._cache.put(key, response, generation=generation)
+        return response
+
+    def check(self, client, priority=PRIORITY_ENFORCEMENT):
+        """return the client status, from the cache if still fresh"""
         if client:
-            return self._metabans.mbo_player_status(self._game_name, client.guid)
+            if self._cache is not None:
+                response = self._cache.get((self._game_name, client.guid))
+                if isinstance(response, MetabansException):
+                    raise response
+                elif response is not None:
+                    return response
+            return self._single_flight.do(('mbo_player_status', client.guid), 
+                                          self._check, client, priority)
+
+    def _check(self, client, priority):
+        key = (self._game_name, client.guid)
+        # the player may be assessed while the status is on its way
+        generation = self._cache.generation(key) if self._cache is not None else None
+        try:
+            if self._coalescer:
+                response = self._coalescer.submit(player_status_request(self._game_name, 
+                                                                        client.guid),
+                                                  priority)
+            else:
+                with span('network'):
+                    response = self._metabans.mbo_player_status(self._game_name, client.guid)
+        except MetabansError, err:
+            if err.code == 9 and self._cache is not None:
+                self._cache.put_unknown(key, err, generation)
+            raise
+        if self._cache is not None:
+            self._cache.put(key, response, generation=generation)
+        return response
+
+    def sight_many(self, clients, sizer=None):
+        """tell Metabans we have seen all those clients, in a single call.
+        
+        Return a list of (client, status) in the order of clients, status 
+        being the player status or the MetabansException Metabans replied
+        with for that client"""
+        statuses = self._send_many(clients, [self.sighting_request(c) for c in clients], sizer)
+        if self._cache is not None:
+            for client, status in statuses:
+                if not isinstance(status, MetabansException):
+                    self._sightings.put((self._game_name, client.guid), 
+                                        (client.name, client.ip, client.pbid))
+        return statuses
+
+    def check_many(self, clients, sizer=None):
+        """get the status of all those clients from Metabans, in a single 
+        call, bypassing the cache.
+        
+        Return a list of (client, status) like sight_many()"""
+        return self._send_many(clients, [player_status_request(self._game_name, c.guid) 
+                                         for c in clients], sizer)
+
+    def _send_many(self, clients, requests, sizer=None):
+        batch = self._metabans.batch()
+        for request in requests:
+            batch.add(request)
+        if self._cache is not None:
+            generations = [self._cache.generation((self._game_name, c.guid)) for c in clients]
+        started = time.time()
+        try:
+            results = batch.send()
+        except Exception:
+            if sizer:
+                sizer.failed()
+            raise
+        if sizer:
+            sizer.record(len(requests), time.time() - started, [r.fetch_time for r in results])
+        statuses = []
+        for i, (client, result) in enumerate(zip(clients, results)):
+            if self._cache is not None:
+                key = (self._game_name, client.guid)
+                if result.ok:
+                    self._cache.put(key, result.data, generation=generations[i])
+                elif isinstance(result.error, MetabansError) and result.error.code == 9:
+                    self._cache.put_unknown(key, result.error, generations[i])
+            statuses.append((client, result.data if result.ok else result.error))
+        return statuses
+
+    def is_fresh(self, client):
+        """whether the cache holds a status of the client that has not 
+        expired"""
+        return self._cache is not None and (self._game_name, client.guid) in self._cache
+
+    @property
+    def cache(self):
+        """the player status cache or None if caching is disabled"""
+        return self._cache
 
+    @property
+    def metabans(self):
+        """the underlying pymetabans.Metabans instance"""
+        return self._metabans
+
+    def close(self):
+        """stop the coalescer thread and close the idle connections"""
+        if self._coalescer is not None:
+            self._coalescer.close()
+        self._metabans.close()
+
+    def forget(self, player_uid):
+        """invalidate what we know about a player after changing its 
+        assessment"""
+        if self._cache is not None:
+            self._cache.invalidate((self._game_name, player_uid))
 
+    def _forget(self, client):
+        self.forget(client.guid)
+
+    def sighting_request(self, client):
+        """build a mb_sight_player request for the client"""
+        return sight_player_request(self._game_name, 
+                                    Player(client.guid, client.name, client.ip, client.pbid),
+                                    self.group_name)
+
+    def assessment_request(self, client, assessment_type, duration=None, reason=None):
+        """build a mb_assess_player request for the client
+        duration is in second"""
+        if reason:
+            reason = self._stripColors(reason)
+        return assess_player_request(self._game_name, client.guid, assessment_type,
+                                     duration, reason)
 
     def clear(self, client, reason=None):
         """remove any assessment on the client"""
         if client:
-            return self._metabans.mb_assess_player(game_name=self._game_name,
-                                                   player_uid=client.guid, 
-                                                   assessment_type='none',
-                                                   reason=self._stripColors(reason))
+            return self._assess(client, 'none', reason=reason)
 
     def watch(self, client, duration=None, reason=None):
         """set the 'watch' assessment on the client
         duration is in second"""
         if client:
-            return self._metabans.mb_assess_player(game_name=self._game_name,
-                                                   player_uid=client.guid, 
-                                                   assessment_type='watch',
-                                                   assessment_length=duration,
-                                                   reason=self._stripColors(reason))
+            return self._assess(client, 'watch', duration, reason)
 
     def ban(self, client, duration=None, reason=None):
         """set the 'black' assessment on the client
         duration is in second"""
         if client:
-            return self._metabans.mb_assess_player(game_name=self._game_name,
-                                                   player_uid=client.guid, 
-                                                   assessment_type='black',
-                                                   assessment_length=duration,
-                                                   reason=self._stripColors(reason))
+            return self._assess(client, 'black', duration, reason)
 
     def protect(self, client, duration=None, reason=None):
         """set the 'white' assessment on the client
         duration is in second"""
         if client:
+            return self._assess(client, 'white', duration, reason)
+
+    def _assess(self, client, assessment_type, duration=None, reason=None):
+        # forgotten before and after, in case a status fetched in between
+        # was cached
+        self._forget(client)
+        try:
             return self._metabans.mb_assess_player(game_name=self._game_name,
                                                    player_uid=client.guid, 
-                                                   assessment_type='white',
+                                                   assessment_type=assessment_type,
                                                    assessment_length=duration,
                                                    reason=self._stripColors(reason))
+        finally:
+            self._forget(client)
 
 
-    def send_bulk_queries(self, queries):
-        """send a bunch of queries in one single call to the metabans API"""
-        nb_queries = 0
-        query_parameters = {}
+    def send_bulk_queries(self, queries, sizer=None):
+        """send a bunch of queries in one single call to the metabans API.
+        
+        Return the MetabansResult of the successful queries, those of the 
+        failed ones and the times in ms Metabans took for each kind of query.
+        The outcome of the call is recorded into sizer if a BatchSizer is given
+        """
+        batch = self._metabans.batch()
         for query in queries:
-            for k, v in query.iteritems():
-                query_parameters['requests[%d][%s]' % (nb_queries, k)] = v
-            nb_queries += 1
-        responses = self._metabans._query(query_parameters)
+            batch.add(query)
         errors = []
         success = []
         fetch_times = {}
-        for r in responses:
-            if 'status' in r and r['status'] == 'OK':
-                success.append(r)
-                key = r['request']['action']
-            else:
-                errors.append(r)
-                key = r['request']['action'] + '_error_%s' % r['error']['code']
-            if not key in fetch_times:
-                fetch_times[key] = []
-            fetch_times[key].append(float(r['fetch_time'].rstrip(' s')) * 1000)
+        started = time.time()
+        try:
+            # responses are decoded one by one as they arrive
+            for r in batch.iter_send():
+                if r.ok:
+                    success.append(r)
+                    key = r.action
+                else:
+                    errors.append(r)
+                    key = r.action + '_error_%s' % r.error.code
+                if not key in fetch_times:
+                    fetch_times[key] = []
+                fetch_times[key].append(r.fetch_time * 1000)
+        except Exception:
+            if sizer:
+                sizer.failed()
+            raise
+        if sizer:
+            sizer.record(len(queries), time.time() - started, 
+                         [r.fetch_time for r in success + errors])
         return (success, errors, fetch_times)
+
+    def send_bulk_pipeline(self, batches, concurrency=4, on_batch_done=None, 
+                           sizer=None):
+        """send batches of queries with up to `concurrency` calls to the 
+        metabans API in flight at once.
+        
+                batches : an iterable of lists of queries, consumed only as
+                          calls can be made
+          on_batch_done : called with the index of a batch and its 
+                          (success, errors, fetch_times) result as each batch
+                          completes. Called from the thread calling this method
+                  sizer : a BatchSizer recording the outcome of each call
+        
+        A batch assessing a player is not sent while an earlier batch assessing
+        the same player is in flight, so that assessments are applied in order.
+        
+        Return the (success, errors, fetch_times) of all the batches. If a call
+        fails, no further batch is sent and its exception is raised once the
+        calls in flight are over.
+        """
+        todo = Queue.Queue()
+        done = Queue.Queue()
+        in_flight = {}
+        all_success = []
+        all_errors = []
+        all_fetch_times = {}
+        failures = []
+
+        def worker():
+            while True:
+                item = todo.get()
+                if item is None:
+                    return
+                index, queries = item
+                try:
+                    done.put((index, self.send_bulk_queries(queries, sizer), None))
+                except Exception, err:
+                    done.put((index, None, err))
+
+        def collect(block):
+            index, result, err = done.get(block)
+            del in_flight[index]
+            if err is not None:
+                failures.append(err)
+                return
+            success, errors, fetch_times = result
+            all_success.extend(success)
+            all_errors.extend(errors)
+            for k, v in fetch_times.iteritems():
+                all_fetch_times.setdefault(k, []).extend(v)
+            if on_batch_done:
+                on_batch_done(index, result)
+
+        threads = []
+        for i in range(concurrency):
+            t = threading.Thread(target=worker, name='metabans-bulk-%s' % i)
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+        try:
+            for index, queries in enumerate(batches):
+                players = set(q['player_uid'] for q in queries if q['action'] == 'mb_assess_player')
+                while not failures and (len(in_flight) >= concurrency 
+                        or any(players & other for other in in_flight.itervalues())):
+                    collect(True)
+                if failures:
+                    break
+                in_flight[index] = players
+                todo.put((index, queries))
+                while not done.empty():
+                    collect(False)
+        finally:
+            for t in threads:
+                todo.put(None)
+            while in_flight:
+                collect(True)
+        if failures:
+            raise failures[0]
+        return (all_success, all_errors, all_fetch_times)
     
 if __name__ == '__main__':
     import logging
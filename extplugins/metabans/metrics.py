@@ -0,0 +1,242 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+from bisect import bisect_left
+import BaseHTTPServer
+import logging
+import socket
+import threading
+import urllib2
+'''Counters and latency histograms of the calls made to Metabans, and a HTTP
+endpoint exposing them in the Prometheus text format'''
+
+log = logging.getLogger('pymetabans')
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# upper bounds of the batch size histogram buckets
+BATCH_SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Histogram(object):
+    """Streaming histogram counting observed values in fixed buckets, so that
+    its memory use does not grow with the number of observations"""
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def copy(self):
+        histogram = Histogram(self.buckets)
+        histogram.counts = list(self.counts)
+        histogram.count = self.count
+        histogram.sum = self.sum
+        return histogram
+
+    def percentile(self, p):
+        """upper bound of the bucket holding the p-th percentile, None if
+        nothing was observed. Values above the last bucket give infinity"""
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+def _error_code(error):
+    """short label of the exception a call failed with"""
+    if isinstance(error, urllib2.HTTPError):
+        return 'http_%s' % error.code
+    elif isinstance(error, socket.timeout):
+        return 'timeout'
+    elif isinstance(error, (socket.error, urllib2.URLError)):
+        return 'connection'
+    else:
+        return error.__class__.__name__
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', r'\\').replace('"', r'\"'))
+                             for k, v in sorted(labels))
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics(object):
+    """Thread-safe store of everything measured about the calls to Metabans.
+
+    Calls are labelled by the action of their requests, or 'mixed' when they
+    carry requests of different actions.
+    """
+    def __init__(self, prefix='metabans'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def add_gauge(self, name, func, help=None):
+        """report the value returned by func, such as the length of a queue,
+        each time the metrics are read"""
+        with self._lock:
+            self._gauges[name] = (func, help)
+
+    def observe_call(self, action, size, round_trip, bytes_sent, bytes_received, error=None):
+        """record a HTTP call of size requests to Metabans"""
+        self.observe('round_trip_seconds', round_trip, action=action)
+        self.observe('batch_size', size, buckets=BATCH_SIZE_BUCKETS, action=action)
+        self.inc('calls_total', action=action)
+        self.inc('requests_total', size, action=action)
+        self.inc('bytes_sent_total', bytes_sent)
+        self.inc('bytes_received_total', bytes_received)
+        if error is not None:
+            self.inc('call_errors_total', action=action, code=_error_code(error))
+
+    def observe_response(self, action, response, fetch_time):
+        """record a single raw response of a call. fetch_time is None if
+        Metabans did not tell how long it took"""
+        if fetch_time is not None:
+            self.observe('fetch_time_seconds', fetch_time, action=action)
+        if response.get('status') != 'OK':
+            code = response.get('error', {}).get('code', 'unknown')
+            self.inc('response_errors_total', action=action, code=code)
+
+    def counter(self, name, **labels):
+        """current value of a counter, summed over the labels not given"""
+        labels = set(labels.items())
+        with self._lock:
+            return sum(value for (n, l), value in self._counters.iteritems()
+                       if n == name and labels <= set(l))
+
+    def histograms(self, name):
+        """return a dict of copies of the histograms of that name by their
+        labels"""
+        with self._lock:
+            return dict((l, h.copy()) for (n, l), h in self._histograms.iteritems() if n == name)
+
+    def gauges(self):
+        """return a dict of the current value of each gauge"""
+        return dict((name, value) for name, value, help in self._read_gauges())
+
+    def _read_gauges(self):
+        with self._lock:
+            gauges = sorted(self._gauges.items())
+        values = []
+        for name, (func, help) in gauges:
+            try:
+                values.append((name, func(), help))
+            except Exception:
+                log.exception("cannot read gauge %s", name)
+        return values
+
+    def render(self):
+        """return all the metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((k, (h.buckets, list(h.counts), h.count, h.sum))
+                                for k, h in self._histograms.iteritems())
+        typed = set()
+        for (name, labels), value in counters:
+            name = '%s_%s' % (self.prefix, name)
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s counter' % name)
+            lines.append('%s%s %s' % (name, _format_labels(labels), _format_value(value)))
+        for (name, labels), (buckets, counts, count, total) in histograms:
+            name = '%s_%s' % (self.prefix, name)
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s histogram' % name)
+            cumulated = 0
+            for bound, bucket_count in zip(buckets + (float('inf'),), counts):
+                cumulated += bucket_count
+                lines.append('%s_bucket%s %s' % (name, _format_labels(labels + (('le', _format_value(bound)),)),
+                                                 cumulated))
+            lines.append('%s_sum%s %s' % (name, _format_labels(labels), _format_value(total)))
+            lines.append('%s_count%s %s' % (name, _format_labels(labels), count))
+        for name, value, help in self._read_gauges():
+            name = '%s_%s' % (self.prefix, name)
+            if help:
+                lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s %s' % (name, _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        log.debug("metrics endpoint: " + format, *args)
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MetricsServer(BaseHTTPServer.HTTPServer):
+    """HTTP server answering GET /metrics with Metrics.render() from a
+    background thread"""
+    allow_reuse_address = True
+
+    def __init__(self, metrics, port=0, address='127.0.0.1'):
+        BaseHTTPServer.HTTPServer.__init__(self, (address, port), _MetricsHandler)
+        self.metrics = metrics
+
+    @property
+    def url(self):
+        return 'http://%s:%s/metrics' % self.server_address[:2]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='metabans-metrics')
+        thread.setDaemon(True)
+        thread.start()
+        return self
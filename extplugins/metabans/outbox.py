@@ -0,0 +1,186 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+from pymetabans import MetabansAuthenticationError
+import logging
+import threading
+import time
+'''Durable queue of requests to deliver to Metabans'''
+
+try:
+    # Python >= 2.6
+    import json
+except ImportError:
+    # Python < 2.6
+    import simplejson as json
+
+log = logging.getLogger('pymetabans')
+
+
+class Outbox(object):
+    """Append-only journal of requests waiting to be delivered to Metabans.
+
+    Requests are written to the local store before anything is sent, then a
+    background thread delivers them in batches, oldest first, so that the
+    order of the requests made for a player is kept. When Metabans cannot be
+    reached, delivery is retried with an exponential backoff, across restarts
+    if needed.
+
+    The journal is compacted as requests are added : a new assessment 
+    replaces the assessments still waiting for the same player, and a 
+    sighting identical to one still waiting is dropped. The assessment_length
+    of a request is counted from the time it was added, so that a tempban
+    which expired while waiting is delivered as no assessment at all.
+
+               store : a LocalStore
+            metabans : a pymetabans.Metabans instance
+          batch_size : maximum number of requests sent in a single call
+     max_retry_delay : maximum number of seconds between two delivery attempts
+        on_delivered : called with each request Metabans accepted
+       on_auth_error : called when Metabans rejects our credentials
+               sizer : a BatchSizer deciding the batch size instead of 
+                       batch_size
+    """
+    def __init__(self, store, metabans, batch_size=50, max_retry_delay=300,
+                 on_delivered=None, on_auth_error=None, sizer=None):
+        self._store = store
+        self.metabans = metabans
+        self.batch_size = batch_size
+        self.sizer = sizer
+        self.max_retry_delay = max_retry_delay
+        self.on_delivered = on_delivered
+        self.on_auth_error = on_auth_error
+        self.compacted = 0
+        self._wakeup = threading.Event()
+        self._stop = None
+        self._thread = None
+        self._store.execute("""CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            player_uid TEXT,
+            action TEXT,
+            request TEXT,
+            time_add REAL)""")
+        self._store.execute("CREATE INDEX IF NOT EXISTS outbox_player ON outbox (player_uid, action)")
+
+    def __len__(self):
+        return self._store.execute("SELECT COUNT(*) FROM outbox")[0][0]
+
+    def has_assessment(self, player_uid):
+        """whether an assessment of the player is waiting to be delivered"""
+        return self._store.execute("SELECT COUNT(*) FROM outbox WHERE action = ? AND player_uid = ?",
+                                   ('mb_assess_player', player_uid))[0][0] > 0
+
+    def put(self, requests):
+        """append requests (dicts of request parameters) to the journal"""
+        now = time.time()
+        with self._store.transaction() as cursor:
+            for request in requests:
+                player_uid = request.get('player_uid')
+                data = json.dumps(request, sort_keys=True)
+                if request['action'] == 'mb_assess_player':
+                    cursor.execute("DELETE FROM outbox WHERE action = ? AND player_uid = ?",
+                                   ('mb_assess_player', player_uid))
+                    self.compacted += cursor.rowcount
+                elif request['action'] == 'mb_sight_player':
+                    cursor.execute("SELECT COUNT(*) FROM outbox WHERE action = ? AND player_uid = ? AND request = ?",
+                                   ('mb_sight_player', player_uid, data))
+                    if cursor.fetchone()[0]:
+                        self.compacted += 1
+                        continue
+                cursor.execute("INSERT INTO outbox (player_uid, action, request, time_add) VALUES (?, ?, ?, ?)",
+                               (player_uid, request['action'], data, now))
+        self._wakeup.set()
+
+    def start(self):
+        """start delivering the journal in the background"""
+        if self._thread is None:
+            # each thread has its own events, so that a stopped thread 
+            # does not eat the wake up calls of the next one
+            self._wakeup = threading.Event()
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(self._wakeup, self._stop),
+                                            name='metabans-outbox')
+            self._thread.setDaemon(True)
+            self._thread.start()
+        self._wakeup.set()
+
+    def stop(self):
+        """stop delivering the journal. Requests put meanwhile are kept until
+        start() is called again"""
+        if self._thread is not None:
+            self._stop.set()
+            self._wakeup.set()
+            self._thread = None
+
+    def _run(self, wakeup, stop):
+        delay = 0
+        while not stop.isSet():
+            batch_size = self.sizer.size if self.sizer else self.batch_size
+            rows = self._store.execute("SELECT id, request, time_add FROM outbox ORDER BY id LIMIT ?",
+                                       (batch_size,))
+            if not rows:
+                wakeup.wait()
+                wakeup.clear()
+                continue
+            try:
+                self._deliver(rows)
+                delay = 0
+                continue
+            except MetabansAuthenticationError, err:
+                log.error("Metabans rejected our credentials : %s", err)
+                delay = self.max_retry_delay
+                if self.on_auth_error:
+                    self.on_auth_error()
+            except Exception, err:
+                delay = min(max(delay * 2, 1), self.max_retry_delay)
+                log.warning("could not deliver %s requests to Metabans (%r), retrying in %ss",
+                            len(rows), err, delay)
+            stop.wait(delay)
+
+    def _deliver(self, rows):
+        now = time.time()
+        requests = []
+        for id, data, time_add in rows:
+            request = json.loads(data)
+            if 'assessment_length' in request:
+                remaining = request['assessment_length'] - int(now - time_add)
+                # a negative length is the same as no assessment at all
+                request['assessment_length'] = remaining if remaining > 0 else -1
+            requests.append(request)
+        batch = self.metabans.batch()
+        for request in requests:
+            batch.add(request)
+        started = time.time()
+        try:
+            results = batch.send()
+        except Exception:
+            if self.sizer:
+                self.sizer.failed()
+            raise
+        if self.sizer:
+            self.sizer.record(len(requests), time.time() - started, 
+                              [r.fetch_time for r in results])
+        delivered = []
+        for (id, _, _), result in zip(rows, results):
+            if isinstance(result.error, MetabansAuthenticationError):
+                raise result.error
+            elif not result.ok:
+                log.error("Metabans rejected %r : %s", result.request, result.error)
+            elif self.on_delivered:
+                self.on_delivered(result.request)
+            delivered.append((id,))
+        with self._store.transaction() as cursor:
+            cursor.executemany("DELETE FROM outbox WHERE id = ?", delivered)
+        log.debug("delivered %s requests, %s left", len(delivered), len(self))
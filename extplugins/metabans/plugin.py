@@ -18,28 +18,52 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 #
 #
-from ConfigParser import NoOptionError
-from b3.clients import Client
+from ConfigParser import NoOptionError, NoSectionError
 from b3.events import EVT_CLIENT_AUTH, EVT_CLIENT_BAN, EVT_CLIENT_BAN_TEMP, \
     EVT_CLIENT_UNBAN, EVT_CLIENT_UPDATE
 from b3.functions import meanstdv
 from b3.plugin import Plugin
 from b3.querybuilder import QueryBuilder
+from batching import BatchSizer, batches, recheck_interval
+from blacklist import Assessment, BlacklistMirror, assessment_from_status
+from collections import OrderedDict, namedtuple
 from datetime import datetime
+from localstore import LocalStore
 from metabanproxy import MetabansProxy
-from pymetabans import MetabansAuthenticationError, MetabansError, \
-    MetabansException
+from metrics import LATENCY_BUCKETS, Metrics, MetricsServer
+from outbox import Outbox
+from pymetabans import MetabansAuthenticationError, MetabansError, MetabansException
+from tracing import Tracer, current_trace, new_trace_id, span
 import b3
 import b3.output
+from workers import WorkerPool, OVERFLOW_DROP_OLDEST, OVERFLOW_POLICIES, \
+    PRIORITY_ENFORCEMENT, PRIORITY_SIGHTING
 import logging
+import socket
 import threading
 import time
 
 __author__  = 'Courgette'
-__version__ = '1.1'
+__version__ = '1.2'
 
 USER_AGENT =  "B3 Metabans plugin/%s" % __version__
 SUPPORTED_PARSERS = ('bfbc2', 'moh', 'cod4', 'cod5', 'cod6', 'cod7', 'homefront', 'bf3')
+# a player found banned on Metabans is not kicked again during that many seconds
+KICK_DEBOUNCE_DELAY = 10
+
+# a ban or tempban from the penalties table along with the banned client info
+BanRow = namedtuple('BanRow', 'id type reason inactive time_edit time_expire guid name ip pbid')
+
+
+def _formatSeconds(seconds):
+    """format the bucket bound returned by Histogram.percentile()"""
+    if seconds is None:
+        return '-'
+    elif seconds == float('inf'):
+        return '>%gs' % LATENCY_BUCKETS[-1]
+    elif seconds < 1:
+        return '<%dms' % (seconds * 1000)
+    return '<%gs' % seconds
 
 
 class MetabansPlugin(Plugin):
@@ -47,9 +71,54 @@ class MetabansPlugin(Plugin):
     _message_method = None
     _metabans = None
     _admins_level = None
+    _workers = None
+    _kicked = None
+    _kicked_lock = None
+    _store = None
+    _outbox = None
+    _sync_concurrency = 4
+    _sync_sizer = None
+    _metrics = None
+    _metricsServer = None
+    _metrics_port = 0
+    _metrics_address = '127.0.0.1'
+    _tracer = None
+    _sweep_enabled = True
+    _sweep_delay = 10
+    _sweep_players_per_call = 32
+    _sweep_interval = 1.0
+    _recheck_enabled = True
+    _recheck_interval = 30
+    _recheck_max_interval = 300
+    _recheck_sizer = None
+    _playerChecksStop = None
+    _blacklist = None
 
     def onLoadConfig(self):
-        self._metabans = MetabansProxy(self.console.gameName, user_agent=USER_AGENT)
+        if self._kicked is None:
+            self._kicked = {}
+            self._kicked_lock = threading.Lock()
+        if self._metrics is None:
+            # kept across config reloads
+            self._metrics = Metrics()
+
+        if self._metabans is not None:
+            # replaced by a proxy using the new settings
+            self._metabans.close()
+        coalesce_max_batch = self._getSetting('batching', 'coalesce_max_batch', self.config.getint, 50)
+        self._metabans = MetabansProxy(self.console.gameName, user_agent=USER_AGENT,
+            keep_alive=self._getSetting('connection', 'keep_alive', self.config.getboolean, True),
+            pool_size=self._getSetting('connection', 'pool_size', self.config.getint, 4),
+            pool_idle_timeout=self._getSetting('connection', 'pool_idle_timeout', self.config.getint, 30),
+            compress_requests=self._getSetting('connection', 'compress_requests', self.config.getboolean, False),
+            timeout=max(1, self._getSetting('connection', 'timeout', self.config.getint, 30)),
+            coalesce_window=self._getSetting('batching', 'coalesce_window', self.config.getint, 100) / 1000.0,
+            coalesce_max_batch=coalesce_max_batch,
+            coalesce_sizer=self._newBatchSizer(coalesce_max_batch),
+            cache_ttl=self._getSetting('cache', 'ttl', self.config.getint, 120),
+            cache_unknown_ttl=self._getSetting('cache', 'unknown_ttl', self.config.getint, 30),
+            cache_size=self._getSetting('cache', 'size', self.config.getint, 1000),
+            metrics=self._metrics)
         
         # get the admin plugin
         self._adminPlugin = self.console.getPlugin('admin')
@@ -102,6 +171,95 @@ class MetabansPlugin(Plugin):
             self.error('cannot read settings/admins_level from admin plugin config file (%s)', err)
             self._admins_level = 60
         self.info("using %s for admins level", self._admins_level)
+
+        # load workers settings
+        overflow_policy = self._getSetting('workers', 'overflow_policy', default=OVERFLOW_DROP_OLDEST)
+        if overflow_policy not in OVERFLOW_POLICIES:
+            self.warning("invalid value for workers/overflow_policy : %r. Expecting one of %s",
+                         overflow_policy, ', '.join(OVERFLOW_POLICIES))
+            overflow_policy = OVERFLOW_DROP_OLDEST
+        if self._workers is None:
+            workers = self._getSetting('workers', 'workers', self.config.getint, 4)
+            if workers < 1:
+                self.warning("invalid value for workers/workers : %r. Expecting at least 1", workers)
+                workers = 4
+            self._workers = WorkerPool(
+                workers=workers,
+                queue_size=self._getSetting('workers', 'queue_size', self.config.getint, 200),
+                overflow=overflow_policy,
+                reserved_workers=self._getSetting('workers', 'reserved_workers', self.config.getint, 1))
+        else:
+            self.info("number of workers will be changed on next B3 restart")
+            self._workers.queue_size = self._getSetting('workers', 'queue_size', self.config.getint, 200)
+            self._workers.overflow = overflow_policy
+        self.info("using %s workers", self._workers.workers)
+        self._metrics.add_gauge('workers_queue_length', lambda: self._workers.queue_length,
+                                "events waiting for a worker")
+        self._metrics.add_gauge('workers_active', lambda: self._workers.active_workers,
+                                "workers busy with an event")
+        self._metrics.add_gauge('workers_dropped', lambda: self._workers.dropped,
+                                "events dropped because the workers queue was full")
+
+        # load outbox settings
+        if self._store is None:
+            database = b3.getAbsolutePath(self._getSetting('storage', 'database', default='@conf/metabans.sqlite'))
+            self.info("using local database %s", database)
+            self._store = LocalStore(database)
+        if self._blacklist is None \
+            and self._getSetting('blacklist', 'local_gate', self.config.getboolean, True):
+            self._blacklist = BlacklistMirror(self._store)
+            self.info("%s Metabans assessments known locally", len(self._blacklist))
+            self._metrics.add_gauge('blacklist_entries', lambda: len(self._blacklist),
+                                    "players with an assessment in the local mirror")
+        if self._outbox is None:
+            self._outbox = Outbox(self._store, self._metabans.metabans,
+                                  on_delivered=self._onOutboxDelivered,
+                                  on_auth_error=self._onAuthenticationError)
+        else:
+            self._outbox.metabans = self._metabans.metabans
+        self._outbox.batch_size = self._getSetting('outbox', 'batch_size', self.config.getint, 50)
+        self._outbox.sizer = self._newBatchSizer(self._outbox.batch_size)
+        self._outbox.max_retry_delay = self._getSetting('outbox', 'max_retry_delay', self.config.getint, 300)
+        self._metrics.add_gauge('outbox_pending', lambda: len(self._outbox),
+                                "ban events waiting to be delivered")
+        self._metrics.add_gauge('outbox_compacted', lambda: self._outbox.compacted,
+                                "ban events superseded before being delivered")
+
+        # load sync settings
+        self._sync_concurrency = max(1, self._getSetting('sync', 'concurrency', self.config.getint, 4))
+        # each ban is sent as a sighting and an assessment
+        self._sync_sizer = self._newBatchSizer(2 * self._getSetting('sync', 'bans_per_call', self.config.getint, 50))
+
+        # load metrics settings
+        self._metrics_port = self._getSetting('metrics', 'port', self.config.getint, 0)
+        self._metrics_address = self._getSetting('metrics', 'address', default='127.0.0.1')
+
+        # load startup sweep settings
+        self._sweep_enabled = self._getSetting('sweep', 'enabled', self.config.getboolean, True)
+        self._sweep_delay = self._getSetting('sweep', 'delay', self.config.getint, 10)
+        self._sweep_players_per_call = max(1, self._getSetting('sweep', 'players_per_call', self.config.getint, 32))
+        self._sweep_interval = self._getSetting('sweep', 'interval', self.config.getint, 1000) / 1000.0
+
+        # load re-check settings
+        self._recheck_enabled = self._getSetting('recheck', 'enabled', self.config.getboolean, True)
+        self._recheck_interval = max(1, self._getSetting('recheck', 'interval', self.config.getint, 30))
+        self._recheck_max_interval = max(self._recheck_interval,
+            self._getSetting('recheck', 'max_interval', self.config.getint, 300))
+        self._recheck_sizer = self._newBatchSizer(self._getSetting('recheck', 'players_per_call', self.config.getint, 50))
+
+        # load tracing settings
+        if self._tracer is not None:
+            self._tracer.close()
+        if self._getSetting('tracing', 'enabled', self.config.getboolean, True):
+            path = self._getSetting('tracing', 'file', default='@conf/metabans_traces.log')
+            self._tracer = Tracer(
+                slow_threshold=self._getSetting('tracing', 'slow_threshold', self.config.getint, 1000) / 1000.0,
+                path=b3.getAbsolutePath(path) if path else None,
+                metrics=self._metrics)
+            self.info("traces slower than %sms are written to %s", 
+                      int(self._tracer.slow_threshold * 1000), self._tracer.path)
+        else:
+            self._tracer = None
         
         
             
@@ -128,9 +286,9 @@ class MetabansPlugin(Plugin):
             self.disable()
             return
         
-        # add pymetabans logs to our current log handler
+        # add pymetabans logs to our current log handler, at the same level
         metabanslog = logging.getLogger('pymetabans')
-        metabanslog.setLevel(logging.DEBUG)
+        metabanslog.setLevel(logging.getLogger('output').getEffectiveLevel())
         for handlr in logging.getLogger('output').handlers:
             metabanslog.addHandler(handlr)
         
@@ -140,18 +298,135 @@ class MetabansPlugin(Plugin):
         self.registerEvent(EVT_CLIENT_BAN_TEMP)
         self.registerEvent(EVT_CLIENT_UNBAN)
 
-#        self._checkConnectedPlayers()
+        pending = len(self._outbox)
+        if pending:
+            self.info("%s requests are waiting to be delivered to Metabans", pending)
+        self._outbox.start()
+
+        if self._metrics_port and self._metricsServer is None:
+            try:
+                self._metricsServer = MetricsServer(self._metrics, port=self._metrics_port,
+                                                    address=self._metrics_address).start()
+                self.info("metrics available at %s", self._metricsServer.url)
+            except socket.error, err:
+                self.error("cannot serve metrics on %s:%s (%s)", self._metrics_address,
+                           self._metrics_port, err)
+
+        self._startPlayerChecks()
+
+
+    def enable(self):
+        Plugin.enable(self)
+        if self._outbox is not None:
+            self._outbox.start()
+            self._startPlayerChecks()
+
+
+    def disable(self):
+        Plugin.disable(self)
+        if self._outbox is not None:
+            # do not keep sending requests Metabans may reject
+            self._outbox.stop()
+        self._stopPlayerChecks()
+
+
+    def _startPlayerChecks(self):
+        """start the threads checking the connected players, unless they
+        are running already"""
+        if self._playerChecksStop is not None:
+            return
+        stop = self._playerChecksStop = threading.Event()
+        if self._sweep_enabled:
+            thread = threading.Thread(target=self._checkConnectedPlayers, args=(stop,),
+                                      name='metabans-sweep')
+            thread.setDaemon(True)
+            thread.start()
+        if self._recheck_enabled:
+            thread = threading.Thread(target=self._recheckConnectedPlayers, args=(stop,),
+                                      name='metabans-recheck')
+            thread.setDaemon(True)
+            thread.start()
+
+
+    def _stopPlayerChecks(self):
+        """make the threads checking the connected players stop"""
+        if self._playerChecksStop is not None:
+            self._playerChecksStop.set()
+            self._playerChecksStop = None
 
 
     def onEvent(self, event):
-        if event.type in (EVT_CLIENT_AUTH, EVT_CLIENT_UPDATE):
-            threading.Thread(target=self.onClientAuth, args=(event,)).start()
+        if event.type == EVT_CLIENT_AUTH:
+            trace_id = new_trace_id()
+            trace = self._startTrace('client_auth', event, trace_id)
+            self._checkLocalGate(event.client, trace)
+            self._submit(PRIORITY_ENFORCEMENT, self.onClientAuth, event, trace)
+            self._submit(PRIORITY_SIGHTING, self.onClientSight, event,
+                         self._startTrace('client_sight', event, trace_id))
+        elif event.type == EVT_CLIENT_UPDATE:
+            self._submit(PRIORITY_SIGHTING, self.onClientSight, event,
+                         self._startTrace('client_sight', event))
         elif event.type == EVT_CLIENT_BAN:
-            threading.Thread(target=self.onClientBan, args=(event,)).start()
+            self.onClientBan(event)
         elif event.type == EVT_CLIENT_BAN_TEMP:
-            threading.Thread(target=self.onClientTempBan, args=(event,)).start()
+            self.onClientTempBan(event)
         elif event.type == EVT_CLIENT_UNBAN:
-            threading.Thread(target=self.onClientUnBan, args=(event,)).start()
+            self.onClientUnBan(event)
+
+    def _submit(self, priority, func, event, trace=None):
+        """hand the event over to the workers"""
+        if trace is None:
+            submitted = self._workers.submit(priority, func, event)
+        else:
+            submitted = self._workers.submit(priority, self._runTraced, func, event, trace)
+        if not submitted:
+            self.warning("workers queue is full (%s waiting), dropping %s", 
+                         self._workers.queue_length, func.__name__)
+            if trace is not None:
+                trace.attributes['dropped'] = True
+                self._tracer.finish(trace)
+        elif self._workers.queue_length:
+            self.verbose("workers: %s active, %s waiting", 
+                         self._workers.active_workers, self._workers.queue_length)
+
+
+    def _checkLocalGate(self, client, trace=None):
+        """kick the client right away if the local mirror knows them as
+        banned, without waiting for a worker. The check the workers then make
+        only refreshes the local mirror"""
+        if self._blacklist is None or not client:
+            return
+        assessment = self._blacklist.banned(client.guid)
+        if assessment is None:
+            return
+        self.debug("%s is banned according to the local mirror", client.name)
+        if trace is None:
+            self.onMetabans_banned(client, reason=assessment.reason,
+                                   inherited_blacklist=assessment.inherited)
+        else:
+            with trace.activated():
+                with span('local_gate'):
+                    self.onMetabans_banned(client, reason=assessment.reason,
+                                           inherited_blacklist=assessment.inherited)
+        self._metrics.inc('local_gate_kicks_total')
+
+
+    def _startTrace(self, name, event, trace_id=None):
+        """return a new Trace of the event, or None if tracing is disabled"""
+        if self._tracer is None or not event.client:
+            return None
+        return self._tracer.start(name, trace_id=trace_id, guid=event.client.guid,
+                                  player=event.client.name)
+
+    def _runTraced(self, func, event, trace):
+        """run func(event) from a worker, recording the time the event 
+        waited for the worker"""
+        trace.add_span('queue_wait', trace.start)
+        try:
+            with trace.activated():
+                func(event)
+        finally:
+            self._tracer.finish(trace)
 
 
     #===============================================================================
@@ -161,12 +436,20 @@ class MetabansPlugin(Plugin):
     #===============================================================================
 
     def onClientAuth(self, event):
+        client = event.client
+        if client:
+            self._checkClient(client)
+
+
+    def onClientSight(self, event):
         client = event.client
         if client:
             self.info("sending sighting event to Metabans for %s", client.name)
             try:
-                response = self._metabans.sight(client)
-                self._onMetabansResponse(client, response)
+                with span('sight'):
+                    response = self._metabans.sight(client)
+                with span('handling'):
+                    self._onMetabansResponse(client, response)
             except MetabansAuthenticationError:
                 self.error("bad METABANS username or api_key. Disabling Metaban plugin")
                 self.disable()
@@ -177,20 +460,14 @@ class MetabansPlugin(Plugin):
     def onClientBan(self, event):
         client = event.client
         if client:
-            self.info("sending ban event to Metabans for %s", client.name)
-            try:
-                self._metabans.ban(client, reason=self._getReasonFromEvent(event))
-            except MetabansAuthenticationError:
-                self.error("bad METABANS username or api_key. Disabling Metaban plugin")
-                self.disable()
-            except MetabansException, err:
-                self.error(err)
+            self.info("queuing ban event to Metabans for %s", client.name)
+            self._queueAssessment(client, 'black', reason=self._getReasonFromEvent(event))
 
 
     def onClientTempBan(self, event):
         client = event.client
         if client:
-            self.info("sending tempban event to Metabans for %s", client.name)
+            self.info("queuing tempban event to Metabans for %s", client.name)
             try:
                 duration = int(event.data['duration']) * 60
             except KeyError:
@@ -198,28 +475,42 @@ class MetabansPlugin(Plugin):
                 duration = 30
             self.debug("duration of ban : %s" % duration)
             if duration >= 30:
-                try:
-                    self._metabans.ban(client, 
-                                       duration=duration,
-                                       reason=self._getReasonFromEvent(event))
-                except MetabansAuthenticationError:
-                    self.error("bad METABANS username or api_key. Disabling Metaban plugin")
-                    self.disable()
-                except MetabansException, err:
-                    self.error(err)
+                self._queueAssessment(client, 'black', duration=duration,
+                                      reason=self._getReasonFromEvent(event))
 
 
     def onClientUnBan(self, event):
         client = event.client
         if client:
-            self.info("sending unban event to Metabans for %s", client.name)
-            try:
-                self._metabans.clear(client, reason=self._getReasonFromEvent(event))
-            except MetabansAuthenticationError:
-                self.error("bad METABANS username or api_key. Disabling Metaban plugin")
-                self.disable()
-            except MetabansException, err:
-                self.error(err)
+            self.info("queuing unban event to Metabans for %s", client.name)
+            self._queueAssessment(client, 'none', reason=self._getReasonFromEvent(event))
+
+
+    def _queueAssessment(self, client, assessment_type, duration=None, reason=None):
+        """write the assessment to the outbox which will deliver it to 
+        Metabans in the background"""
+        self._metabans.forget(client.guid)
+        if self._blacklist is not None:
+            if assessment_type == 'none':
+                self._blacklist.update(client.guid, None)
+            else:
+                self._blacklist.update(client.guid, Assessment(assessment_type, 
+                    time.time() + duration if duration else None, reason, None))
+        self._outbox.put([
+            self._metabans.sighting_request(client),
+            self._metabans.assessment_request(client, assessment_type, 
+                                              duration=duration, reason=reason),
+        ])
+
+
+    def _onOutboxDelivered(self, request):
+        if request['action'] == 'mb_assess_player':
+            self._metabans.forget(request['player_uid'])
+
+
+    def _onAuthenticationError(self):
+        self.error("bad METABANS username or api_key. Disabling Metaban plugin")
+        self.disable()
 
 
     #===========================================================================
@@ -386,35 +677,109 @@ class MetabansPlugin(Plugin):
 
 
 
+    def cmd_metabansstats(self, data=None, client=None, cmd=None):
+        """\
+        display latencies, errors and queues of the calls to Metabans.com
+        """
+        round_trips = self._metrics.histograms('round_trip_seconds')
+        if not round_trips:
+            client.message("no call made to metabans.com yet")
+        fetch_times = self._metrics.histograms('fetch_time_seconds')
+        for labels, histogram in sorted(round_trips.items()):
+            action = dict(labels)['action']
+            message = "%s: %s calls, p50 %s, p95 %s, p99 %s" % (action, histogram.count,
+                _formatSeconds(histogram.percentile(50)), _formatSeconds(histogram.percentile(95)),
+                _formatSeconds(histogram.percentile(99)))
+            if labels in fetch_times:
+                message += ", fetch p95 %s" % _formatSeconds(fetch_times[labels].percentile(95))
+            errors = self._metrics.counter('call_errors_total', action=action) \
+                + self._metrics.counter('response_errors_total', action=action)
+            if errors:
+                message += ", %s errors" % errors
+            client.message(message)
+        gauges = self._metrics.gauges()
+        client.message("queues: workers %s, outbox %s, coalescer %s" % (
+            gauges.get('workers_queue_length', 0), gauges.get('outbox_pending', 0),
+            gauges.get('coalescer_pending', 0)))
+        client.message("sent %s KB, received %s KB" % (
+            self._metrics.counter('bytes_sent_total') // 1024,
+            self._metrics.counter('bytes_received_total') // 1024))
+
+
     def cmd_metabanssync(self, data=None, client=None, cmd=None):
         """\
-        send all active bans and tempbans found on your database to Metabans.com
+        [full] - send bans and tempbans changed since last sync to Metabans.com, or all active ones
         """
-        MAX_BANS_PER_CALL = 50
-        def chunks(l, n):
-            for i in range(0, len(l), n):
-                yield l[i:i+n]
-
-        active_bans = self._getAllActiveBans()
-        if len(active_bans) == 0:
-            client.message("no active ban found")
+        if data and data.strip().lower() == 'full':
+            checkpoint = None
+        else:
+            checkpoint = self._getSyncCheckpoint()
+        high_water_mark = self._getPenaltiesHighWaterMark()
+        nb_bans = self._countActiveBans(since=checkpoint)
+        if nb_bans == 0:
+            if checkpoint is None:
+                client.message("no active ban found")
+            else:
+                client.message("no ban changed since last sync")
+                self._setSyncCheckpoint(high_water_mark)
             return
-        client.message("will now send %s bans to metabans.com" % len(active_bans))
+        if checkpoint is None:
+            client.message("will now send %s bans to metabans.com" % nb_bans)
+        else:
+            client.message("will now send %s bans changed since last sync to metabans.com" % nb_bans)
+        chunks = {}
+        progress = {'next_index': 0, 'completed': {}, 'failed': False, 'last': None}
+        def query_batches():
+            bans_per_call = lambda: max(1, self._sync_sizer.size // 2)
+            for index, chunk in enumerate(batches(self._iterActiveBans(since=checkpoint), bans_per_call)):
+                chunks[index] = chunk
+                progress['last'] = max(progress['last'], (chunk[-1].time_edit, chunk[-1].id))
+                yield self._getBanQueries(chunk)
+
+        def on_batch_done(index, result):
+            oks, fails, stats = result
+            nb_ban_sent = 0
+            for v in oks:
+                if v.action == 'mb_assess_player':
+                    nb_ban_sent += 1
+            if self._blacklist is not None:
+                self._blacklist.update_many([(v.request['player_uid'], assessment_from_status(v.data))
+                                             for v in oks if v.action == 'mb_assess_player' and v.data])
+            client.message("%s bans sent" % nb_ban_sent)
+            for k in stats:
+                mean, stdv = meanstdv(stats[k])
+                self.debug("%s (%s calls): (ms) min(%0.1f), max(%0.1f), mean(%0.1f), stddev(%0.1f)", 
+                              k, len(stats[k]),
+                              min(stats[k]), max(stats[k]), 
+                              mean, stdv)
+            rejected = set(v.request['player_uid'] for v in fails if v.action == 'mb_assess_player')
+            if rejected:
+                self.warning("Metabans rejected the bans of %s players", len(rejected))
+            # bans are sorted by last edition, so we can resume after the last
+            # ban preceded by bans acknowledged by Metabans only
+            progress['completed'][index] = rejected
+            mark = None
+            while not progress['failed'] and progress['next_index'] in progress['completed']:
+                rejected = progress['completed'].pop(progress['next_index'])
+                for ban in chunks.pop(progress['next_index']):
+                    if ban.guid in rejected:
+                        progress['failed'] = True
+                        break
+                    mark = (ban.time_edit, ban.id)
+                progress['next_index'] += 1
+            if checkpoint is not None and mark is not None:
+                self._setSyncCheckpoint(mark)
+
         try:
-            for bans in chunks(active_bans, MAX_BANS_PER_CALL):
-                oks, fails, stats = self._send_bans(bans)
-                nb_ban_sent = 0
-                for v in oks:
-                    if v['request']['action'] == 'mb_assess_player':
-                        nb_ban_sent += 1
-                client.message("%s bans sent" % nb_ban_sent)
-                for k in stats:
-                    mean, stdv = meanstdv(stats[k])
-                    self.debug("%s (%s calls): (ms) min(%0.1f), max(%0.1f), mean(%0.1f), stddev(%0.1f)", 
-                                  k, len(stats[k]),
-                                  min(stats[k]), max(stats[k]), 
-                                  mean, stdv)
-            client.message("all active bans sent to metabans.com")
+            self._metabans.send_bulk_pipeline(query_batches(), 
+                                              concurrency=self._sync_concurrency,
+                                              on_batch_done=on_batch_done,
+                                              sizer=self._sync_sizer)
+            if progress['failed']:
+                client.message("some bans were rejected by metabans.com, they will be sent again by next sync")
+            else:
+                self._setSyncCheckpoint(max(high_water_mark, progress['last']))
+                client.message("all bans sent to metabans.com")
         except MetabansAuthenticationError:
             self.error("bad METABANS username or api_key. Disabling Metaban plugin")
             client.message("bad METABANS username or api_key. Disabling Metaban plugin")
@@ -429,88 +794,166 @@ class MetabansPlugin(Plugin):
     # 
     #=======================================================================
 
-    def _send_bans(self, bans):
-        queries_bans = []
-        players = set()
+    def _getBanQueries(self, bans):
+        """return the sightings of the banned players followed by their 
+        assessments, bans being BanRow objects.
+        
+        A single assessment is sent per player, made from all the active bans
+        of the player in the database and not only from those given, so that
+        lifting a ban does not clear another one"""
+        players = OrderedDict()
         for ban in bans:
-            if ban.type not in ('Ban', 'TempBan'):
-                continue
-            try:
-                c = self.console.storage.getClient(Client(id=ban.clientId))
-                players.add(c)
-            except KeyError:
-                self.debug("could not find client with id %s" % ban.clientId)
-                continue
-            query = {
-                'action': 'mb_assess_player',
-                'game_name': self._metabans._game_name,
-                'assessment_type': 'black',
-                'player_uid': c.guid
-            }
-            duration_remaining = int(ban.timeExpire - time.time()) 
-            if duration_remaining > 0:
-                query['assessment_length'] = duration_remaining
-            if ban.reason:
-                query['reason'] = self._metabans._stripColors(ban.reason)
-            self.debug("add %r" % query)
-            queries_bans.append(query)
+            players[ban.guid] = ban
+        active_bans = self._getActiveBansByGuid(players.keys())
         queries_players = []
-        for p in players:
-            queries_players.append({
-                'action': 'mb_sight_player',
-                'game_name': self._metabans._game_name,
-                'group_name': self._metabans.group_name,
-                'player_uid': p.guid,
-                'player_name': p.name,
-                'player_ip': p.ip,
-                'alternate_uid': p.pbid,
-            })
-        return self._metabans.send_bulk_queries(queries_players + queries_bans)
-
-
-    def _getAllActiveBans(self):
-        def createPenaltyFromRow(g):
-            if g['type'] == 'Warning':
-                penalty = b3.clients.ClientWarning()
-            elif g['type'] == 'TempBan':
-                penalty = b3.clients.ClientTempBan()
-            elif g['type'] == 'Kick':
-                penalty = b3.clients.ClientKick()
-            elif g['type'] == 'Ban':
-                penalty = b3.clients.ClientBan()
-            elif g['type'] == 'Notice':
-                penalty = b3.clients.ClientNotice()
+        queries_bans = []
+        for guid, ban in players.iteritems():
+            queries_players.append(self._metabans.sighting_request(ban))
+            if guid not in active_bans:
+                # the bans were lifted
+                query = self._metabans.assessment_request(ban, 'none')
             else:
-                penalty = b3.clients.Penalty()
-            penalty.id = int(g['id'])
-            penalty.type    = g['type']
-            penalty.keyword = g['keyword']
-            penalty.reason = g['reason']
-            penalty.data = g['data']
-            penalty.inactive    = int(g['inactive'])
-            penalty.timeAdd  = int(g['time_add'])
-            penalty.timeEdit = int(g['time_edit'])
-            penalty.timeExpire = int(g['time_expire'])
-            penalty.clientId = int(g['client_id'])
-            penalty.adminId = int(g['admin_id'])
-            penalty.duration = int(g['duration'])
-            return penalty
+                # the ban which lasts the longest prevails
+                ban = max(active_bans[guid], 
+                          key=lambda b: float('inf') if b.time_expire == -1 else b.time_expire)
+                duration_remaining = int(ban.time_expire - time.time())
+                query = self._metabans.assessment_request(ban, 'black', 
+                            duration=duration_remaining if duration_remaining > 0 else None,
+                            reason=ban.reason)
+            self.debug("add %r" % query)
+            queries_bans.append(query)
+        return queries_players + queries_bans
+
+
+    def _getActiveBansByGuid(self, guids):
+        """return a dict of the lists of active bans and tempbans of the
+        clients having those guids, by guid"""
+        active_bans = {}
+        if not guids:
+            return active_bans
+        # guids are escaped by the storage, some games let players choose them
+        clients = QueryBuilder(self.console.storage.db).WhereClause({'guid': tuple(guids)})
+        where = """p.type IN ('Ban', 'TempBan') AND p.inactive = 0 
+            AND (p.time_expire = -1 OR p.time_expire > %d)
+            AND p.client_id IN (SELECT id FROM clients WHERE %s)""" % (int(time.time()), clients)
+        for ban in self._queryBans(where):
+            active_bans.setdefault(ban.guid, []).append(ban)
+        return active_bans
+
+
+    def _iterActiveBans(self, since=None):
+        """yield the active bans and tempbans as BanRow objects, reading them
+        from the database as they are consumed.
         
-        where = QueryBuilder(self.console.storage.db).WhereClause( { 'type' : ('Ban', 'TempBan'), 'inactive' : 0 } )
-        where += ' and ((time_expire = -1 and time_add > %s) or time_expire > %s)' % (time.time() - (3*30*24*60*60), time.time())
-
-        cursor = self.console.storage.query(QueryBuilder(self.console.storage.db).SelectQuery('*', 'penalties', where, 'client_id'))
+        If since is a (time_edit, id) tuple, yield instead the bans and 
+        tempbans edited after that point, including the lifted ones, sorted by
+        time of edition
+        """
+        where, order_by = self._getBansWhereClause(since)
+        return self._queryBans("%s ORDER BY %s" % (where, order_by))
+
+
+    def _queryBans(self, where):
+        """yield the penalties matching the where SQL clause as BanRow 
+        objects, reading them from the database as they are consumed"""
+        cursor = self.console.storage.query("""SELECT p.id AS id, p.type AS type, p.reason AS reason,
+                p.inactive AS inactive, p.time_edit AS time_edit, p.time_expire AS time_expire,
+                c.guid AS guid, c.name AS name, c.ip AS ip, c.pbid AS pbid
+            FROM penalties p INNER JOIN clients c ON c.id = p.client_id
+            WHERE %s""" % where)
         if not cursor:
-            return ()
-
-        penalties = []
-        while not cursor.EOF:
-            penalties.append(createPenaltyFromRow(cursor.getRow()))
-            cursor.moveNext()
-        cursor.close()
-
-        return penalties
-
+            return
+        try:
+            while not cursor.EOF:
+                g = cursor.getRow()
+                yield BanRow(id=int(g['id']), type=g['type'], reason=g['reason'],
+                             inactive=int(g['inactive']), time_edit=int(g['time_edit']),
+                             time_expire=int(g['time_expire']), guid=g['guid'], 
+                             name=g['name'], ip=g['ip'], pbid=g['pbid'])
+                cursor.moveNext()
+        finally:
+            cursor.close()
+
+
+    def _countActiveBans(self, since=None):
+        """return the number of bans _iterActiveBans() would yield"""
+        where, order_by = self._getBansWhereClause(since)
+        cursor = self.console.storage.query("""SELECT COUNT(*) AS nb_bans
+            FROM penalties p INNER JOIN clients c ON c.id = p.client_id
+            WHERE %s""" % where)
+        nb_bans = 0
+        if cursor:
+            if not cursor.EOF:
+                nb_bans = int(cursor.getRow()['nb_bans'])
+            cursor.close()
+        return nb_bans
+
+
+    def _getBansWhereClause(self, since=None):
+        """return the (where, order_by) SQL clauses selecting bans and tempbans
+        from the penalties table aliased as p"""
+        now = int(time.time())
+        where = "p.type IN ('Ban', 'TempBan') AND "
+        if since is None:
+            where += "p.inactive = 0 AND ((p.time_expire = -1 AND p.time_add > %d) OR p.time_expire > %d)" % (
+                        now - (3*30*24*60*60), now)
+            order_by = 'p.client_id'
+        else:
+            time_edit, penalty_id = since
+            where += "(p.time_edit > %d OR (p.time_edit = %d AND p.id > %d))" % (time_edit, time_edit, penalty_id)
+            where += " AND (p.inactive = 1 OR p.time_expire = -1 OR p.time_expire > %d)" % now
+            order_by = 'p.time_edit, p.id'
+        return where, order_by
+
+
+    def _getPenaltiesHighWaterMark(self):
+        """return the (time_edit, id) of the last edited ban or tempban"""
+        cursor = self.console.storage.query("""SELECT time_edit, id FROM penalties 
+            WHERE type IN ('Ban', 'TempBan') ORDER BY time_edit DESC, id DESC LIMIT 1""")
+        high_water_mark = (0, 0)
+        if cursor:
+            if not cursor.EOF:
+                row = cursor.getRow()
+                high_water_mark = (int(row['time_edit']), int(row['id']))
+            cursor.close()
+        return high_water_mark
+
+
+    def _getSyncCheckpoint(self):
+        """return the (time_edit, id) of the last ban acknowledged by Metabans
+        or None if bans were never synchronized"""
+        value = self._store.get_value('sync_checkpoint')
+        if value:
+            time_edit, penalty_id = value.split(':')
+            return int(time_edit), int(penalty_id)
+
+
+    def _setSyncCheckpoint(self, checkpoint):
+        self._store.set_value('sync_checkpoint', '%d:%d' % checkpoint)
+
+
+    def _getSetting(self, section, option, getter=None, default=None):
+        """read an optional setting, falling back on default if it is missing
+        or invalid"""
+        if getter is None:
+            getter = self.config.get
+        try:
+            return getter(section, option)
+        except (NoSectionError, NoOptionError):
+            self.debug("cannot read %s/%s from config file, using default : %r", section, option, default)
+        except ValueError, err:
+            self.warning("invalid value for %s/%s (%s), using default : %r", section, option, err, default)
+        return default
+
+    def _newBatchSizer(self, batch_size):
+        """return a BatchSizer starting at batch_size requests per call, which
+        stays at that size if adaptive batching is disabled"""
+        if not self._getSetting('batching', 'adaptive', self.config.getboolean, True):
+            return BatchSizer(initial=batch_size, minimum=batch_size, maximum=batch_size)
+        return BatchSizer(initial=batch_size,
+            minimum=self._getSetting('batching', 'min_batch', self.config.getint, 1),
+            maximum=self._getSetting('batching', 'max_batch', self.config.getint, 200),
+            target_latency=self._getSetting('batching', 'target_latency', self.config.getint, 2000) / 1000.0)
 
     def _getReasonFromEvent(self, event):
         if isinstance(event.data, basestring):
@@ -543,12 +986,122 @@ class MetabansPlugin(Plugin):
         """
         self.debug('checking %s (%s)', client, client.guid)
         try:
-            self._onMetabansResponse(client, self._metabans.check(client))
+            with span('check'):
+                response = self._metabans.check(client)
+            with span('handling'):
+                self._onMetabansResponse(client, response)
         except MetabansAuthenticationError:
             self.error("bad METABANS username or api_key. Disabling Metaban plugin")
             self.disable()
         except MetabansError, err:
-            self.error(err)
+            if err.code == 9:
+                self.debug("%s is unknown at Metabans.com", client.name)
+                if self._blacklist is not None:
+                    self._updateBlacklist(client.guid, None)
+            else:
+                self.error(err)
+
+    def _checkConnectedPlayers(self, stop):
+        """check and sight the players already connected when the plugin 
+        starts or is enabled again, many players per call to Metabans, until
+        stop is set. Calls are spaced out and wait for the pending player
+        checks so that live traffic goes first"""
+        stop.wait(self._sweep_delay)
+        if stop.isSet():
+            return
+        clients = [c for c in self.console.clients.getList() 
+                   if c.guid and not getattr(c, 'bot', False)]
+        if not clients:
+            return
+        self.info("checking %s connected players", len(clients))
+        for index, chunk in enumerate(batches(clients, self._sweep_players_per_call)):
+            if index:
+                stop.wait(self._sweep_interval)
+            self._waitForPlayerChecks(stop)
+            if stop.isSet() or not self.isEnabled():
+                return
+            try:
+                statuses = self._metabans.sight_many(chunk)
+            except Exception, err:
+                self.error("could not check connected players (%s)", err)
+                return
+            if not self._onMetabansStatuses(statuses):
+                return
+
+    def _recheckConnectedPlayers(self, stop):
+        """re-check connected players until stop is set so that bans issued
+        meanwhile, from another server of the account or inherited from
+        another account, apply without waiting for the players to reconnect. 
+        
+        Players whose status is still in the cache are skipped, so a player 
+        status is at most cache/ttl plus the re-check interval old"""
+        interval = self._recheck_interval
+        while not stop.isSet():
+            stop.wait(interval)
+            if stop.isSet() or not self.isEnabled():
+                continue
+            try:
+                calls, latency = self._recheckStalePlayers(stop)
+            except Exception, err:
+                self.error("could not re-check connected players (%s)", err)
+                interval = self._recheck_max_interval
+            else:
+                interval = recheck_interval(self._recheck_interval, self._recheck_max_interval,
+                                            calls, latency, self._recheck_sizer.target_latency)
+                if calls:
+                    self.debug("re-checked connected players in %s calls, next re-check in %0.0fs",
+                               calls, interval)
+
+    def _recheckStalePlayers(self, stop=None):
+        """check the connected players whose cached status expired, in as few
+        calls as the batch size allows, until stop is set. Return the number
+        of calls made and their mean duration"""
+        if stop is None:
+            stop = threading.Event()
+        clients = [c for c in self.console.clients.getList()
+                   if c.guid and not getattr(c, 'bot', False) and not self._metabans.is_fresh(c)]
+        calls = 0
+        duration = 0.0
+        for chunk in batches(clients, lambda: self._recheck_sizer.size):
+            self._waitForPlayerChecks(stop)
+            if stop.isSet():
+                break
+            started = time.time()
+            statuses = self._metabans.check_many(chunk, sizer=self._recheck_sizer)
+            duration += time.time() - started
+            calls += 1
+            if not self._onMetabansStatuses(statuses):
+                break
+        return calls, duration / calls if calls else 0.0
+
+    def _waitForPlayerChecks(self, stop, max_wait=10):
+        """wait for the workers to be done with the checks of connecting 
+        players, which go first, for at most max_wait seconds so that a 
+        steady flow of connections does not hold the caller forever, or
+        until stop is set"""
+        deadline = time.time() + max_wait
+        while self._workers.lane_length(PRIORITY_ENFORCEMENT) and time.time() < deadline \
+            and not stop.isSet():
+            stop.wait(0.1)
+
+    def _onMetabansStatuses(self, statuses):
+        """act on the (client, status) list of MetabansProxy.sight_many() or
+        check_many(). Return False if the plugin was disabled"""
+        for client, status in statuses:
+            if isinstance(status, MetabansAuthenticationError):
+                self.error("bad METABANS username or api_key. Disabling Metaban plugin")
+                self.disable()
+                return False
+            elif isinstance(status, MetabansException):
+                if status.code == 9:
+                    self.debug("%s is unknown at Metabans.com", client.name)
+                    if self._blacklist is not None:
+                        self._updateBlacklist(client.guid, None)
+                else:
+                    self.error(status)
+            else:
+                self._onMetabansResponse(client, status)
+        return True
 
     def _tellMetabansResponse(self, client, target_client, response):
         self.debug("response: %r", response)
@@ -577,7 +1130,14 @@ class MetabansPlugin(Plugin):
         else:
             client.message("no response from Metabans")
 
+    def _updateBlacklist(self, player_uid, assessment):
+        """refresh the local mirror with what Metabans told, unless our own
+        assessment of the player has not reached Metabans yet"""
+        self._blacklist.refresh(player_uid, assessment, self._outbox.has_assessment)
+
     def _onMetabansResponse(self, client, response):
+        if response and self._blacklist is not None:
+            self._updateBlacklist(client.guid, assessment_from_status(response))
         if response:
             if response['is_banned'] == True:
                 self.onMetabans_banned(client, reason=response['reason'], 
@@ -591,7 +1151,20 @@ class MetabansPlugin(Plugin):
 
 
     def onMetabans_banned(self, client, reason=None, inherited_blacklist=None):
-        client.kick(keyword="METABANS", silent=True, reason=reason)
+        now = time.time()
+        with self._kicked_lock:
+            if self._kicked.get(client.guid, 0) > now - KICK_DEBOUNCE_DELAY:
+                self.debug("%s was kicked already", client.name)
+                return
+            self._kicked[client.guid] = now
+            for guid, kick_time in self._kicked.items():
+                if kick_time <= now - KICK_DEBOUNCE_DELAY:
+                    del self._kicked[guid]
+        with span('kick'):
+            client.kick(keyword="METABANS", silent=True, reason=reason)
+        trace = current_trace()
+        if trace is not None:
+            trace.attributes['time_to_kick'] = time.time() - trace.start
         try:
             msg = self.getMessage('ban_message', 
                                   b3.parser.Parser.getMessageVariables(
@@ -763,7 +1336,7 @@ Usage:
             joe.auth()
 
         
-    def test_getAllActiveBans(): 
+    def test_iterActiveBans(): 
         p.disable()
         superadmin.connects(0)
         for i in range(1, 50):
@@ -775,7 +1348,7 @@ Usage:
             tmp.connects(i)
             superadmin.says('!permban test_permban_g%s test reason %s' % (i, i))
         p.enable()
-        for i in p._getAllActiveBans():
+        for i in p._iterActiveBans():
             print i
 
     def test_Command_sync(): 
@@ -796,6 +1369,6 @@ Usage:
     #test_ban_event()
     #test_tempban_event()
     #test_Command_sync()
-    #test_getAllActiveBans()
+    #test_iterActiveBans()
     test_tempban_expiration()
     time.sleep(60)
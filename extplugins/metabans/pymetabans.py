@@ -25,15 +25,40 @@
 #  * MetabansException now have two attributes : code and message
 # 2.1.1 - 2011-06-12
 #  * minor change to the salt and tests
+# 2.2 - 2026-10-18
+#  * HTTP requests are made over a pool of persistent keep-alive connections
+#  * add multi_query() and the request builders to send many requests at once
+#  * add fetch_time()
+#  * add Metabans.batch() to send many requests and get a result for each one
+#  * requests are no longer echoed back in responses unless asked for with the
+#    mirror option
+#  * add AsyncMetabans (see asyncmetabans.py) to run many calls on one thread
+#  * add iter_multi_query() and MetabansBatch.iter_send() which decode the
+#    responses one by one as the HTTP body arrives
+#  * full HTTP bodies are only logged at DEBUG level
+#  * responses can be compressed with gzip or deflate, and requests with gzip
+#    (see compress_requests)
+#  * HTTP calls go through a pluggable Transport
+#  * round-trip times, fetch times, errors, batch sizes and bytes of calls can
+#    be recorded (see the metrics parameter)
 #
 from hashlib import sha1
+from itertools import izip
+import httplib
 import logging
+import re
+import select
+import socket
+import threading
+import time
 import urllib
 import urllib2
+import urlparse
 import uuid
+import zlib
 '''A library that provides a Python interface to the Metabans API'''
 __author__  = 'courgette@bigbrotherbot.net'
-__version__ = '2.1.1'
+__version__ = '2.2'
 
 try:
     # Python >= 2.6
@@ -48,6 +73,9 @@ except ImportError:
 
 log = logging.getLogger('pymetabans')
 
+# size of the pieces a HTTP body is read by when streaming responses
+STREAM_CHUNK_SIZE = 8192
+
 """whenever the Metabans service answers with an error""" 
 class MetabansException(Exception):
     def __init__(self, value):
@@ -73,13 +101,578 @@ class Player:
         self.ip = ip
         self.alternate_uid = alternate_uid
         
+def player_status_request(game_name, player_uid):
+    """build the parameters of a mbo_player_status request"""
+    return {
+        'action': 'mbo_player_status',
+        'game_name': game_name,
+        'player_uid': player_uid,
+    }
+
+def sight_player_request(game_name, player, group_name=None):
+    """build the parameters of a mb_sight_player request for a Player"""
+    request = {
+        'action': 'mb_sight_player',
+        'game_name': game_name,
+        'player_uid': player.uid,
+        'player_name': player.name,
+    }
+    if group_name:
+        request['group_name'] = group_name
+    if player.ip:
+        request['player_ip'] = player.ip
+    if player.alternate_uid:
+        request['alternate_uid'] = player.alternate_uid
+    return request
+
+def assess_player_request(game_name, player_uid, assessment_type, 
+                          assessment_length=None, reason=None):
+    """build the parameters of a mb_assess_player request"""
+    request = {
+        'action': 'mb_assess_player',
+        'game_name': game_name,
+        'player_uid': player_uid,
+        'assessment_type': assessment_type,
+    }
+    if assessment_length:
+        request['assessment_length'] = int(assessment_length)
+    if reason:
+        request['reason'] = reason
+    return request
+
+def encode_requests(requests):
+    """flatten a sequence of requests into the requests[N][...] form 
+    parameters expected by the Metabans API"""
+    query_parameters = {}
+    for i, request in enumerate(requests):
+        for k, v in request.iteritems():
+            if isinstance(v, unicode):
+                v = v.encode('utf-8')
+            query_parameters['requests[%d][%s]' % (i, k)] = v
+    return query_parameters
+
+def parse_response(response):
+    """return the 'data' part of a single raw response or raise the 
+    MetabansException it describes"""
+    if 'status' in response and response['status'] == 'OK':
+        return response['data']
+    elif 'error' in response:
+        if 'code' in response['error'] and response['error']['code'] == 5:
+            raise MetabansAuthenticationError(response['error'])
+        else:
+            raise MetabansError(response['error'])
+    else:
+        raise MetabansException(response)
+
+def fetch_time(response):
+    """return the time in seconds Metabans reports it took to process the 
+    request of a raw response, 0 if unknown"""
+    try:
+        return float(response['fetch_time'].rstrip(' s'))
+    except (KeyError, AttributeError, ValueError):
+        return 0.0
+
+
+def call_label(requests):
+    """return the action of the requests of a call, or 'mixed' if they are 
+    not all of the same action"""
+    actions = set(request.get('action') for request in requests)
+    if len(actions) == 1:
+        return actions.pop()
+    return 'mixed'
+
+
+_reResponsesStart = re.compile(r'"responses"\s*:\s*\[')
+_reSeparator = re.compile(r'[\s,]*')
+_reStructural = re.compile(r'[{}\[\]"]')
+_reStringSpecial = re.compile(r'["\\]')
+
+
+class _ElementScanner(object):
+    """find the end of a JSON object or array given in pieces, looking at
+    each character only once"""
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, data, pos=0):
+        """scan data from pos and return the offset just after the end of
+        the element, or None if the element goes on after data"""
+        while pos < len(data):
+            if self.escaped:
+                self.escaped = False
+                pos += 1
+                continue
+            if self.in_string:
+                match = _reStringSpecial.search(data, pos)
+                if match is None:
+                    return None
+                pos = match.end()
+                if match.group() == '\\':
+                    self.escaped = True
+                else:
+                    self.in_string = False
+                continue
+            match = _reStructural.search(data, pos)
+            if match is None:
+                return None
+            pos = match.end()
+            char = match.group()
+            if char == '"':
+                self.in_string = True
+            elif char in '{[':
+                self.depth += 1
+            else:
+                self.depth -= 1
+                if self.depth == 0:
+                    return pos
+        return None
+
+
+def iter_responses(chunks):
+    """decode the raw responses of the 'responses' array of a JSON HTTP body
+    one by one, as the chunks of the body come from the chunks iterable.
+
+    The chunks of a response are only joined once the response is complete,
+    so that big responses coming in many chunks are decoded in linear time"""
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buf = ''
+    while True:
+        match = _reResponsesStart.search(buf)
+        if match:
+            pos = match.end()
+            break
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise ValueError("no responses found in %s" % abbreviate(buf))
+        buf += chunk
+    while True:
+        pos = _reSeparator.match(buf, pos).end()
+        if pos == len(buf):
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise ValueError("truncated responses")
+            buf, pos = chunk, 0
+            continue
+        if buf[pos] == ']':
+            # read the end of the body so the connection can be reused
+            for chunk in chunks:
+                pass
+            return
+        if buf[pos] not in '{[':
+            raise ValueError("unexpected response : %s" % abbreviate(buf[pos:]))
+        scanner = _ElementScanner()
+        end = scanner.feed(buf, pos)
+        if end is None:
+            pieces = [buf[pos:]]
+            while end is None:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    raise ValueError("truncated responses : %s" % abbreviate(''.join(pieces)))
+                pieces.append(chunk)
+                end = scanner.feed(chunk)
+            end += sum(len(piece) for piece in pieces[:-1])
+            buf, pos = ''.join(pieces), 0
+        response, pos = decoder.raw_decode(buf, pos)
+        yield response
+
+def gzip_compress(data, level=6):
+    """return data compressed in the gzip format"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def decompress_chunks(chunks, encoding):
+    """yield the decoded chunks of a HTTP body sent with the given 
+    Content-Encoding"""
+    encoding = (encoding or 'identity').strip().lower()
+    if encoding == 'identity':
+        for chunk in chunks:
+            yield chunk
+        return
+    if encoding not in ('gzip', 'x-gzip', 'deflate'):
+        raise ValueError("unsupported content encoding : %r" % encoding)
+    decompressor = None
+    head = ''
+    for chunk in chunks:
+        if decompressor is None:
+            head += chunk
+            if len(head) < 2:
+                continue
+            decompressor = _decompressor(encoding, head)
+            chunk, head = head, None
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    if decompressor is None:
+        if not head:
+            return
+        # the whole body is shorter than a zlib header
+        decompressor = _decompressor(encoding, head)
+        data = decompressor.decompress(head)
+        if data:
+            yield data
+    data = decompressor.flush()
+    if data:
+        yield data
+
+def _decompressor(encoding, head):
+    """return the zlib decompressor for a body with the given
+    Content-Encoding starting with head"""
+    if encoding != 'deflate':
+        wbits = 16 + zlib.MAX_WBITS
+    elif len(head) >= 2 and (ord(head[0]) & 0x0f) == 8 \
+        and ((ord(head[0]) << 8) + ord(head[1])) % 31 == 0:
+        # zlib wrapped deflate stream
+        wbits = zlib.MAX_WBITS
+    else:
+        # some servers send raw deflate streams
+        wbits = -zlib.MAX_WBITS
+    return zlib.decompressobj(wbits)
+
+def abbreviate(data, limit=200):
+    """return the repr of the first limit characters of data, without
+    building the repr of the whole data"""
+    if len(data) <= limit:
+        return repr(data)
+    return "%s... (%s characters)" % (repr(data[:limit]), len(data))
+
+
+class MetabansResult(object):
+    """Outcome of a single request of a MetabansBatch
+    
+           request : the dict of request parameters
+              data : the 'data' part of the response, None on error
+             error : the MetabansException describing the failure, or None
+        fetch_time : time in seconds Metabans took to process the request
+        
+    """
+    def __init__(self, request, response):
+        self.request = request
+        self.data = None
+        self.error = None
+        if response is None:
+            self.fetch_time = 0.0
+            self.error = MetabansException("no response for request %r" % (request,))
+        elif 'request' in response and response['request'].get('action') != self.action:
+            self.fetch_time = 0.0
+            self.error = MetabansException("response %r does not match request %r" % (response, request))
+        else:
+            self.fetch_time = fetch_time(response)
+            try:
+                self.data = parse_response(response)
+            except MetabansException, err:
+                self.error = err
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def action(self):
+        return self.request.get('action')
+
+    def get(self):
+        """return the data of the response or raise its MetabansException"""
+        if self.error is not None:
+            raise self.error
+        return self.data
+
+    def __repr__(self):
+        if self.ok:
+            return "MetabansResult(%s, data=%r)" % (self.action, self.data)
+        return "MetabansResult(%s, error=%s)" % (self.action, self.error)
+
+
+class MetabansBatch(object):
+    """Requests to send to Metabans in a single call.
+    
+        Each method adding a request returns the index of its result in the 
+        list send() returns. A request the Metabans service rejects does not
+        fail the others, its MetabansResult holds the error instead.
+        
+    """
+    def __init__(self, metabans):
+        self._metabans = metabans
+        self.requests = []
+
+    def __len__(self):
+        return len(self.requests)
+
+    def add(self, request):
+        """add a dict of request parameters"""
+        self.requests.append(request)
+        return len(self.requests) - 1
+
+    def sight(self, game_name, player, group_name=None):
+        return self.add(sight_player_request(game_name, player, group_name))
+
+    def status(self, game_name, player_uid):
+        return self.add(player_status_request(game_name, player_uid))
+
+    def assess(self, game_name, player_uid, assessment_type, 
+               assessment_length=None, reason=None):
+        return self.add(assess_player_request(game_name, player_uid, assessment_type,
+                                              assessment_length, reason))
+
+    def send(self, mirror=None, profiler=None):
+        """send all the requests in a single call and return the list of their
+        MetabansResult, in the order the requests were added. 
+        
+        See Metabans.multi_query() for mirror and profiler"""
+        return self.results(self._metabans.multi_query(self.requests, mirror, profiler))
+
+    def results(self, responses):
+        """match raw responses with the requests, by position"""
+        responses = list(responses)
+        responses.extend([None] * (len(self.requests) - len(responses)))
+        return [MetabansResult(request, response) 
+                for request, response in zip(self.requests, responses)]
+
+    def iter_send(self, mirror=None, profiler=None):
+        """like send() but yield each MetabansResult as soon as its response is
+        decoded, without holding the whole HTTP body in memory"""
+        responses = self._metabans.iter_multi_query(self.requests, mirror, profiler)
+        count = 0
+        for request, response in izip(self.requests, responses):
+            count += 1
+            yield MetabansResult(request, response)
+        for response in responses:
+            pass
+        for request in self.requests[count:]:
+            yield MetabansResult(request, None)
+
+
+class Transport(object):
+    """How calls reach the Metabans service.
+    
+        Metabans hands the url-encoded body of each call to the post_stream()
+        method of its transport, so that calls can go through something else
+        than HTTP connections made by urllib2.
+        
+    """
+    def post_stream(self, body, headers, wire=None):
+        """POST body with the given headers and yield the response body in
+        chunks as it arrives, decompressed if needed. Raise urllib2.HTTPError
+        if the HTTP status is not 200.
+        
+        If wire is given, wire['received'] is increased by the size of the
+        response body as read from the connection, before decompression"""
+        raise NotImplementedError
+
+    def close(self):
+        """release the resources held by the transport"""
+        pass
+
+
+class Urllib2Transport(Transport):
+    """Transport opening a new urllib2 connection for each call, which fails
+    with socket.timeout when the server does not answer within `timeout`
+    seconds"""
+    def __init__(self, url, timeout=30):
+        self.url = url
+        self.timeout = timeout
+
+    def post_stream(self, body, headers, wire=None, chunk_size=STREAM_CHUNK_SIZE):
+        req =  urllib2.Request(self.url, headers=headers)
+        opener = urllib2.build_opener(urllib2.HTTPHandler(debuglevel=0))
+        fp = opener.open(req, body, self.timeout)
+        def read():
+            while True:
+                chunk = fp.read(chunk_size)
+                if not chunk:
+                    return
+                if wire is not None:
+                    wire['received'] += len(chunk)
+                yield chunk
+        try:
+            for chunk in decompress_chunks(read(), fp.info().getheader('Content-Encoding')):
+                yield chunk
+        finally:
+            fp.close()
+
+
+def _is_dropped(conn):
+    """whether an idle connection was closed by the server. Nothing is to be
+    read from an idle connection but the end of the stream"""
+    if conn.sock is None:
+        return True
+    try:
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+    except (select.error, socket.error, ValueError):
+        return True
+    return bool(readable)
+
+
+class HTTPConnectionPool(Transport):
+    """Thread-safe pool of persistent HTTP/1.1 connections to a single URL.
+    
+        At most `size` idle connections are kept and an idle connection is 
+        discarded after `idle_timeout` seconds. Under load, extra connections
+        are opened as needed and closed once released. A call fails with
+        socket.timeout when the server does not answer within `timeout`
+        seconds.
+        
+    """
+    def __init__(self, url, size=4, idle_timeout=30, timeout=30):
+        self.url = url
+        parts = urlparse.urlsplit(url)
+        if parts.scheme == 'https':
+            self._connection_class = httplib.HTTPSConnection
+        else:
+            self._connection_class = httplib.HTTPConnection
+        self._host = parts.hostname
+        self._port = parts.port
+        self._path = parts.path or '/'
+        if parts.query:
+            self._path += '?' + parts.query
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def post(self, body, headers):
+        """POST body to the pooled URL and return the response body.
+        
+        Idle connections closed by the server are discarded before use. If a
+        reused connection fails while the request is being sent, the request
+        is sent again over a new connection. It is never sent again once it
+        was sent entirely, as Metabans may have processed it already.
+        """
+        return ''.join(self.post_stream(body, headers))
+
+    def post_stream(self, body, headers, wire=None, chunk_size=STREAM_CHUNK_SIZE):
+        """like post() but yield the response body in chunks as it arrives,
+        decompressed if needed.
+        
+        The connection goes back to the pool once the body has been read
+        entirely. See Transport.post_stream() for wire.
+        """
+        conn, response = self._request(body, headers)
+        def read():
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    return
+                if wire is not None:
+                    wire['received'] += len(chunk)
+                yield chunk
+        complete = False
+        try:
+            for chunk in decompress_chunks(read(), response.getheader('Content-Encoding')):
+                yield chunk
+            complete = True
+        finally:
+            if complete and not response.will_close:
+                self._release(conn)
+            else:
+                conn.close()
+
+    def _request(self, body, headers):
+        """send the request and return a (connection, response) tuple once the
+        response headers are received"""
+        while True:
+            conn, reused = self._acquire()
+            try:
+                conn.request('POST', self._path, body, headers)
+            except (httplib.HTTPException, socket.error), err:
+                conn.close()
+                if reused:
+                    # the request did not get through
+                    log.debug("kept-alive connection is gone (%r), reconnecting", err)
+                    continue
+                raise
+            try:
+                response = conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                raise
+            if response.status != 200:
+                response.read()
+                if response.will_close:
+                    conn.close()
+                else:
+                    self._release(conn)
+                raise urllib2.HTTPError(self.url, response.status, response.reason,
+                                        response.msg, None)
+            return conn, response
+
+    def close(self):
+        """close all idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, last_used in idle:
+            conn.close()
+
+    def _acquire(self):
+        """return a (connection, reused) tuple"""
+        now = time.time()
+        with self._lock:
+            while self._idle:
+                conn, last_used = self._idle.pop()
+                if now - last_used < self.idle_timeout and not _is_dropped(conn):
+                    return conn, True
+                conn.close()
+        return self._connection_class(self._host, self._port, timeout=self.timeout), False
+
+    def _release(self, conn):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((conn, time.time()))
+                return
+        conn.close()
+
+
 class Metabans(object):
     def __init__(self, username=None, apikey=None, user_agent='pymetabans', 
-                 url="http://metabans.com/api"):
+                 url="http://metabans.com/api", keep_alive=True, pool_size=4,
+                 pool_idle_timeout=30, mirror=False, profiler=True,
+                 compress_requests=False, compress_min_size=1024, transport=None,
+                 metrics=None, timeout=30):
+        """
+              keep_alive : if True, reuse HTTP connections between requests.
+                           If False, a new connection is made for each request
+               pool_size : maximum number of idle connections to keep 
+       pool_idle_timeout : time in seconds after which an idle connection is
+                           closed
+                  mirror : if True, Metabans echoes each request back in its
+                           response. Responses are matched with requests by
+                           position anyway
+                profiler : if True, Metabans tells how long it took to process
+                           each request (see fetch_time())
+       compress_requests : if True, gzip the requests of at least 
+                           compress_min_size bytes. Compression is turned off
+                           if the Metabans service rejects a compressed request
+               transport : the Transport calls go through. By default a 
+                           HTTPConnectionPool if keep_alive is True, or a
+                           Urllib2Transport otherwise
+                 metrics : a metrics.Metrics recording each call and response.
+                           Nothing is recorded if None
+                 timeout : time in seconds after which a call the Metabans
+                           service does not answer fails with socket.timeout
+                           
+        Responses are compressed with gzip or deflate whenever the Metabans
+        service supports it.
+        """
         self._service_url = url
         self._user_agent = user_agent
         self.username = username
         self.apikey = apikey
+        self.mirror = mirror
+        self.profiler = profiler
+        self.compress_requests = compress_requests
+        self.compress_min_size = compress_min_size
+        self.metrics = metrics
+        if transport is not None:
+            self.transport = transport
+        elif keep_alive:
+            self.transport = HTTPConnectionPool(url, size=pool_size, 
+                                                idle_timeout=pool_idle_timeout,
+                                                timeout=timeout)
+        else:
+            self.transport = Urllib2Transport(url, timeout=timeout)
 
 
     def mbo_player_status(self, game_name, player_uid):
@@ -89,24 +682,15 @@ class Metabans(object):
             player_uid : a Player identifier
             
         """
-        query_parameters = {}
-        query_parameters['requests[0][action]'] = 'mbo_player_status'
-        query_parameters['requests[0][game_name]'] = game_name
-        query_parameters['requests[0][player_uid]'] = player_uid
-        return self._query(query_parameters)
+        return self._query([player_status_request(game_name, player_uid)])
 
 
     def mbo_availability_account_name(self, usernames):
         """Ask Metabans for a usernames availability"""
         if isinstance(usernames, basestring):
             usernames = (usernames,)
-        query_parameters = {}
-        i = 0
-        for name in usernames:
-            query_parameters['requests[%s][action]' % i] = 'mbo_availability_account_name'
-            query_parameters['requests[%s][account_name]' % i] = name
-            i += 1
-        return self._query(query_parameters)
+        return self._query([{'action': 'mbo_availability_account_name', 'account_name': name} 
+                            for name in usernames])
 
 
     def mb_sight_player(self, game_name, players,  group_name=None):
@@ -122,22 +706,7 @@ class Metabans(object):
         """
         if isinstance(players, Player):
             players = (players, )
-        i = 0
-        query_parameters = {}
-        for _p in players:
-            query_parameters['requests[%s][action]' % i] = 'mb_sight_player'
-            query_parameters['requests[%s][game_name]' % i] = game_name
-            if group_name:
-                query_parameters['requests[%s][group_name]' % i] = group_name
-            # now player info :
-            query_parameters['requests[%s][player_uid]' % i] = _p.uid
-            query_parameters['requests[%s][player_name]' % i] = _p.name
-            if _p.ip:
-                query_parameters['requests[%s][player_ip]' % i] = _p.ip
-            if _p.alternate_uid:
-                query_parameters['requests[%s][alternate_uid]' % i] = _p.alternate_uid
-            i += 1
-        return self._query(query_parameters)
+        return self._query([sight_player_request(game_name, _p, group_name) for _p in players])
 
 
     def mb_assess_player(self, game_name, player_uid, assessment_type, 
@@ -155,20 +724,54 @@ class Metabans(object):
                             allow for easier grouping of ban types
             
         """
-        query_parameters = {}
-        query_parameters['requests[0][action]'] = 'mb_assess_player'
-        query_parameters['requests[0][game_name]'] = game_name
-        # now player info :
-        query_parameters['requests[0][player_uid]'] = player_uid
-        query_parameters['requests[0][assessment_type]'] = assessment_type
-        if assessment_length:
-            query_parameters['requests[0][assessment_length]'] = int(assessment_length)
-        if reason:
-            query_parameters['requests[0][reason]'] = reason
-        return self._query(query_parameters)
-
-
-    def _query(self, parameters):
+        return self._query([assess_player_request(game_name, player_uid, assessment_type,
+                                                  assessment_length, reason)])
+
+
+    def batch(self):
+        """return a new MetabansBatch to build and send many typed requests
+        at once"""
+        return MetabansBatch(self)
+
+
+    def multi_query(self, requests, mirror=None, profiler=None):
+        """Send many requests to the Metabans service in a single call
+        
+              requests : a sequence of dict of request parameters, each one 
+                         having at least an 'action' key
+       mirror/profiler : override the options given to the constructor for
+                         this call
+        
+        Return the list of the raw responses, in the same order as requests.
+        Use parse_response() to get the data out of a raw response.
+        """
+        return self._send(list(requests), self._options(mirror, profiler))
+
+
+    def iter_multi_query(self, requests, mirror=None, profiler=None):
+        """like multi_query() but yield each raw response as soon as it is 
+        decoded from the HTTP body"""
+        requests = list(requests)
+        parameters = self._query_parameters(encode_requests(requests), 
+                                            self._options(mirror, profiler))
+        received = {'responses': 0, 'bytes': 0}
+        def counted(chunks):
+            for chunk in chunks:
+                received['bytes'] += len(chunk)
+                yield chunk
+        debug = log.isEnabledFor(logging.DEBUG)
+        chunks = self._post_stream(urllib.urlencode(parameters), requests)
+        for response in iter_responses(counted(chunks)):
+            if debug:
+                log.debug('received : %r', response)
+            if received['responses'] < len(requests):
+                self._observe_response(requests[received['responses']], response)
+            received['responses'] += 1
+            yield response
+        log.info('received %(responses)s responses (%(bytes)s bytes)', received)
+
+
+    def _query(self, requests):
         """Make the HTTP request to the Metabans service and decode the json
         response. 
         
@@ -177,7 +780,45 @@ class Metabans(object):
         
         If we have multiples responses, then raw json response is returned
         """
-        query_parameters = {'options': 'mirror,json,profiler'}
+        return self._unwrap(self._send(requests))
+
+
+    def _unwrap(self, responses):
+        """return the raw responses if there are many, or the 'data' part of 
+        the single response"""
+        if len(responses) > 1:
+            return responses
+        else:
+            log.debug("responses[0]: %r", responses[0])
+            return parse_response(responses[0])
+
+
+    def _send(self, requests, options=None):
+        """Make the HTTP request to the Metabans service and return the list of
+        raw responses"""
+        parameters = self._query_parameters(encode_requests(requests), options)
+        responses = self._decode(self._post(urllib.urlencode(parameters), requests))
+        for request, response in izip(requests, responses):
+            self._observe_response(request, response)
+        return responses
+
+
+    def _options(self, mirror=None, profiler=None):
+        """return the value of the options parameter of a call"""
+        options = ['json']
+        if self.mirror if mirror is None else mirror:
+            options.insert(0, 'mirror')
+        if self.profiler if profiler is None else profiler:
+            options.append('profiler')
+        return ','.join(options)
+
+
+    def _query_parameters(self, parameters, options=None):
+        """return the parameters of a call, along with the options and the
+        salted credentials"""
+        if options is None:
+            options = self._options()
+        query_parameters = {'options': options}
         if self.username and self.apikey:
             query_parameters['username'] = self.username
             myUuid = uuid.uuid4().hex
@@ -187,30 +828,96 @@ class Metabans(object):
         for k,v in parameters.iteritems():
             query_parameters[k] = v
         log.debug("querying %s with %r", self._service_url, query_parameters)
-        data = urllib.urlencode(query_parameters)
-        req =  urllib2.Request(self._service_url, headers={'User-Agent': self._user_agent})
-        opener = urllib2.build_opener(urllib2.HTTPHandler(debuglevel=0))
-        fp = opener.open(req, data)
+        return query_parameters
+
+
+    def _decode(self, http_body):
+        """return the list of raw responses from a HTTP body"""
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('received : %r', http_body)
+        elif log.isEnabledFor(logging.INFO):
+            log.info('received %s bytes : %s', len(http_body), abbreviate(http_body))
+        return json.loads(http_body)['responses']
+
+
+    def _observe_response(self, request, response):
+        if self.metrics is not None:
+            self.metrics.observe_response(request.get('action'), response,
+                                          fetch_time(response) if 'fetch_time' in response else None)
+
+
+    def _post(self, data, requests=()):
+        """send data to the Metabans service and return the HTTP body"""
+        return ''.join(self._post_stream(data, requests))
+
+
+    def _post_stream(self, data, requests=()):
+        """send data to the Metabans service and yield the HTTP body in chunks
+        as it arrives. The call is recorded in metrics as a call of those
+        requests"""
+        if self.metrics is None:
+            return self._post_chunks(data, None)
+        return self._measured_post_stream(data, requests)
+
+
+    def _measured_post_stream(self, data, requests):
+        wire = {'sent': 0, 'received': 0}
+        started = time.time()
+        error = None
         try:
-            http_body = fp.read()
-            log.info('received : %r', http_body)
-            responses = json.loads(http_body)['responses']
-            if len(responses) > 1:
-                return responses
-            else:
-                response = responses[0]
-                log.debug("responses[0]: %r", response)
-                if 'status' in response and response['status'] == 'OK':
-                    return response['data']
-                elif 'error' in response:
-                    if 'code' in response['error'] and response['error']['code'] == 5:
-                        raise MetabansAuthenticationError(response['error'])
-                    else:
-                        raise MetabansError(response['error'])
-                else:
-                    raise MetabansException(response)
+            for chunk in self._post_chunks(data, wire):
+                yield chunk
+        except Exception, err:
+            error = err
+            raise
         finally:
-            fp.close()
+            # also recorded when the consumer stops reading the body early
+            self.metrics.observe_call(call_label(requests), len(requests), time.time() - started,
+                                      wire['sent'], wire['received'], error=error)
+
+
+    def _post_chunks(self, data, wire):
+        """yield the HTTP body of the call in chunks. If wire is not None,
+        set wire['sent'] to the size of the request body actually sent and
+        count the bytes of the response body in wire['received'], both as
+        they go over the connection"""
+        headers = {
+            'User-Agent': self._user_agent,
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'Accept-Encoding': 'gzip, deflate',
+        }
+        if self.compress_requests and len(data) >= self.compress_min_size:
+            compressed = gzip_compress(data)
+            log.debug("request compressed from %s to %s bytes", len(data), len(compressed))
+            if wire is not None:
+                wire['sent'] = len(compressed)
+            chunks = self.transport.post_stream(compressed, dict(headers, **{'Content-Encoding': 'gzip'}),
+                                                wire)
+            try:
+                # the request is made when the first chunk is asked for
+                first = next(chunks, None)
+            except urllib2.HTTPError, err:
+                if err.code not in (400, 411, 415):
+                    raise
+                log.warning("Metabans rejected a compressed request (HTTP %s), "
+                            "sending uncompressed requests from now on", err.code)
+                self.compress_requests = False
+            else:
+                if first is not None:
+                    yield first
+                for chunk in chunks:
+                    yield chunk
+                return
+        if wire is not None:
+            wire['sent'] = len(data)
+        for chunk in self.transport.post_stream(data, headers, wire):
+            yield chunk
+
+
+    def close(self):
+        """release the resources held by the transport, such as kept-alive 
+        connections"""
+        self.transport.close()
 
 
 if __name__ == '__main__':
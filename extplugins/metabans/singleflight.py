@@ -0,0 +1,70 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+import threading
+'''Share the result of a call among the threads making the same call at the
+same time'''
+
+
+class _Call(object):
+    def __init__(self):
+        self.result = None
+        self.exception = None
+        self.done = threading.Event()
+
+
+class SingleFlight(object):
+    """Make sure only one call per key is in flight.
+
+    Threads calling do() with a key for which a call is already running wait
+    for that call and get its result (or exception) instead of making their
+    own.
+    """
+    def __init__(self):
+        self.shared = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    @property
+    def in_flight(self):
+        """number of calls currently running"""
+        return len(self._calls)
+
+    def do(self, key, func, *args):
+        """return func(*args), unless a call for key is already running in
+        which case its result is returned"""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                leader = True
+            else:
+                self.shared += 1
+                leader = False
+        if not leader:
+            call.done.wait()
+            if call.exception:
+                raise call.exception
+            return call.result
+        try:
+            call.result = func(*args)
+            return call.result
+        except Exception, err:
+            call.exception = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
@@ -0,0 +1,178 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+import logging
+import sys
+import threading
+import time
+import uuid
+'''Lightweight tracing of the stages a B3 event goes through, from its
+arrival to the action taken on the player'''
+
+try:
+    # Python >= 2.6
+    import json
+except ImportError:
+    # Python < 2.6
+    import simplejson as json
+
+log = logging.getLogger('pymetabans')
+
+_local = threading.local()
+
+
+def new_trace_id():
+    return uuid.uuid4().hex[:16]
+
+
+def current_trace():
+    """return the Trace activated in this thread, or None"""
+    return getattr(_local, 'trace', None)
+
+
+def add_span(name, start, end=None):
+    """add a span to the Trace activated in this thread, if any"""
+    trace = current_trace()
+    if trace is not None:
+        trace.add_span(name, start, end)
+
+
+@contextmanager
+def span(name):
+    """record the time the with block takes as a span of the Trace activated
+    in this thread, if any"""
+    trace = current_trace()
+    if trace is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        trace.add_span(name, start)
+
+
+class Trace(object):
+    """Timeline of a single event, made of named spans.
+
+           name : what is traced, such as 'client_auth'
+       trace_id : identifier of the trace, generated if not given
+     attributes : what the event is about, such as the player guid
+    """
+    def __init__(self, name, trace_id=None, **attributes):
+        self.name = name
+        self.trace_id = trace_id or new_trace_id()
+        self.attributes = attributes
+        self.start = time.time()
+        self.end = None
+        self.spans = []
+
+    def add_span(self, name, start, end=None):
+        if end is None:
+            end = time.time()
+        self.spans.append((name, start, end))
+
+    @property
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+    @contextmanager
+    def activated(self):
+        """make this trace the current one of the thread for the with block"""
+        previous = current_trace()
+        _local.trace = self
+        try:
+            yield self
+        finally:
+            _local.trace = previous
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'start': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.start))
+                     + '.%03d' % (self.start % 1 * 1000),
+            'duration_ms': round(self.duration * 1000, 3),
+            'attributes': self.attributes,
+            'spans': [{'name': name,
+                       'start_ms': round((start - self.start) * 1000, 3),
+                       'duration_ms': round((end - start) * 1000, 3)}
+                      for name, start, end in sorted(self.spans, key=lambda s: s[1])],
+        }
+
+    def __repr__(self):
+        return "Trace(%s %s, %0.1fms, %s spans)" % (self.name, self.trace_id,
+                                                     self.duration * 1000, len(self.spans))
+
+
+class _TraceFileHandler(RotatingFileHandler):
+    """write slow traces to a file of bounded size, logging write errors"""
+    def handleError(self, record):
+        log.warning("cannot write trace to %s (%s)", self.baseFilename, sys.exc_info()[1])
+
+
+class Tracer(object):
+    """Start and finish traces, writing the slow ones to a file.
+
+      slow_threshold : time in seconds above which a finished trace is
+                       written to path
+                path : file slow traces are appended to, as one JSON object
+                       per line. Slow traces are only logged if None
+           max_bytes : size in bytes above which path is rotated
+        backup_count : number of rotated files kept, as path.1, path.2...
+             metrics : a metrics.Metrics recording the duration of every
+                       trace, and the time taken to kick players
+    """
+    def __init__(self, slow_threshold=1.0, path=None, metrics=None,
+                 max_bytes=1024 * 1024, backup_count=3):
+        self.slow_threshold = slow_threshold
+        self.path = path
+        self.metrics = metrics
+        self.slow = 0
+        self._lock = threading.Lock()
+        self._handler = None
+        if path is not None:
+            self._handler = _TraceFileHandler(path, maxBytes=max_bytes,
+                                              backupCount=backup_count, delay=True)
+            self._handler.setFormatter(logging.Formatter('%(message)s'))
+
+    def close(self):
+        """close the file slow traces are written to"""
+        if self._handler is not None:
+            self._handler.close()
+
+    def start(self, name, **attributes):
+        return Trace(name, **attributes)
+
+    def finish(self, trace):
+        trace.end = time.time()
+        if self.metrics is not None:
+            self.metrics.observe('trace_seconds', trace.duration, trace=trace.name)
+            if 'time_to_kick' in trace.attributes:
+                self.metrics.observe('time_to_kick_seconds', trace.attributes['time_to_kick'])
+        if trace.duration >= self.slow_threshold:
+            with self._lock:
+                self.slow += 1
+            self._export(trace)
+
+    def _export(self, trace):
+        data = trace.to_dict()
+        log.info("slow trace %s %s took %sms : %s", trace.name, trace.trace_id, data['duration_ms'],
+                 ', '.join('%(name)s %(duration_ms)sms' % s for s in data['spans']))
+        if self._handler is None:
+            return
+        self._handler.handle(logging.makeLogRecord({'msg': json.dumps(data)}))
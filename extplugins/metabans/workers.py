@@ -0,0 +1,151 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+from collections import deque
+import logging
+import threading
+'''Fixed size pool of worker threads fed by a bounded priority queue'''
+
+log = logging.getLogger('pymetabans')
+
+# job priorities, lower runs first
+PRIORITY_ENFORCEMENT = 0    # checks which can lead to a kick
+PRIORITY_ASSESSMENT = 1     # bans and unbans to send to Metabans
+PRIORITY_SIGHTING = 2       # routine sightings
+PRIORITIES = (PRIORITY_ENFORCEMENT, PRIORITY_ASSESSMENT, PRIORITY_SIGHTING)
+
+# what to do when a job is submitted while the queue is full
+OVERFLOW_BLOCK = 'block'            # wait for room in the queue
+OVERFLOW_DROP_NEW = 'drop_new'      # discard the submitted job
+OVERFLOW_DROP_OLDEST = 'drop_oldest'  # discard the oldest queued job
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_NEW, OVERFLOW_DROP_OLDEST)
+
+
+class WorkerPool(object):
+    """Run jobs on a fixed number of threads, highest priority jobs first.
+
+                  workers : number of worker threads
+         reserved_workers : number of workers that only run 
+                            PRIORITY_ENFORCEMENT jobs, so that enforcement
+                            never waits for a backlog of lower priority jobs
+               queue_size : maximum number of jobs waiting for a worker
+                 overflow : one of OVERFLOW_POLICIES. Whatever the policy, a
+                            job is first made room for by discarding a queued
+                            job of lower priority
+    """
+    def __init__(self, workers=4, queue_size=200, overflow=OVERFLOW_DROP_OLDEST,
+                 reserved_workers=1, name='metabans-worker'):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("unknown overflow policy %r" % overflow)
+        if workers < 1:
+            raise ValueError("at least one worker is needed, got %r" % workers)
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self._size = workers
+        # at least one worker is left for lower priority jobs
+        self.reserved_workers = max(0, min(reserved_workers, workers - 1))
+        self.dropped = 0
+        self._lanes = dict((priority, deque()) for priority in PRIORITIES)
+        self._active = 0
+        self._active_low = 0
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self._run, name='%s-%s' % (name, i))
+            t.setDaemon(True)
+            t.start()
+            self._threads.append(t)
+
+    @property
+    def workers(self):
+        """number of worker threads"""
+        return self._size
+
+    @property
+    def active_workers(self):
+        """number of workers currently running a job"""
+        return self._active
+
+    @property
+    def queue_length(self):
+        """number of jobs waiting for a worker"""
+        return sum(len(lane) for lane in self._lanes.itervalues())
+
+    def lane_length(self, priority):
+        """number of jobs of the given priority waiting for a worker"""
+        return len(self._lanes[priority])
+
+    def submit(self, priority, func, *args):
+        """queue a call to func(*args) with the given priority.
+
+        Return False if the job was discarded because the queue is full
+        """
+        with self._lock:
+            if self.queue_length >= self.queue_size:
+                lowest = max(PRIORITIES, key=lambda p: (len(self._lanes[p]) > 0, p))
+                if lowest > priority:
+                    self._lanes[lowest].popleft()
+                    self.dropped += 1
+                elif self.overflow == OVERFLOW_DROP_NEW \
+                    or (self.overflow == OVERFLOW_DROP_OLDEST and lowest < priority):
+                    self.dropped += 1
+                    return False
+                elif self.overflow == OVERFLOW_DROP_OLDEST:
+                    self._lanes[lowest].popleft()
+                    self.dropped += 1
+                else:
+                    while self.queue_length >= self.queue_size:
+                        self._not_full.wait()
+            self._lanes[priority].append((func, args))
+            self._not_empty.notify_all()
+        return True
+
+    def _next_job(self):
+        """return the next (priority, func, args) job a worker can run or None.
+        Must be called with the lock held"""
+        for priority in PRIORITIES:
+            if self._lanes[priority]:
+                if priority != PRIORITY_ENFORCEMENT \
+                    and self._active_low >= self.workers - self.reserved_workers:
+                    return None
+                func, args = self._lanes[priority].popleft()
+                return priority, func, args
+        return None
+
+    def _run(self):
+        while True:
+            with self._lock:
+                job = self._next_job()
+                while job is None:
+                    self._not_empty.wait()
+                    job = self._next_job()
+                priority, func, args = job
+                self._active += 1
+                if priority != PRIORITY_ENFORCEMENT:
+                    self._active_low += 1
+                self._not_full.notify()
+            try:
+                func(*args)
+            except Exception:
+                log.exception("error while running %r", func)
+            finally:
+                with self._lock:
+                    self._active -= 1
+                    if priority != PRIORITY_ENFORCEMENT:
+                        self._active_low -= 1
+                        # a worker may be waiting for a low priority slot
+                        self._not_empty.notify_all()
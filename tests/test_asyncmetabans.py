@@ -0,0 +1,139 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+from asyncmetabans import AsyncMetabans, MetabansFuture, coroutine
+from fakemetabans import FakeMetabans, FakeMetabansServer
+from pymetabans import MetabansError, Player
+import socket
+import time
+import unittest
+
+
+class Test_coroutine(unittest.TestCase):
+    def test_results_are_sent_back(self):
+        first = MetabansFuture()
+        second = MetabansFuture()
+        @coroutine
+        def add():
+            a = yield first
+            b = yield second
+            yield a + b
+        future = add()
+        self.assertFalse(future.done())
+        first.set_result(1)
+        self.assertFalse(future.done())
+        second.set_result(2)
+        self.assertEqual(3, future.result())
+
+    def test_done_future(self):
+        done = MetabansFuture()
+        done.set_result('x')
+        @coroutine
+        def echo():
+            value = yield done
+            yield value
+        self.assertEqual('x', echo().result())
+
+    def test_exception_is_raised_in_the_generator(self):
+        failing = MetabansFuture()
+        @coroutine
+        def recover():
+            try:
+                yield failing
+            except MetabansError, err:
+                yield 'recovered from %s' % err.code
+        future = recover()
+        failing.set_exception(MetabansError({'code': 9, 'message': 'unknown player'}))
+        self.assertEqual('recovered from 9', future.result())
+
+    def test_uncaught_exception(self):
+        failing = MetabansFuture()
+        @coroutine
+        def fail():
+            yield failing
+        future = fail()
+        failing.set_exception(socket.error('gone'))
+        self.assertRaises(socket.error, future.result)
+
+    def test_function_not_a_generator(self):
+        @coroutine
+        def plain():
+            return 42
+        self.assertEqual(42, plain().result())
+
+
+class Test_AsyncMetabans(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeMetabans()
+        self.server = FakeMetabansServer(metabans=self.fake).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def client(self, **kwargs):
+        metabans = AsyncMetabans('user', 'key', url=self.server.url, **kwargs)
+        self.addCleanup(metabans.close)
+        return metabans
+
+    def test_calls(self):
+        metabans = self.client()
+        futures = [metabans.mb_sight_player('BF_3', Player('EA_%s' % i, 'p%s' % i)) for i in range(5)]
+        self.assertEqual(['EA_%s' % i for i in range(5)],
+                         [data['player_uid'] for data in metabans.wait(futures)])
+
+    def test_max_connections(self):
+        self.fake.latency = 0.2
+        metabans = self.client(max_connections=2)
+        futures = [metabans.mb_sight_player('BF_3', Player('EA_%s' % i, 'p%s' % i)) for i in range(5)]
+        self.assertEqual(2, len(metabans._calls))
+        self.assertEqual(5, metabans.pending)
+        started = time.time()
+        metabans.wait(futures)
+        # 3 rounds of 2 calls at most
+        self.assertTrue(time.time() - started >= 0.5)
+        self.assertEqual(5, self.server.calls)
+
+    def test_timeout(self):
+        self.fake.latency = 2
+        metabans = self.client(timeout=0.3)
+        future = metabans.mb_sight_player('BF_3', Player('EA_1', 'p1'))
+        started = time.time()
+        self.assertRaises(socket.timeout, metabans.wait, future)
+        self.assertTrue(time.time() - started < 1.5)
+
+    def test_metabans_error(self):
+        metabans = self.client()
+        future = metabans.mbo_player_status('BF_3', 'EA_unknown')
+        try:
+            metabans.wait(future)
+        except MetabansError, err:
+            self.assertEqual(9, err.code)
+        else:
+            self.fail("MetabansError not raised")
+        self.assertEqual(9, future.exception().code)
+
+    def test_coroutine_of_calls(self):
+        metabans = self.client()
+        @coroutine
+        def sight_then_check():
+            yield metabans.mb_sight_player('BF_3', Player('EA_1', 'p1'))
+            status = yield metabans.mbo_player_status('BF_3', 'EA_1')
+            yield status['player_uid']
+        self.assertEqual(['EA_1'], metabans.wait(sight_then_check()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+from batching import BatchSizer, batches, recheck_interval
+import unittest
+
+
+class Test_BatchSizer(unittest.TestCase):
+    def setUp(self):
+        self.sizer = BatchSizer(initial=50, minimum=1, maximum=200, step=5, target_latency=2.0)
+
+    def full_batches(self, count, latency=0.2):
+        for i in range(count):
+            self.sizer.record(self.sizer.size, latency)
+
+    def test_full_batches_grow(self):
+        self.full_batches(5)
+        self.assertEqual(75, self.sizer.size)
+
+    def test_size_stays_within_bounds(self):
+        self.full_batches(100)
+        self.assertEqual(200, self.sizer.size)
+        for i in range(20):
+            self.sizer.failed()
+        self.assertEqual(1, self.sizer.size)
+
+    def test_partial_batch_does_not_grow(self):
+        self.sizer.record(10, 0.2)
+        self.assertEqual(50, self.sizer.size)
+
+    def test_lone_requests_do_not_shrink(self):
+        self.full_batches(5)
+        # a lone request taking as long as a full batch
+        self.sizer.record(1, 0.2)
+        self.sizer.record(1, 0.2)
+        self.assertEqual(75, self.sizer.size)
+
+    def test_latency_spike_shrinks(self):
+        self.full_batches(5)
+        self.sizer.record(75, 1.0)
+        self.assertEqual(37, self.sizer.size)
+
+    def test_server_time_spike_shrinks(self):
+        for i in range(5):
+            self.sizer.record(self.sizer.size, 0.2, [0.001] * self.sizer.size)
+        self.sizer.record(1, 0.2, [0.01])
+        self.assertEqual(37, self.sizer.size)
+
+    def test_slow_call_shrinks(self):
+        self.sizer.record(1, 3.0)
+        self.assertEqual(25, self.sizer.size)
+
+    def test_failure_shrinks(self):
+        self.sizer.failed()
+        self.assertEqual(25, self.sizer.size)
+
+    def test_fixed_size(self):
+        sizer = BatchSizer(initial=50, minimum=50, maximum=50)
+        sizer.record(50, 0.1)
+        sizer.failed()
+        self.assertEqual(50, sizer.size)
+
+
+
+class Test_batches(unittest.TestCase):
+    def test_fixed_size(self):
+        self.assertEqual([[0, 1], [2, 3], [4]], list(batches(range(5), 2)))
+        self.assertEqual([], list(batches([], 2)))
+
+    def test_size_function(self):
+        sizes = iter([1, 3, 10])
+        self.assertEqual([[0], [1, 2, 3], [4, 5]], list(batches(range(6), lambda: next(sizes))))
+
+    def test_iterable_is_consumed_lazily(self):
+        consumed = []
+        def items():
+            for i in range(10):
+                consumed.append(i)
+                yield i
+        chunks = batches(items(), 3)
+        self.assertEqual([0, 1, 2], next(chunks))
+        self.assertEqual([0, 1, 2], consumed)
+
+
+class Test_recheck_interval(unittest.TestCase):
+    def test_single_fast_call(self):
+        self.assertEqual(30, recheck_interval(30, 300, 1, 0.5, 2))
+        self.assertEqual(30, recheck_interval(30, 300, 0, 0, 2))
+
+    def test_stretched_by_calls(self):
+        self.assertEqual(90, recheck_interval(30, 300, 3, 0.5, 2))
+
+    def test_stretched_by_slow_calls(self):
+        self.assertEqual(120, recheck_interval(30, 300, 2, 4, 2))
+
+    def test_bounded(self):
+        self.assertEqual(300, recheck_interval(30, 300, 20, 8, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
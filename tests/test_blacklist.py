@@ -0,0 +1,150 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+from blacklist import Assessment, BlacklistMirror, assessment_from_status
+from fakemetabans import FakeMetabans, FakeTransport
+from localstore import LocalStore
+from outbox import Outbox
+from pymetabans import Metabans, assess_player_request
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+
+class Test_BlacklistMirror(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'metabans.sqlite')
+        self.mirror = BlacklistMirror(LocalStore(self.path))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_unknown_player(self):
+        self.assertEqual(None, self.mirror.get('EA_1'))
+        self.assertEqual(None, self.mirror.banned('EA_1'))
+
+    def test_banned(self):
+        ban = Assessment('black', None, 'cheat', None)
+        self.mirror.update('EA_1', ban)
+        self.mirror.update('EA_2', Assessment('watch', None, None, None))
+        self.assertEqual(ban, self.mirror.banned('EA_1'))
+        self.assertEqual(None, self.mirror.banned('EA_2'))
+        self.assertEqual('watch', self.mirror.get('EA_2').type)
+
+    def test_expired_assessment_is_dropped(self):
+        self.mirror.update('EA_1', Assessment('black', time.time() - 1, 'cheat', None))
+        self.assertEqual(None, self.mirror.banned('EA_1'))
+        self.assertEqual(0, len(self.mirror))
+
+    def test_update_many(self):
+        self.mirror.update_many([('EA_%s' % i, Assessment('black', None, None, None)) for i in range(3)])
+        self.mirror.update_many([('EA_0', None), ('EA_1', Assessment('white', None, None, None))])
+        self.assertEqual(2, len(self.mirror))
+        self.assertEqual(None, self.mirror.get('EA_0'))
+        self.assertEqual('white', self.mirror.get('EA_1').type)
+
+    def test_survives_restart(self):
+        ban = Assessment('black', time.time() + 3600, 'cheat', 'BF_3')
+        self.mirror.update('EA_1', ban)
+        self.mirror.update('EA_2', Assessment('black', time.time() - 1, 'old', None))
+        self.mirror.update('EA_3', ban)
+        self.mirror.update('EA_3', None)
+        mirror = BlacklistMirror(LocalStore(self.path))
+        self.assertEqual(1, len(mirror))
+        self.assertEqual(ban, mirror.banned('EA_1'))
+
+    def test_assessment_from_status(self):
+        self.assertEqual(None, assessment_from_status({'is_banned': False}))
+        assessment = assessment_from_status({'is_banned': True, 'assessment_expires': '0',
+                                             'reason': 'cheat'})
+        self.assertEqual(Assessment('black', None, 'cheat', None), assessment)
+        self.assertEqual('white', assessment_from_status({'is_whitelisted': True}).type)
+
+
+class Test_refresh(unittest.TestCase):
+    """the local gate kicks the players the mirror knows as banned, the mirror
+    being refreshed from the Metabans responses"""
+    def setUp(self):
+        self.store = LocalStore(':memory:')
+        self.mirror = BlacklistMirror(self.store)
+        # never started : what is put in stays pending
+        self.outbox = Outbox(self.store, Metabans(transport=FakeTransport(FakeMetabans())))
+
+    def assess(self, uid, assessment_type, reason=None):
+        """what the plugin does when an admin assesses a player"""
+        self.mirror.update(uid, Assessment(assessment_type, None, reason, None)
+                           if assessment_type != 'none' else None)
+        self.outbox.put([assess_player_request('BF_3', uid, assessment_type, None, reason)])
+
+    def test_banned_by_metabans(self):
+        self.mirror.refresh('EA_1', assessment_from_status({'is_banned': True, 'reason': 'cheat',
+                                                            'inherited_blacklist': 'BF_3'}),
+                            self.outbox.has_assessment)
+        assessment = self.mirror.banned('EA_1')
+        self.assertEqual('cheat', assessment.reason)
+        self.assertEqual('BF_3', assessment.inherited)
+
+    def test_unbanned_by_metabans(self):
+        self.mirror.update('EA_1', Assessment('black', None, 'cheat', None))
+        self.mirror.refresh('EA_1', assessment_from_status({'is_banned': False}),
+                            self.outbox.has_assessment)
+        self.assertEqual(None, self.mirror.banned('EA_1'))
+        self.assertEqual(0, len(self.store.execute("SELECT * FROM assessments")))
+
+    def test_whitelisted_player_is_not_kicked(self):
+        self.mirror.refresh('EA_1', assessment_from_status({'is_whitelisted': True}),
+                            self.outbox.has_assessment)
+        self.assertEqual(None, self.mirror.banned('EA_1'))
+        self.assertEqual('white', self.mirror.get('EA_1').type)
+
+    def test_pending_ban_is_kept(self):
+        self.assess('EA_1', 'black', 'cheat')
+        # Metabans has not received our ban yet
+        self.mirror.refresh('EA_1', None, self.outbox.has_assessment)
+        self.assertEqual('cheat', self.mirror.banned('EA_1').reason)
+
+    def test_pending_unban_is_kept(self):
+        self.mirror.update('EA_1', Assessment('black', None, 'cheat', None))
+        self.assess('EA_1', 'none')
+        self.mirror.refresh('EA_1', assessment_from_status({'is_banned': True, 'reason': 'cheat'}),
+                            self.outbox.has_assessment)
+        self.assertEqual(None, self.mirror.banned('EA_1'))
+
+    def test_only_pending_players_are_skipped(self):
+        self.assess('EA_1', 'black', 'cheat')
+        self.mirror.update('EA_2', Assessment('black', None, 'old', None))
+        self.mirror.refresh('EA_1', None, self.outbox.has_assessment)
+        self.mirror.refresh('EA_2', None, self.outbox.has_assessment)
+        self.assertNotEqual(None, self.mirror.banned('EA_1'))
+        self.assertEqual(None, self.mirror.banned('EA_2'))
+
+    def test_unchanged_assessment_is_not_rewritten(self):
+        ban = Assessment('black', None, 'cheat', None)
+        self.mirror.update('EA_1', ban)
+        pending = []
+        self.mirror.refresh('EA_1', ban, pending.append)
+        self.assertEqual([], pending)
+
+    def test_without_outbox(self):
+        self.mirror.update('EA_1', Assessment('black', None, 'cheat', None))
+        self.mirror.refresh('EA_1', None)
+        self.assertEqual(None, self.mirror.banned('EA_1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
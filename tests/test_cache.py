@@ -0,0 +1,70 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+from cache import StatusCache
+import time
+import unittest
+
+
+class Test_StatusCache(unittest.TestCase):
+    def test_get(self):
+        cache = StatusCache()
+        cache.put('a', 1)
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+    def test_expiration(self):
+        cache = StatusCache(ttl=0.05, unknown_ttl=0)
+        cache.put('a', 1)
+        cache.put_unknown('b', 2)
+        self.assertFalse('b' in cache)
+        self.assertTrue('a' in cache)
+        time.sleep(0.1)
+        self.assertEqual(None, cache.get('a'))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = StatusCache(max_size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual([1, None, 3], [cache.get(k) for k in 'abc'])
+
+    def test_invalidate(self):
+        cache = StatusCache()
+        cache.put('a', 1)
+        cache.invalidate('a')
+        self.assertEqual(None, cache.get('a'))
+
+    def test_value_fetched_before_invalidation_is_dropped(self):
+        cache = StatusCache()
+        generation = cache.generation('a')
+        cache.invalidate('a')
+        cache.put('a', 'old', generation=generation)
+        self.assertEqual(None, cache.get('a'))
+        cache.put('a', 'new', generation=cache.generation('a'))
+        self.assertEqual('new', cache.get('a'))
+
+    def test_invalidation_of_other_keys_does_not_drop_value(self):
+        cache = StatusCache()
+        generation = cache.generation('a')
+        cache.invalidate('b')
+        cache.put('a', 1, generation=generation)
+        self.assertEqual(1, cache.get('a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
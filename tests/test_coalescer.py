@@ -0,0 +1,174 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+from coalescer import RequestCoalescer, _PendingRequest
+from fakemetabans import FakeMetabans, FakeTransport
+from pymetabans import Metabans, MetabansError, Player, player_status_request, \
+    sight_player_request
+from workers import PRIORITY_ENFORCEMENT, PRIORITY_SIGHTING
+import socket
+import threading
+import time
+import unittest
+
+
+class Test_RequestCoalescer(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeMetabans()
+        self.metabans = Metabans(transport=FakeTransport(self.fake))
+        self.coalescer = RequestCoalescer(self.metabans, window=0.2, max_batch=50)
+
+    def tearDown(self):
+        self.coalescer.close()
+
+    def submit_all(self, requests, priority=PRIORITY_SIGHTING):
+        results = [None] * len(requests)
+        def submit(i):
+            try:
+                results[i] = self.coalescer.submit(requests[i], priority)
+            except Exception, err:
+                results[i] = err
+        threads = [threading.Thread(target=submit, args=(i,)) for i in range(len(requests))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def test_concurrent_requests_make_a_single_call(self):
+        requests = [sight_player_request('BF_3', Player('EA_%s' % i, 'p%s' % i)) for i in range(10)]
+        results = self.submit_all(requests)
+        self.assertEqual(1, self.fake.calls)
+        self.assertEqual(['EA_%s' % i for i in range(10)], [r['player_uid'] for r in results])
+
+    def test_each_caller_gets_its_own_error(self):
+        self.fake.handle_request(sight_player_request('BF_3', Player('EA_known', 'known')))
+        results = self.submit_all([player_status_request('BF_3', 'EA_known'),
+                                   player_status_request('BF_3', 'EA_unknown')])
+        self.assertEqual('EA_known', results[0]['player_uid'])
+        self.assertTrue(isinstance(results[1], MetabansError))
+        self.assertEqual(9, results[1].code)
+
+    def test_batches_are_limited_to_max_batch(self):
+        self.coalescer.max_batch = 4
+        self.submit_all([sight_player_request('BF_3', Player('EA_%s' % i, 'p%s' % i)) for i in range(10)])
+        self.assertEqual(3, self.fake.calls)
+
+    def test_enforcement_requests_go_first(self):
+        self.coalescer.max_batch = 2
+        for i in range(3):
+            request = sight_player_request('BF_3', Player('EA_%s' % i, 'p%s' % i))
+            self.coalescer._lanes[PRIORITY_SIGHTING].append(_PendingRequest(request, PRIORITY_SIGHTING))
+        request = player_status_request('BF_3', 'EA_check')
+        self.coalescer._lanes[PRIORITY_ENFORCEMENT].append(_PendingRequest(request, PRIORITY_ENFORCEMENT))
+        batch = self.coalescer._next_batch()
+        self.assertEqual(['mbo_player_status', 'mb_sight_player'], [item.request['action'] for item in batch])
+        self.assertEqual(2, self.coalescer.pending)
+
+    def test_slow_batch_does_not_hold_up_the_next_ones(self):
+        gate = threading.Event()
+        self.addCleanup(gate.set)
+        send = self.metabans.batch
+        def batch():
+            if not self.slow_started.isSet():
+                self.slow_started.set()
+                gate.wait(5)
+            return send()
+        self.slow_started = threading.Event()
+        self.metabans.batch = batch
+        self.coalescer.window = 0.05
+        self.coalescer.timeout = 2
+        slow = threading.Thread(target=self.coalescer.submit,
+                                args=(sight_player_request('BF_3', Player('EA_1', 'p1')),))
+        slow.start()
+        self.assertTrue(self.slow_started.wait(5))
+        self.assertEqual('EA_2', self.coalescer.submit(
+            sight_player_request('BF_3', Player('EA_2', 'p2')), PRIORITY_ENFORCEMENT)['player_uid'])
+        gate.set()
+        slow.join(5)
+
+    def test_enforcement_does_not_wait_for_busy_senders(self):
+        self.coalescer.concurrency = 1
+        self.coalescer.window = 0.05
+        self.coalescer.timeout = 2
+        gate = threading.Event()
+        self.addCleanup(gate.set)
+        sending = threading.Event()
+        send = self.metabans.batch
+        def batch():
+            if threading.currentThread().name == 'metabans-coalescer':
+                sending.set()
+                gate.wait(5)
+            return send()
+        self.metabans.batch = batch
+        for i in range(3):
+            thread = threading.Thread(target=self.coalescer.submit,
+                                      args=(sight_player_request('BF_3', Player('EA_%s' % i, 'p')),))
+            thread.setDaemon(True)
+            thread.start()
+        self.assertTrue(sending.wait(5))
+        self.assertEqual('EA_check', self.coalescer.submit(
+            sight_player_request('BF_3', Player('EA_check', 'p')), PRIORITY_ENFORCEMENT)['player_uid'])
+
+    def test_concurrency_is_bounded(self):
+        self.coalescer.concurrency = 2
+        self.coalescer.window = 0
+        gate = threading.Event()
+        self.addCleanup(gate.set)
+        send = self.metabans.batch
+        def batch():
+            gate.wait(5)
+            return send()
+        self.metabans.batch = batch
+        for i in range(5):
+            thread = threading.Thread(target=self.coalescer.submit,
+                                      args=(sight_player_request('BF_3', Player('EA_%s' % i, 'p')),))
+            thread.setDaemon(True)
+            thread.start()
+        time.sleep(0.3)
+        self.assertEqual(2, len(self.coalescer._threads))
+        gate.set()
+
+    def test_close_stops_the_threads(self):
+        self.coalescer.submit(sight_player_request('BF_3', Player('EA_1', 'p1')))
+        threads = list(self.coalescer._threads)
+        self.coalescer.close()
+        for thread in threads:
+            thread.join(1)
+            self.assertFalse(thread.isAlive())
+        # a request submitted afterwards is still sent
+        self.assertEqual('EA_2', self.coalescer.submit(
+            sight_player_request('BF_3', Player('EA_2', 'p2')))['player_uid'])
+
+    def test_wait_is_bounded(self):
+        gate = threading.Event()
+        self.addCleanup(gate.set)
+        send = self.metabans.batch
+        def blocked_batch():
+            gate.wait(5)
+            return send()
+        self.metabans.batch = blocked_batch
+        self.coalescer.timeout = 0.3
+        self.assertRaises(socket.timeout, self.coalescer.submit,
+                          sight_player_request('BF_3', Player('EA_1', 'p1')))
+        # a request still waiting for its batch is given up
+        self.coalescer.window = 5
+        self.assertRaises(socket.timeout, self.coalescer.submit,
+                          sight_player_request('BF_3', Player('EA_2', 'p2')))
+        self.assertEqual(0, self.coalescer.pending)
+
+
+if __name__ == '__main__':
+    unittest.main()
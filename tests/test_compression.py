@@ -0,0 +1,70 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+from pymetabans import decompress_chunks, gzip_compress
+import unittest
+import zlib
+
+
+def split(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+def raw_deflate(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class Test_compression(unittest.TestCase):
+    body = '{"responses": [%s]}' % ', '.join(['{"status": "OK"}'] * 100)
+
+    def decompress(self, chunks, encoding):
+        return ''.join(decompress_chunks(chunks, encoding))
+
+    def test_gzip_compress(self):
+        compressed = gzip_compress(self.body)
+        self.assertTrue(len(compressed) < len(self.body))
+        self.assertEqual(self.body, zlib.decompress(compressed, 16 + zlib.MAX_WBITS))
+
+    def test_identity(self):
+        self.assertEqual(self.body, self.decompress(split(self.body, 10), None))
+        self.assertEqual(self.body, self.decompress(split(self.body, 10), 'identity'))
+
+    def test_gzip(self):
+        compressed = gzip_compress(self.body)
+        for size in (1, 2, 5, len(compressed)):
+            self.assertEqual(self.body, self.decompress(split(compressed, size), 'gzip'))
+        self.assertEqual(self.body, self.decompress([compressed], ' X-GZIP '))
+
+    def test_deflate(self):
+        for compressed in (zlib.compress(self.body), raw_deflate(self.body)):
+            for size in (1, 2, 5, len(compressed)):
+                self.assertEqual(self.body, self.decompress(split(compressed, size), 'deflate'))
+
+    def test_tiny_bodies(self):
+        self.assertEqual('', self.decompress([], 'gzip'))
+        self.assertEqual('', self.decompress([''], 'deflate'))
+        self.assertEqual('', self.decompress(split(raw_deflate(''), 1), 'deflate'))
+        self.assertEqual('a', self.decompress(split(raw_deflate('a'), 1), 'deflate'))
+
+    def test_single_byte_body(self):
+        # a body shorter than a zlib header is not silently dropped
+        self.assertRaises(zlib.error, self.decompress, ['\xff'], 'deflate')
+
+    def test_unsupported_encoding(self):
+        self.assertRaises(ValueError, self.decompress, ['x'], 'br')
+
+
+if __name__ == '__main__':
+    unittest.main()
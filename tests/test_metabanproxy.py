@@ -0,0 +1,89 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+from fakemetabans import FakeMetabans, FakeTransport
+from metabanproxy import MetabansProxy
+from pymetabans import MetabansError, Player, sight_player_request
+import threading
+import unittest
+
+
+class Client(object):
+    def __init__(self, guid, name='joe', ip=None, pbid=None):
+        self.guid = guid
+        self.name = name
+        self.ip = ip
+        self.pbid = pbid
+
+
+class GatedTransport(FakeTransport):
+    """FakeTransport whose calls wait for the gate to open"""
+    def __init__(self, metabans):
+        FakeTransport.__init__(self, metabans)
+        self.gate = threading.Event()
+        self.gate.set()
+        self.entered = threading.Event()
+
+    def post_stream(self, body, headers, wire=None):
+        self.entered.set()
+        self.gate.wait(5)
+        return FakeTransport.post_stream(self, body, headers, wire)
+
+
+class Test_MetabansProxy(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeMetabans()
+        self.transport = GatedTransport(self.fake)
+        self.proxy = MetabansProxy('bf3', coalesce_window=0, transport=self.transport)
+        self.client = Client('EA_1')
+        self.fake.handle_request(sight_player_request('BF_3', Player('EA_1', 'joe')))
+
+    def test_check_is_cached(self):
+        self.proxy.check(self.client)
+        self.proxy.check(self.client)
+        self.assertEqual(1, self.fake.calls)
+        self.assertTrue(self.proxy.is_fresh(self.client))
+
+    def test_unknown_player_is_cached(self):
+        self.assertRaises(MetabansError, self.proxy.check, Client('EA_unknown'))
+        self.assertRaises(MetabansError, self.proxy.check, Client('EA_unknown'))
+        self.assertEqual(1, self.fake.calls)
+
+    def test_ban_forgets_the_status(self):
+        self.assertFalse(self.proxy.check(self.client)['is_banned'])
+        self.proxy.ban(self.client, reason='cheat')
+        self.assertTrue(self.proxy.check(self.client)['is_banned'])
+
+    def test_status_in_flight_during_assessment_is_not_cached(self):
+        self.transport.gate.clear()
+        checking = threading.Thread(target=self.proxy.check, args=(self.client,))
+        checking.start()
+        self.transport.entered.wait(5)
+        # the player is banned while its old status is on its way
+        self.proxy.forget(self.client.guid)
+        self.transport.gate.set()
+        checking.join()
+        self.assertFalse(self.proxy.is_fresh(self.client))
+
+    def test_check_many_bypasses_the_cache(self):
+        self.proxy.check(self.client)
+        statuses = self.proxy.check_many([self.client, Client('EA_unknown')])
+        self.assertEqual(2, self.fake.calls)
+        self.assertEqual('EA_1', statuses[0][1]['player_uid'])
+        self.assertEqual(9, statuses[1][1].code)
+
+
+if __name__ == '__main__':
+    unittest.main()
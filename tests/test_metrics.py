@@ -0,0 +1,82 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+from asyncmetabans import AsyncMetabans
+from fakemetabans import FakeMetabansServer
+from metrics import Metrics
+from pymetabans import Metabans, Player, sight_player_request
+import unittest
+
+
+class Test_Metrics(unittest.TestCase):
+    def test_histograms_are_copies(self):
+        metrics = Metrics()
+        metrics.observe('round_trip_seconds', 0.1, action='mb_sight_player')
+        histogram = metrics.histograms('round_trip_seconds')[(('action', 'mb_sight_player'),)]
+        metrics.observe('round_trip_seconds', 0.2, action='mb_sight_player')
+        self.assertEqual(1, histogram.count)
+        self.assertEqual(2, metrics.histograms('round_trip_seconds').values()[0].count)
+
+
+class Test_wire_bytes(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeMetabansServer().start()
+        self.metrics = Metrics()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def sight_many(self, metabans):
+        batch = metabans.batch()
+        for i in range(50):
+            batch.sight('BF_3', Player('EA_%s' % i, 'player %s' % i))
+        return batch.send()
+
+    def assertWireBytes(self):
+        self.assertEqual(self.server.bytes_received, self.metrics.counter('bytes_sent_total'))
+        self.assertEqual(self.server.bytes_sent, self.metrics.counter('bytes_received_total'))
+
+    def test_compressed_bytes_are_counted(self):
+        metabans = Metabans('user', 'key', url=self.server.url, compress_requests=True,
+                            metrics=self.metrics)
+        try:
+            self.sight_many(metabans)
+        finally:
+            metabans.close()
+        self.assertWireBytes()
+
+    def test_call_read_partly_is_recorded(self):
+        metabans = Metabans('user', 'key', url=self.server.url, metrics=self.metrics)
+        try:
+            requests = [sight_player_request('BF_3', Player('EA_%s' % i, 'p')) for i in range(3)]
+            responses = metabans.iter_multi_query(requests)
+            next(responses)
+            responses.close()
+        finally:
+            metabans.close()
+        self.assertEqual(1, self.metrics.counter('calls_total'))
+
+    def test_async(self):
+        metabans = AsyncMetabans('user', 'key', url=self.server.url, metrics=self.metrics)
+        try:
+            metabans.wait(self.sight_many(metabans))
+        finally:
+            metabans.close()
+        self.assertWireBytes()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+from fakemetabans import FakeMetabans, FakeTransport
+from localstore import LocalStore
+from outbox import Outbox
+from pymetabans import Metabans, Player, assess_player_request, sight_player_request
+import time
+import unittest
+
+
+def ban(uid, length=None):
+    return assess_player_request('BF_3', uid, 'black', length, 'cheat')
+
+def unban(uid):
+    return assess_player_request('BF_3', uid, 'none')
+
+def sighting(uid):
+    return sight_player_request('BF_3', Player(uid, 'joe'))
+
+
+class Test_Outbox(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeMetabans()
+        self.store = LocalStore(':memory:')
+        self.delivered = []
+        self.auth_errors = 0
+        self.outbox = Outbox(self.store, Metabans(transport=FakeTransport(self.fake)),
+                             on_delivered=self.delivered.append,
+                             on_auth_error=self.on_auth_error)
+
+    def tearDown(self):
+        self.outbox.stop()
+
+    def on_auth_error(self):
+        self.auth_errors += 1
+        self.outbox.stop()
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if condition():
+                return
+            time.sleep(0.01)
+        self.fail("timed out")
+
+    def test_requests_are_delivered_in_order(self):
+        self.outbox.put([sighting('EA_1'), ban('EA_1')])
+        self.outbox.start()
+        self.wait_for(lambda: len(self.outbox) == 0)
+        self.assertEqual(['mb_sight_player', 'mb_assess_player'], [r['action'] for r in self.delivered])
+        self.assertTrue(self.fake._status(('BF_3', 'EA_1'))['is_banned'])
+
+    def test_requests_are_kept_until_started(self):
+        self.outbox.put([sighting('EA_1')])
+        outbox = Outbox(self.store, self.outbox.metabans)
+        self.assertEqual(1, len(outbox))
+
+    def test_last_assessment_of_a_player_replaces_the_others(self):
+        self.outbox.put([sighting('EA_1'), ban('EA_1')])
+        self.outbox.put([sighting('EA_1'), unban('EA_1')])
+        self.assertEqual(2, len(self.outbox))
+        self.assertEqual(2, self.outbox.compacted)
+        self.assertTrue(self.outbox.has_assessment('EA_1'))
+        self.assertFalse(self.outbox.has_assessment('EA_2'))
+
+    def test_expired_tempban_is_delivered_as_no_assessment(self):
+        self.outbox.put([sighting('EA_1'), ban('EA_1', length=60)])
+        self.store.execute("UPDATE outbox SET time_add = time_add - 120")
+        self.outbox.start()
+        self.wait_for(lambda: len(self.outbox) == 0)
+        self.assertEqual(-1, self.delivered[1]['assessment_length'])
+        self.assertFalse(self.fake._status(('BF_3', 'EA_1'))['is_banned'])
+
+    def test_delivery_is_retried(self):
+        self.fake.failing_calls = 1
+        self.outbox.put([sighting('EA_1')])
+        self.outbox.start()
+        self.wait_for(lambda: len(self.outbox) == 0)
+        self.assertEqual(2, self.fake.calls)
+
+    def test_authentication_error_stops_delivery(self):
+        self.fake.accounts = {'user': 'key'}
+        self.outbox.metabans.username = 'user'
+        self.outbox.metabans.apikey = 'wrong key'
+        self.outbox.put([sighting('EA_1')])
+        self.outbox.start()
+        self.wait_for(lambda: self.auth_errors)
+        time.sleep(0.2)
+        self.assertEqual(1, self.fake.calls)
+        self.assertEqual(1, len(self.outbox))
+        # delivered once started again with the right key
+        self.outbox.metabans.apikey = 'key'
+        self.outbox.start()
+        self.wait_for(lambda: len(self.outbox) == 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
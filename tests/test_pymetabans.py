@@ -0,0 +1,186 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+from fakemetabans import FakeMetabans, FakeMetabansHandler, FakeMetabansServer
+from asyncmetabans import AsyncMetabans
+from pymetabans import HTTPConnectionPool, Metabans, Player, abbreviate, iter_responses
+import httplib
+import json
+import socket
+import time
+import unittest
+import urllib
+import urllib2
+
+
+def sighting_body(uid='EA_1'):
+    return urllib.urlencode({'options': 'json',
+                             'requests[0][action]': 'mb_sight_player',
+                             'requests[0][game_name]': 'BF_3',
+                             'requests[0][player_uid]': uid,
+                             'requests[0][player_name]': 'joe'})
+
+
+def split(body, size):
+    return [body[i:i + size] for i in range(0, len(body), size)]
+
+
+class Test_abbreviate(unittest.TestCase):
+    def test_short(self):
+        self.assertEqual("'abc'", abbreviate('abc'))
+
+    def test_long(self):
+        self.assertEqual("'aaaaa'... (1000000 characters)", abbreviate('a' * 1000000, limit=5))
+
+
+class Test_iter_responses(unittest.TestCase):
+    responses = [{'status': 'OK', 'data': {'player_uid': 'EA_1', 'reason': 'a "quoted" } [ reason \\'}},
+                 {'status': 'OK', 'data': {'list': [1, [2, {}], "]"]}},
+                 {'status': 'ERROR', 'error': {'code': 9, 'message': 'unknown player'}}]
+
+    def body(self):
+        return json.dumps({'responses': self.responses, 'fetch_time': 0.01})
+
+    def test_whole_body(self):
+        self.assertEqual(self.responses, list(iter_responses([self.body()])))
+
+    def test_any_split(self):
+        body = self.body()
+        for size in (1, 2, 3, 7, 50):
+            self.assertEqual(self.responses, list(iter_responses(split(body, size))), size)
+
+    def test_no_response(self):
+        self.assertEqual([], list(iter_responses(split('{"responses" : [ ]}', 3))))
+
+    def test_truncated(self):
+        body = self.body()
+        self.assertRaises(ValueError, list, iter_responses(split(body[:len(body) // 2], 5)))
+        self.assertRaises(ValueError, list, iter_responses(['{"error": "nothing"}']))
+
+    def test_big_response_in_small_chunks(self):
+        responses = [{'status': 'OK', 'data': {'players': ['EA_%s' % i for i in range(20000)]}}]
+        body = json.dumps({'responses': responses})
+        started = time.time()
+        self.assertEqual(responses, list(iter_responses(split(body, 16))))
+        self.assertTrue(time.time() - started < 5)
+
+
+class Test_HTTPConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.metabans = FakeMetabans()
+        self.server = FakeMetabansServer(metabans=self.metabans).start()
+        self.pool = HTTPConnectionPool(self.server.url)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_is_reused(self):
+        self.pool.post(sighting_body(), {})
+        self.pool.post(sighting_body(), {})
+        self.assertEqual(2, self.server.calls)
+        self.assertEqual(1, len(self.pool._idle))
+
+    def test_connection_closed_by_server_is_not_reused(self):
+        timeout = FakeMetabansHandler.timeout
+        FakeMetabansHandler.timeout = 0.1
+        try:
+            self.pool.post(sighting_body(), {})
+            time.sleep(0.5)
+        finally:
+            FakeMetabansHandler.timeout = timeout
+        self.pool.post(sighting_body(), {})
+        self.assertEqual(2, self.server.calls)
+
+    def test_request_sent_is_not_sent_again(self):
+        self.pool.post(sighting_body(), {})
+        # the connection is lost after the request reached Metabans
+        self.metabans.disconnect_rate = 1.0
+        self.assertRaises((httplib.HTTPException, socket.error),
+                          self.pool.post, sighting_body('EA_2'), {})
+        self.assertEqual(2, self.server.calls)
+
+    def test_timeout(self):
+        self.metabans.latency = 2
+        pool = HTTPConnectionPool(self.server.url, timeout=0.2)
+        started = time.time()
+        self.assertRaises(socket.timeout, pool.post, sighting_body(), {})
+        self.assertTrue(time.time() - started < 1.5)
+
+
+class Test_Metabans(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeMetabansServer().start()
+        self.metabans = Metabans('user', 'key', url=self.server.url)
+
+    def tearDown(self):
+        self.metabans.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_sight_player(self):
+        data = self.metabans.mb_sight_player('BF_3', Player('EA_1', 'joe'))
+        self.assertEqual('EA_1', data['player_uid'])
+        self.assertFalse(data['is_banned'])
+
+
+
+class Test_compressed_requests(unittest.TestCase):
+    def call(self, rejection_status):
+        server = FakeMetabansServer(compression=False, rejection_status=rejection_status).start()
+        metabans = Metabans('user', 'key', url=server.url, compress_requests=True,
+                            compress_min_size=0)
+        try:
+            data = metabans.mb_sight_player('BF_3', Player('EA_1', 'joe'))
+            self.assertEqual('EA_1', data['player_uid'])
+            self.assertFalse(metabans.compress_requests)
+            metabans.mb_sight_player('BF_3', Player('EA_2', 'joe'))
+            return server.calls
+        finally:
+            metabans.close()
+            server.shutdown()
+            server.server_close()
+
+    def test_fallback_to_uncompressed_requests(self):
+        for status in (400, 411, 415):
+            # the rejected request is not counted as a call
+            self.assertEqual(2, self.call(status), status)
+
+    def test_other_errors_are_raised(self):
+        self.assertRaises(urllib2.HTTPError, self.call, 500)
+
+
+class Test_AsyncMetabans(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeMetabansServer().start()
+        self.metabans = AsyncMetabans('user', 'key', url=self.server.url)
+
+    def tearDown(self):
+        self.metabans.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_iter_send(self):
+        batch = self.metabans.batch()
+        batch.sight('BF_3', Player('EA_1', 'joe'))
+        batch.status('BF_3', 'EA_unknown')
+        results = list(batch.iter_send())
+        self.assertEqual('EA_1', results[0].get()['player_uid'])
+        self.assertFalse(results[1].ok)
+
+
+if __name__ == '__main__':
+    unittest.main()
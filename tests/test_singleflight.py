@@ -0,0 +1,77 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+from singleflight import SingleFlight
+import threading
+import time
+import unittest
+
+
+class Test_SingleFlight(unittest.TestCase):
+    def setUp(self):
+        self.single_flight = SingleFlight()
+        self.calls = []
+        self.release = threading.Event()
+
+    def slow_call(self, value):
+        self.calls.append(value)
+        self.release.wait(5)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    def do_all(self, key, value, count):
+        """make count identical calls at once and return their outcomes"""
+        results = [None] * count
+        def do(i):
+            try:
+                results[i] = self.single_flight.do(key, self.slow_call, value)
+            except Exception, err:
+                results[i] = err
+        threads = [threading.Thread(target=do, args=(i,)) for i in range(count)]
+        for t in threads:
+            t.start()
+        while self.single_flight.shared < count - 1:
+            time.sleep(0.01)
+        self.release.set()
+        for t in threads:
+            t.join()
+        return results
+
+    def test_identical_calls_are_made_once(self):
+        self.assertEqual(['a'] * 5, self.do_all('key', 'a', 5))
+        self.assertEqual(['a'], self.calls)
+        self.assertEqual(0, self.single_flight.in_flight)
+
+    def test_exception_is_shared(self):
+        error = ValueError('boom')
+        self.assertEqual([error] * 3, self.do_all('key', error, 3))
+        self.assertEqual(1, len(self.calls))
+
+    def test_calls_of_different_keys_are_not_shared(self):
+        self.release.set()
+        self.single_flight.do('a', self.slow_call, 1)
+        self.single_flight.do('b', self.slow_call, 2)
+        self.assertEqual([1, 2], self.calls)
+
+    def test_later_call_is_made_again(self):
+        self.release.set()
+        self.single_flight.do('a', self.slow_call, 1)
+        self.single_flight.do('a', self.slow_call, 1)
+        self.assertEqual([1, 1], self.calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
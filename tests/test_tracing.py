@@ -0,0 +1,107 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+from metrics import Metrics
+from tracing import Trace, Tracer, add_span, current_trace, span
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+
+class Test_Trace(unittest.TestCase):
+    def test_span_without_trace(self):
+        with span('nothing'):
+            pass
+        add_span('nothing', time.time())
+        self.assertEqual(None, current_trace())
+
+    def test_spans_of_the_activated_trace(self):
+        trace = Trace('client_auth', guid='EA_1')
+        with trace.activated():
+            self.assertTrue(current_trace() is trace)
+            with span('check'):
+                time.sleep(0.01)
+            add_span('queue_wait', trace.start)
+        self.assertEqual(None, current_trace())
+        data = trace.to_dict()
+        self.assertEqual('client_auth', data['name'])
+        self.assertEqual({'guid': 'EA_1'}, data['attributes'])
+        self.assertEqual(['queue_wait', 'check'], [s['name'] for s in data['spans']])
+        self.assertTrue(data['spans'][1]['duration_ms'] >= 10)
+
+    def test_span_recorded_on_error(self):
+        trace = Trace('client_auth')
+        def fail():
+            with trace.activated():
+                with span('check'):
+                    raise ValueError()
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(['check'], [name for name, start, end in trace.spans])
+
+    def test_activations_nest(self):
+        outer = Trace('outer')
+        inner = Trace('inner')
+        with outer.activated():
+            with inner.activated():
+                self.assertTrue(current_trace() is inner)
+            self.assertTrue(current_trace() is outer)
+
+
+class Test_Tracer(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'traces.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def finish(self, tracer, duration, **attributes):
+        trace = tracer.start('client_auth', **attributes)
+        trace.start -= duration
+        tracer.finish(trace)
+        return trace
+
+    def test_only_slow_traces_are_written(self):
+        tracer = Tracer(slow_threshold=1.0, path=self.path)
+        self.finish(tracer, 0.1)
+        slow = self.finish(tracer, 2)
+        tracer.close()
+        self.assertEqual(1, tracer.slow)
+        with open(self.path) as f:
+            lines = f.readlines()
+        self.assertEqual([slow.trace_id], [json.loads(line)['trace_id'] for line in lines])
+
+    def test_file_is_rotated(self):
+        tracer = Tracer(slow_threshold=0, path=self.path, max_bytes=1000, backup_count=2)
+        for i in range(50):
+            self.finish(tracer, 0.1, guid='EA_%s' % i)
+        tracer.close()
+        self.assertEqual(['traces.log', 'traces.log.1', 'traces.log.2'], sorted(os.listdir(self.directory)))
+        for name in os.listdir(self.directory):
+            self.assertTrue(os.path.getsize(os.path.join(self.directory, name)) <= 1000)
+
+    def test_metrics(self):
+        metrics = Metrics()
+        tracer = Tracer(metrics=metrics)
+        self.finish(tracer, 0.1, time_to_kick=0.05)
+        self.assertEqual(1, metrics.histograms('trace_seconds').values()[0].count)
+        self.assertEqual(1, metrics.histograms('time_to_kick_seconds').values()[0].count)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+from workers import WorkerPool, OVERFLOW_DROP_NEW, OVERFLOW_DROP_OLDEST, \
+    PRIORITY_ASSESSMENT, PRIORITY_ENFORCEMENT, PRIORITY_SIGHTING
+import threading
+import time
+import unittest
+
+
+class Test_WorkerPool(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.ran = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        self.release.set()
+
+    def blocking_job(self, name):
+        self.release.wait(5)
+        with self.lock:
+            self.ran.append(name)
+
+    def job(self, name, done=None):
+        with self.lock:
+            self.ran.append(name)
+        if done:
+            done.set()
+
+    def busy_pool(self, workers, reserved_workers, queue_size=10, overflow=OVERFLOW_DROP_NEW):
+        """return a pool whose low priority workers are all busy"""
+        pool = WorkerPool(workers=workers, queue_size=queue_size, overflow=overflow,
+                          reserved_workers=reserved_workers)
+        for i in range(workers - pool.reserved_workers):
+            pool.submit(PRIORITY_SIGHTING, self.blocking_job, 'busy')
+        self.wait_for(lambda: pool.active_workers == workers - pool.reserved_workers)
+        return pool
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if condition():
+                return
+            time.sleep(0.01)
+        self.fail("timed out")
+
+    def test_jobs_run(self):
+        pool = WorkerPool(workers=2)
+        done = threading.Event()
+        pool.submit(PRIORITY_SIGHTING, self.job, 'a', done)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(['a'], self.ran)
+
+    def test_reserved_worker_runs_enforcement_while_others_are_busy(self):
+        pool = self.busy_pool(workers=3, reserved_workers=1)
+        pool.submit(PRIORITY_SIGHTING, self.job, 'sighting')
+        done = threading.Event()
+        pool.submit(PRIORITY_ENFORCEMENT, self.job, 'check', done)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(['check'], self.ran)
+        self.assertEqual(1, pool.lane_length(PRIORITY_SIGHTING))
+
+    def test_higher_priority_runs_first(self):
+        pool = self.busy_pool(workers=1, reserved_workers=0)
+        pool.submit(PRIORITY_SIGHTING, self.job, 'sighting')
+        pool.submit(PRIORITY_ASSESSMENT, self.job, 'ban')
+        pool.submit(PRIORITY_ENFORCEMENT, self.job, 'check')
+        self.release.set()
+        self.wait_for(lambda: len(self.ran) == 4)
+        self.assertEqual(['busy', 'check', 'ban', 'sighting'], self.ran)
+
+    def test_full_queue_drops_lower_priority_first(self):
+        pool = self.busy_pool(workers=1, reserved_workers=0, queue_size=2)
+        self.assertTrue(pool.submit(PRIORITY_SIGHTING, self.job, 'sighting'))
+        self.assertTrue(pool.submit(PRIORITY_SIGHTING, self.job, 'sighting'))
+        self.assertTrue(pool.submit(PRIORITY_ENFORCEMENT, self.job, 'check'))
+        self.assertEqual(1, pool.dropped)
+        self.assertEqual(1, pool.lane_length(PRIORITY_SIGHTING))
+
+    def test_drop_new(self):
+        pool = self.busy_pool(workers=1, reserved_workers=0, queue_size=1)
+        self.assertTrue(pool.submit(PRIORITY_SIGHTING, self.job, 'first'))
+        self.assertFalse(pool.submit(PRIORITY_SIGHTING, self.job, 'second'))
+        self.release.set()
+        self.wait_for(lambda: len(self.ran) == 2)
+        self.assertEqual(['busy', 'first'], self.ran)
+
+    def test_drop_oldest(self):
+        pool = self.busy_pool(workers=1, reserved_workers=0, queue_size=1, overflow=OVERFLOW_DROP_OLDEST)
+        self.assertTrue(pool.submit(PRIORITY_SIGHTING, self.job, 'first'))
+        self.assertTrue(pool.submit(PRIORITY_SIGHTING, self.job, 'second'))
+        self.release.set()
+        self.wait_for(lambda: len(self.ran) == 2)
+        self.assertEqual(['busy', 'second'], self.ran)
+
+    def test_full_queue_does_not_block_by_default(self):
+        pool = WorkerPool(workers=1, queue_size=1)
+        pool.submit(PRIORITY_SIGHTING, self.blocking_job, 'busy')
+        self.wait_for(lambda: pool.active_workers == 1)
+        started = time.time()
+        self.assertTrue(pool.submit(PRIORITY_SIGHTING, self.job, 'first'))
+        self.assertTrue(pool.submit(PRIORITY_SIGHTING, self.job, 'second'))
+        self.assertTrue(time.time() - started < 1)
+        self.assertEqual(1, pool.dropped)
+
+    def test_single_worker_runs_any_job(self):
+        pool = WorkerPool(workers=1, reserved_workers=1)
+        self.assertEqual(0, pool.reserved_workers)
+        done = threading.Event()
+        pool.submit(PRIORITY_SIGHTING, self.job, 'sighting', done)
+        self.assertTrue(done.wait(5))
+
+    def test_no_worker(self):
+        self.assertRaises(ValueError, WorkerPool, workers=0)
+
+
+if __name__ == '__main__':
+    unittest.main()